@@ -34,6 +34,8 @@ class Settings(BaseSettings):
     )
 
     BOT_TOKEN: str
+    # custom Bot API server, e.g. a local telegram-bot-api or the load-test stand-in
+    BOT_API_URL: str | None = None
 
     DATABASE_URL: str | None = None
     PGUSER: str | None = None
@@ -47,6 +49,77 @@ class Settings(BaseSettings):
 
     PAY_PROVIDER_TOKEN: str = ""
     PAY_CURRENCY: str = "RUB"
+    # invoices unpaid this long are cancelled; the sweep runs every PENDING_ORDER_SWEEP_SEC
+    PENDING_ORDER_TTL_SEC: int = 60 * 60 * 24
+    PENDING_ORDER_SWEEP_SEC: int = 60 * 10
+
+    # "tuned" applies the SQLITE_*/PG_* settings below, "default" keeps driver defaults
+    DB_ENGINE_PROFILE: str = "tuned"
+
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_CACHE_SIZE: int = -64000  # negative = KiB
+
+    PG_POOL_SIZE: int = 10
+    PG_MAX_OVERFLOW: int = 20
+    PG_POOL_RECYCLE: int = 1800
+    PG_POOL_PRE_PING: bool = False
+    PG_STATEMENT_CACHE_SIZE: int = 500
+
+    # Prometheus /metrics endpoint; disabled when the port is not set
+    METRICS_HOST: str = "0.0.0.0"
+    METRICS_PORT: int | None = None
+
+    # tracing: "jsonl" writes spans to TRACE_FILE, "otlp" posts them to an OTLP/HTTP collector, empty disables
+    TRACE_EXPORTER: str = ""
+    TRACE_FILE: str = "traces.jsonl"
+    TRACE_OTLP_ENDPOINT: str = "http://127.0.0.1:4318"
+    TRACE_SERVICE_NAME: str = "shop-bot"
+    TRACE_SAMPLE_RATE: float = 0.01
+    # traces at least this slow are kept even when not sampled; 0 keeps only sampled ones
+    TRACE_SLOW_MS: int = 1000
+
+    # event-loop watchdog: tick period and the lag that counts as a stall (0 disables the watchdog)
+    LOOP_WATCHDOG_INTERVAL_MS: int = 100
+    LOOP_LAG_THRESHOLD_MS: int = 250
+
+    # statements slower than this are kept with their plan for /slow (0 disables)
+    SLOW_QUERY_MS: int = 200
+    SLOW_QUERY_BUFFER: int = 50
+    # EXPLAIN ANALYZE re-runs the statement; applied to SELECTs only, inside a rolled back transaction
+    SLOW_QUERY_EXPLAIN_ANALYZE: bool = False
+    # the same statement is explained at most once per this many seconds
+    SLOW_QUERY_EXPLAIN_EVERY_SEC: int = 60
+
+    # while the catalog loads at startup, catalog screens wait this long before answering "каталог обновляется"
+    CATALOG_WAIT_TIMEOUT_SEC: float = 5.0
+
+    # per-user state (screen, delivery form, input mode, last UI message, cart) is kept for at most this many
+    # users, least recently active dropped first, and forgotten after this long without activity
+    USER_STATE_MAX_USERS: int = 100_000
+    USER_STATE_TTL_SEC: int = 60 * 60 * 24
+    # cached stock is recomputed as DB stock minus cart holds this often and drift is logged (0 disables)
+    STOCK_RECONCILE_INTERVAL_SEC: int = 300
+
+    # open product screens are re-rendered when their product changes: changes are collected for
+    # LIVE_VIEW_COALESCE_MS, then edited at this total rate, split evenly between WORKERS (0 disables);
+    # screens older than LIVE_VIEW_TTL_SEC are dropped
+    LIVE_VIEW_EDITS_PER_SEC: float = 20
+    LIVE_VIEW_COALESCE_MS: int = 500
+    LIVE_VIEW_TTL_SEC: int = 60 * 60
+
+    # >1: a supervisor receives updates and routes them by user id to this many worker processes
+    WORKERS: int = 1
+    # set by the supervisor in each worker's environment
+    SHARD_INDEX: int | None = None
+    SHARD_SUPERVISOR: str = ""
+    # receive updates through a webhook instead of long polling (sharded mode); the path is taken from the URL
+    WEBHOOK_URL: str = ""
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8080
+    WEBHOOK_SECRET: str = ""
 
     @field_validator("ADMIN_IDS", "MANAGER_IDS", mode="before")
     @classmethod
@@ -0,0 +1,104 @@
+﻿from app.data import catalog
+
+# product id -> {id(cart): cart} of the carts holding it, so a price change marks only those dirty
+_HOLDERS: dict[int, dict[int, "Cart"]] = {}
+
+
+def _price(pid: int) -> int | None:
+    p = catalog.PRODUCTS_BY_ID.get(pid)
+    return p["price"] if p else None
+
+
+class Cart(dict):
+    """One user's lines {product id: qty} with running totals; change lines only through add/remove/clear.
+
+    `count` is every unit in the cart (the badge). `total_qty` and `total` cover the products still in
+    the catalog and are kept by add/remove at the current price; when a product's price changes or it
+    leaves the catalog, `price_changed` marks the carts holding it dirty and the next read walks the lines once.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self._qty = 0
+        self._total = 0
+        self.dirty = False
+
+    def add(self, pid: int, n: int = 1) -> None:
+        if pid not in self:
+            _HOLDERS.setdefault(pid, {})[id(self)] = self
+        self[pid] = self.get(pid, 0) + n
+        self.count += n
+        price = _price(pid)
+        if price is not None:
+            self._qty += n
+            self._total += price * n
+
+    def remove(self, pid: int, n: int | None = None) -> int:
+        """Take `n` units of `pid` out, all of them when None; returns how many were taken."""
+        have = self.get(pid, 0)
+        n = have if n is None else min(n, have)
+        if n <= 0:
+            return 0
+        if n == have:
+            del self[pid]
+            _unhold(pid, self)
+        else:
+            self[pid] = have - n
+        self.count -= n
+        price = _price(pid)
+        if price is not None:
+            self._qty -= n
+            self._total -= price * n
+        return n
+
+    def clear(self) -> dict[int, int]:
+        """Empty the cart; returns the lines it had."""
+        lines = dict(self)
+        for pid in lines:
+            _unhold(pid, self)
+        super().clear()
+        self.count = self._qty = self._total = 0
+        self.dirty = False
+        return lines
+
+    def _recount(self) -> None:
+        qty = total = 0
+        products = catalog.PRODUCTS_BY_ID
+        for pid, n in self.items():
+            p = products.get(pid)
+            if p:
+                qty += n
+                total += p["price"] * n
+        self._qty, self._total, self.dirty = qty, total, False
+
+    @property
+    def total_qty(self) -> int:
+        if self.dirty:
+            self._recount()
+        return self._qty
+
+    @property
+    def total(self) -> int:
+        if self.dirty:
+            self._recount()
+        return self._total
+
+
+def _unhold(pid: int, cart: Cart) -> None:
+    carts = _HOLDERS.get(pid)
+    if carts is not None:
+        carts.pop(id(cart), None)
+        if not carts:
+            del _HOLDERS[pid]
+
+
+def held(pid: int) -> int:
+    """Units of `pid` in this process's carts."""
+    return sum(cart[pid] for cart in _HOLDERS.get(pid, {}).values())
+
+
+def price_changed(pid: int) -> None:
+    """Called by the catalog cache when a product's price changes or it is removed."""
+    for cart in _HOLDERS.get(pid, {}).values():
+        cart.dirty = True
@@ -1,9 +1,26 @@
 ﻿PRODUCTS = {}
 PRODUCTS_BY_ID = {}
+# product id -> its index in PRODUCTS[(category, stone)]; neighbours are the items at pos - 1 and pos + 1
+PRODUCT_POS = {}
+# ascending product ids per /list filter: (None, None) all, (category, None), (None, stone), (category, stone)
+IDS_BY_FILTER = {}
 
 CAT_LABELS = {}
 STONE_LABELS = {}
 
+# id -> {"id", "code", "name_ru"}
+CATEGORIES = {}
+STONES = {}
+
+# code -> id, for compact callback data
+CAT_IDS = {}
+STONE_IDS = {}
+
+# normalized name / slug / transliteration variant -> id
+CAT_TERMS = {}
+STONE_TERMS = {}
+
 for key, items in PRODUCTS.items():
-    for p in items:
-        PRODUCTS_BY_ID[p["id"]] = p
\ No newline at end of file
+    for i, p in enumerate(items):
+        PRODUCTS_BY_ID[p["id"]] = p
+        PRODUCT_POS[p["id"]] = i
\ No newline at end of file
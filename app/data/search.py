@@ -0,0 +1,296 @@
+﻿import heapq
+import re
+from bisect import bisect_left, insort
+from functools import lru_cache
+from itertools import chain
+
+from app.utils.slug import slugify_ru, term_variants
+
+MIN_PREFIX = 2
+MAX_RESULTS = 20
+QUERY_CACHE_SIZE = 1024
+FUZZY_MIN_SIMILARITY = 0.34
+
+TITLE_WEIGHT = 3
+DESC_WEIGHT = 1
+
+_WORD = re.compile(r"[0-9a-zа-яё]+")
+
+
+def words(text: str) -> list[str]:
+    return _WORD.findall((text or "").lower().replace("ё", "е"))
+
+
+@lru_cache(maxsize=65536)
+def _word_tokens(word: str) -> tuple[str, ...]:
+    return tuple(term_variants(word))
+
+
+def tokenize(text: str) -> list[str]:
+    """Cyrillic words plus their transliterations, so "tsitrin", "citrin" and "цитрин" all hit."""
+    out = []
+    for w in words(text):
+        out += _word_tokens(w)
+    return out
+
+
+def _forms(word: str) -> list[str]:
+    """Spellings of a query word that are matched against indexed tokens by prefix."""
+    return [f for f in dict.fromkeys((word, slugify_ru(word))) if len(f) >= MIN_PREFIX]
+
+
+def trigrams(token: str) -> set[str]:
+    t = f"  {token} "
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+
+class SearchIndex:
+    """
+    Inverted index over product title/description kept next to the catalog cache.
+
+    Query words match indexed words by prefix (sorted vocabulary + bisect); a word
+    with no prefix hit falls back to trigram similarity to survive typos. Candidates
+    are walked best tier first (title before description, exact before prefix), so
+    a lookup stops as soon as the top results are settled instead of scoring every hit.
+
+    A product change drops only the cached queries it can affect: those with a word that
+    is a prefix of one of the product's old or new tokens, those whose trigram fallback
+    matched one of them, and every fallback query when the vocabulary itself changed.
+    """
+
+    def __init__(self):
+        self.title_post: dict[str, set[int]] = {}
+        self.desc_post: dict[str, set[int]] = {}
+        self.docs: dict[int, dict[str, int]] = {}   # pid -> {token: weight}
+        self.vocab: list[str] = []
+        self.grams: dict[str, set[str]] = {}
+        self.cache: dict[str, list[int]] = {}
+        self.cache_forms: dict[str, set[str]] = {}  # query word form -> cached keys using it
+        self.cache_fuzzy: dict[str, set[str]] = {}  # cached key with a trigram fallback -> tokens it matched
+        self.cache_fuzzy_toks: dict[str, set[str]] = {}  # and back: token -> those keys
+
+    def clear(self) -> None:
+        self.title_post.clear()
+        self.desc_post.clear()
+        self.docs.clear()
+        self.vocab.clear()
+        self.grams.clear()
+        self.clear_cache()
+
+    def clear_cache(self) -> None:
+        self.cache.clear()
+        self.cache_forms.clear()
+        self.cache_fuzzy.clear()
+        self.cache_fuzzy_toks.clear()
+
+    def replace(self, other: "SearchIndex") -> None:
+        """Take over the index `other` built in the meantime; the query cache starts empty."""
+        self.title_post, self.desc_post, self.docs = other.title_post, other.desc_post, other.docs
+        self.vocab, self.grams = other.vocab, other.grams
+        self.clear_cache()
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def _known(self, tok: str) -> bool:
+        return tok in self.title_post or tok in self.desc_post
+
+    def add(self, item: dict, _bulk: bool = False) -> None:
+        pid = item["id"]
+        weights = dict.fromkeys(tokenize(item.get("description") or ""), DESC_WEIGHT)
+        weights.update(dict.fromkeys(tokenize(item.get("title") or ""), TITLE_WEIGHT))
+        if self.docs.get(pid) == weights:
+            return
+        if pid in self.docs:
+            self.remove(pid)
+
+        new_tokens = False
+        for tok, w in weights.items():
+            if not self._known(tok):
+                new_tokens = True
+                if _bulk:
+                    self.vocab.append(tok)
+                else:
+                    insort(self.vocab, tok)
+                for g in trigrams(tok):
+                    self.grams.setdefault(g, set()).add(tok)
+            post = self.title_post if w == TITLE_WEIGHT else self.desc_post
+            post.setdefault(tok, set()).add(pid)
+        self.docs[pid] = weights
+        if not _bulk:
+            self._invalidate(weights, new_tokens)
+
+    def rebuild(self, items) -> None:
+        """Full reload: index everything, sort the vocabulary once."""
+        for _ in self.rebuild_steps(items):
+            pass
+
+    def rebuild_steps(self, items, step: int = 500):
+        """rebuild() as a generator that pauses after every `step` items, so a caller can yield to the event loop."""
+        self.clear()
+        for i, item in enumerate(items, 1):
+            self.add(item, _bulk=True)
+            if i % step == 0:
+                yield
+        self.vocab.sort()
+
+    def remove(self, pid: int) -> None:
+        weights = self.docs.pop(pid, None)
+        if weights is None:
+            return
+        gone = False
+        for tok, w in weights.items():
+            post = self.title_post if w == TITLE_WEIGHT else self.desc_post
+            bucket = post.get(tok)
+            if bucket is not None:
+                bucket.discard(pid)
+                if not bucket:
+                    del post[tok]
+            if self._known(tok):
+                continue
+            gone = True
+            i = bisect_left(self.vocab, tok)
+            if i < len(self.vocab) and self.vocab[i] == tok:
+                del self.vocab[i]
+            for g in trigrams(tok):
+                grams = self.grams.get(g)
+                if grams is not None:
+                    grams.discard(tok)
+                    if not grams:
+                        del self.grams[g]
+        self._invalidate(weights, gone)
+
+    def _invalidate(self, tokens, vocab_changed: bool) -> None:
+        """Drop the cached queries that a document with `tokens` can match."""
+        keys = set(self.cache_fuzzy) if vocab_changed else set()
+        for tok in tokens:
+            keys.update(self.cache_fuzzy_toks.get(tok, ()))
+            for n in range(MIN_PREFIX, len(tok) + 1):
+                keys.update(self.cache_forms.get(tok[:n], ()))
+        for key in keys:
+            self._forget(key)
+
+    def _forget(self, key: str) -> None:
+        self.cache.pop(key, None)
+        for tok in self.cache_fuzzy.pop(key, ()):
+            users = self.cache_fuzzy_toks[tok]
+            users.discard(key)
+            if not users:
+                del self.cache_fuzzy_toks[tok]
+        for w in key.split():
+            for f in _forms(w):
+                users = self.cache_forms.get(f)
+                if users is not None:
+                    users.discard(key)
+                    if not users:
+                        del self.cache_forms[f]
+
+    def _remember(self, key: str, result: list[int], fuzzy: set[str] | None) -> None:
+        if len(self.cache) >= QUERY_CACHE_SIZE:
+            self._forget(next(iter(self.cache)))
+        self.cache[key] = result
+        for w in key.split():
+            for f in _forms(w):
+                self.cache_forms.setdefault(f, set()).add(key)
+        if fuzzy is not None:
+            self.cache_fuzzy[key] = fuzzy
+            for tok in fuzzy:
+                self.cache_fuzzy_toks.setdefault(tok, set()).add(key)
+
+    def _prefix_tokens(self, prefix: str) -> list[str]:
+        i = bisect_left(self.vocab, prefix)
+        out = []
+        while i < len(self.vocab) and self.vocab[i].startswith(prefix):
+            out.append(self.vocab[i])
+            i += 1
+        return out
+
+    def _fuzzy_tokens(self, word: str) -> list[str]:
+        q = trigrams(word)
+        shared: dict[str, int] = {}
+        for g in q:
+            for tok in self.grams.get(g, ()):
+                shared[tok] = shared.get(tok, 0) + 1
+        return [tok for tok, n in shared.items()
+                if n / (len(q) + len(tok) + 1 - n) >= FUZZY_MIN_SIMILARITY]
+
+    def _match(self, word: str) -> tuple[set[str], set[str], bool]:
+        """(exact tokens, all matching tokens, whether it fell back to trigrams) for one query word."""
+        forms = _forms(word)
+        toks = set(chain.from_iterable(self._prefix_tokens(f) for f in forms))
+        fuzzy = not toks
+        if fuzzy:
+            toks = set(self._fuzzy_tokens(word))
+        return {t for t in forms if t in toks}, toks, fuzzy
+
+    @staticmethod
+    def _doc_score(doc: dict[str, int], exact: set[str], toks: set[str]) -> int:
+        best = 0
+        for tok, w in doc.items():
+            if tok in toks:
+                s = w * 2 + (1 if tok in exact else 0)
+                if s > best:
+                    best = s
+        return best
+
+    def _tiers(self, exact: set[str], toks: set[str]):
+        loose = toks - exact
+        yield TITLE_WEIGHT * 2 + 1, [self.title_post.get(t, ()) for t in exact]
+        yield TITLE_WEIGHT * 2, [self.title_post.get(t, ()) for t in loose]
+        yield DESC_WEIGHT * 2 + 1, [self.desc_post.get(t, ()) for t in exact]
+        yield DESC_WEIGHT * 2, [self.desc_post.get(t, ()) for t in loose]
+
+    def _estimate(self, toks: set[str]) -> int:
+        return sum(len(self.title_post.get(t, ())) + len(self.desc_post.get(t, ())) for t in toks)
+
+    def search(self, query: str, limit: int = MAX_RESULTS) -> list[int]:
+        key = " ".join(dict.fromkeys(words(query)))
+        if not key:
+            return []
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached[:limit]
+
+        matches = [self._match(w) for w in key.split()]
+        fuzzy = {t for _, toks, f in matches if f for t in toks} if any(f for _, _, f in matches) else None
+        matches = [(exact, toks) for exact, toks, _ in matches]
+        result: list[int] = []
+        if all(toks for _, toks in matches):
+            # the rarest word drives the walk, the others are checked against the candidate's own tokens
+            matches.sort(key=lambda m: self._estimate(m[1]))
+            (d_exact, d_toks), others = matches[0], matches[1:]
+            # best score the other words can still add: a title hit, +1 only if the word is a whole token
+            slack = sum(TITLE_WEIGHT * 2 + (1 if exact else 0) for exact, _ in others)
+
+            top: list[tuple[int, int]] = []  # min-heap of (score, -pid)
+            seen: set[int] = set()
+            for tier_score, buckets in self._tiers(d_exact, d_toks):
+                bound = tier_score + slack
+                if len(top) == MAX_RESULTS and bound <= top[0][0]:
+                    break
+                for pid in chain.from_iterable(buckets):
+                    if pid in seen:
+                        continue
+                    seen.add(pid)
+                    doc = self.docs[pid]
+                    score = tier_score
+                    for exact, toks in others:
+                        s = self._doc_score(doc, exact, toks)
+                        if not s:
+                            break
+                        score += s
+                    else:
+                        entry = (score, -pid)
+                        if len(top) < MAX_RESULTS:
+                            heapq.heappush(top, entry)
+                        elif entry > top[0]:
+                            heapq.heapreplace(top, entry)
+                        if len(top) == MAX_RESULTS and bound <= top[0][0]:
+                            break
+            result = [-npid for _, npid in sorted(top, reverse=True)]
+
+        self._remember(key, result, fuzzy)
+        return result[:limit]
+
+
+SEARCH = SearchIndex()
@@ -1,7 +1,24 @@
-﻿from sqlalchemy import select, delete, exists
+﻿import asyncio
+import itertools
+from bisect import bisect_left
+import logging
+from collections import Counter as Tally
+
+from sqlalchemy import select, delete, exists
+from sqlalchemy.schema import CreateIndex
 from app.db.session import engine, Session
 from app.db.models import Base, Category, Stone, Product
 from app.data import catalog
+from app.data.cart import held, price_changed
+from app.data.search import SEARCH, SearchIndex
+from app.db.stats import backfill_sales_rollups
+from app.metrics import Counter
+from app.tracing import traced
+from app.utils.slug import slugify_ru, normalize_term, term_variants
+
+log = logging.getLogger(__name__)
+
+STOCK_DRIFT = Counter("bot_stock_drift_total", "Cached products whose stock the reconciliation job had to repair.")
 
 async def init_db():
     async with engine.begin() as conn:
@@ -15,6 +32,8 @@ async def init_db():
             await conn.exec_driver_sql("ALTER TABLE products ADD COLUMN IF NOT EXISTS photos JSONB NOT NULL DEFAULT '[]'::jsonb;")
             await conn.exec_driver_sql("UPDATE categories SET name_ru = COALESCE(name_ru, code);")
             await conn.exec_driver_sql("UPDATE stones     SET name_ru = COALESCE(name_ru, code);")
+            await conn.exec_driver_sql("ALTER TABLE orders ALTER COLUMN currency TYPE VARCHAR(3);")
+            await conn.exec_driver_sql("ALTER TABLE orders ADD COLUMN IF NOT EXISTS approved_at TIMESTAMP WITH TIME ZONE;")
         else:
             cols = {r[1] for r in (await conn.exec_driver_sql("PRAGMA table_info(categories)")).fetchall()}
             if "name_ru" not in cols:
@@ -29,88 +48,388 @@ async def init_db():
                 await conn.exec_driver_sql("ALTER TABLE products ADD COLUMN description TEXT;")
             if "photos" not in cols:
                 await conn.exec_driver_sql("ALTER TABLE products ADD COLUMN photos TEXT DEFAULT '[]' NOT NULL;")
+            cols = {r[1] for r in (await conn.exec_driver_sql("PRAGMA table_info(orders)")).fetchall()}
+            if "approved_at" not in cols:
+                await conn.exec_driver_sql("ALTER TABLE orders ADD COLUMN approved_at DATETIME;")
+
+        # create_all() skips indexes of tables that already exist
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                await conn.execute(CreateIndex(index, if_not_exists=True))
 
 
 async def ensure_base_ref_data():
         return
 
 
-async def load_catalog_to_memory():
-    catalog.PRODUCTS.clear()
-    catalog.PRODUCTS_BY_ID.clear()
-    catalog.CAT_LABELS.clear()
-    catalog.STONE_LABELS.clear()
+# item["rev"]: bumped on every change of a cached product (stock included), for open screens and the reconciliation.
+# item["ver"]: bumped only when what a buy button stands for changes - the fields below or being in stock at all -
+# so a button can tell it was drawn for an older state; other shoppers' reservations leave it alone
+_VERSIONS = itertools.count(1)
+_BUTTON_FIELDS = ("title", "price", "description", "photos", "category", "stone")
+# told the id of every product that changes or leaves the cache (see app.live)
+_LISTENER = None
+
+
+def set_product_listener(fn) -> None:
+    global _LISTENER
+    _LISTENER = fn
+
+
+def cache_touch(item: dict, content: bool = True) -> None:
+    item["rev"] = next(_VERSIONS)
+    if content or "ver" not in item:
+        item["ver"] = item["rev"]
+    if _LISTENER is not None:
+        _LISTENER(item["id"])
+
+
+def _button_changed(old: dict, item: dict) -> bool:
+    return (any(old.get(k) != item.get(k) for k in _BUTTON_FIELDS)
+            or (old["stock"] > 0) != (item["stock"] > 0))
+
+
+def _touch_stock(item: dict, was: int) -> None:
+    cache_touch(item, content=(was > 0) != (item["stock"] > 0))
+
+
+# called with every cache change made here, so other worker processes can replay it (see app.shard)
+_PUBLISHER = None
+
+
+def set_catalog_publisher(fn) -> None:
+    global _PUBLISHER
+    _PUBLISHER = fn
+
+
+def _publish(op: str, **fields) -> None:
+    if _PUBLISHER is not None:
+        _PUBLISHER({"op": op, **fields})
+
+
+# cached "stock" is what can still be put into a cart: DB stock minus the units held in carts.
+# _HOLDS returns this process's holds {pid: qty} in one pass over its carts (set by the handlers);
+# REMOTE_HOLDS are the holds of other workers, summed from their published stock deltas
+_HOLDS = None
+REMOTE_HOLDS: Tally = Tally()
+
+
+def set_stock_holds(fn) -> None:
+    global _HOLDS
+    _HOLDS = fn
+
+
+def _holds() -> Tally:
+    holds = Tally(_HOLDS()) if _HOLDS is not None else Tally()
+    holds.update(REMOTE_HOLDS)
+    return holds
+
+
+def db_stock(item: dict) -> int:
+    """DB stock of a cached product: its cached stock plus the units held in carts here and on other workers."""
+    return item["stock"] + held(item["id"]) + REMOTE_HOLDS[item["id"]]
+
+
+# a load that re-indexes more products than this builds a fresh search index in slices, yielding to the
+# loop between them, and swaps it in; fewer are re-indexed in place (~0.1 ms each)
+SEARCH_REBUILD_MIN = 500
+# ids added to / removed from the search index while such a build runs, replayed onto it before the swap
+_SEARCH_DIRTY: set[int] | None = None
+
+
+def _search_add(item: dict) -> None:
+    if _SEARCH_DIRTY is not None:
+        _SEARCH_DIRTY.add(item["id"])
+    SEARCH.add(item)
+
+
+def _search_remove(pid: int) -> None:
+    if _SEARCH_DIRTY is not None:
+        _SEARCH_DIRTY.add(pid)
+    SEARCH.remove(pid)
+
+
+async def _rebuild_search() -> None:
+    global _SEARCH_DIRTY
+    docs = [{"id": it["id"], "title": it["title"], "description": it["description"]}
+            for it in catalog.PRODUCTS_BY_ID.values()]
+    fresh = SearchIndex()
+    _SEARCH_DIRTY = set()
+    try:
+        for _ in fresh.rebuild_steps(docs):
+            await asyncio.sleep(0)
+    finally:
+        dirty, _SEARCH_DIRTY = _SEARCH_DIRTY, None
+    for pid in dirty:
+        item = catalog.PRODUCTS_BY_ID.get(pid)
+        if item is not None:
+            fresh.add(item)
+        else:
+            fresh.remove(pid)
+    SEARCH.replace(fresh)
+
+
+def _text_changed(old: dict, item: dict) -> bool:
+    return old["title"] != item["title"] or old.get("description") != item.get("description")
+
+
+def _filter_keys(category: str, stone: str):
+    return (None, None), (category, None), (None, stone), (category, stone)
+
+
+def _index_ids(pid: int, category: str, stone: str) -> None:
+    for key in _filter_keys(category, stone):
+        ids = catalog.IDS_BY_FILTER.setdefault(key, [])
+        i = bisect_left(ids, pid)
+        if i == len(ids) or ids[i] != pid:
+            ids.insert(i, pid)
 
+
+def _unindex_ids(pid: int, category: str, stone: str) -> None:
+    for key in _filter_keys(category, stone):
+        ids = catalog.IDS_BY_FILTER.get(key)
+        if ids is None:
+            continue
+        i = bisect_left(ids, pid)
+        if i < len(ids) and ids[i] == pid:
+            del ids[i]
+        if not ids:
+            del catalog.IDS_BY_FILTER[key]
+
+
+@traced("cache load_catalog_to_memory")
+async def load_catalog_to_memory(broadcast: bool = True):
+    old_items = catalog.PRODUCTS_BY_ID.copy()
     async with Session() as session:
         cats = (await session.execute(select(Category))).scalars().all()
         stns = (await session.execute(select(Stone))).scalars().all()
         prods = (await session.execute(select(Product))).scalars().all()
 
-        id2cat = {c.id: c.code for c in cats}
-        id2stn = {s.id: s.code for s in stns}
-        for c in cats:
-            catalog.CAT_LABELS[c.code] = c.name_ru or c.code
-        for s in stns:
-            catalog.STONE_LABELS[s.code] = s.name_ru or s.code
-
-        for p in prods:
-            cat_code = id2cat.get(p.category_id)
-            stn_code = id2stn.get(p.stone_id)
-            if not cat_code or not stn_code:
-                continue
-            item = {
-                "id": p.id,
-                "title": p.title,
-                "price": p.price,
-                "stock": p.stock,
-                "description": p.description,
-                "photos": (p.photos or []),
-            }
-            catalog.PRODUCTS.setdefault((cat_code, stn_code), []).append(item)
-            catalog.PRODUCTS_BY_ID[p.id] = item
+    # rebuilt without awaits from here on, so no cart changes between the holds and the stock they are taken from
+    holds = _holds()
+    catalog.PRODUCTS.clear()
+    catalog.PRODUCTS_BY_ID.clear()
+    catalog.PRODUCT_POS.clear()
+    catalog.IDS_BY_FILTER.clear()
+    catalog.CAT_LABELS.clear()
+    catalog.STONE_LABELS.clear()
+    catalog.CATEGORIES.clear()
+    catalog.STONES.clear()
+    catalog.CAT_IDS.clear()
+    catalog.STONE_IDS.clear()
+    catalog.CAT_TERMS.clear()
+    catalog.STONE_TERMS.clear()
 
+    reindex = []
+    id2cat = {c.id: c.code for c in cats}
+    id2stn = {s.id: s.code for s in stns}
+    for c in cats:
+        cache_upsert_category(c.id, c.code, c.name_ru)
+    for s in stns:
+        cache_upsert_stone(s.id, s.code, s.name_ru)
 
-async def init_db_and_load_cache():
+    for p in prods:
+        cat_code = id2cat.get(p.category_id)
+        stn_code = id2stn.get(p.stone_id)
+        if not cat_code or not stn_code:
+            continue
+        item = {
+            "id": p.id,
+            "title": p.title,
+            "price": p.price,
+            "stock": p.stock - holds[p.id],
+            "description": p.description,
+            "photos": (p.photos or []),
+            "category": cat_code,
+            "stone": stn_code,
+        }
+        old = old_items.pop(p.id, None)
+        if old is None or old["price"] != item["price"]:
+            price_changed(p.id)
+        if old is None or _text_changed(old, item):
+            reindex.append(item)
+        # a reload keeps the versions of an unchanged product, so open screens stay valid
+        if old and all(old.get(k) == v for k, v in item.items()):
+            item["ver"], item["rev"] = old["ver"], old["rev"]
+        elif old:
+            item["ver"] = old["ver"]
+            cache_touch(item, content=_button_changed(old, item))
+        else:
+            cache_touch(item)
+        lst = catalog.PRODUCTS.setdefault((cat_code, stn_code), [])
+        catalog.PRODUCT_POS[p.id] = len(lst)
+        lst.append(item)
+        catalog.PRODUCTS_BY_ID[p.id] = item
+        for key in _filter_keys(cat_code, stn_code):
+            catalog.IDS_BY_FILTER.setdefault(key, []).append(p.id)
+    for ids in catalog.IDS_BY_FILTER.values():
+        ids.sort()
+
+    for pid in old_items:
+        # gone from the DB (or from its category / stone)
+        price_changed(pid)
+        if _LISTENER is not None:
+            _LISTENER(pid)
+    # only new, renamed and removed products are re-indexed; a large batch is indexed in slices
+    if _SEARCH_DIRTY is None and len(reindex) + len(old_items) > SEARCH_REBUILD_MIN:
+        await _rebuild_search()
+    else:
+        for pid in old_items:
+            _search_remove(pid)
+        for item in reindex:
+            _search_add(item)
+    if broadcast:
+        _publish("reload")
+
+
+async def prepare_db():
+    """Schema migration and the one-off rollup backfill: DDL and the backfill must not run concurrently,
+    so when sharded the supervisor runs this once before it starts the workers."""
     await init_db()
     await ensure_base_ref_data()
-    await load_catalog_to_memory()
+    await backfill_sales_rollups()
+
+
+async def init_db_and_load_cache():
+    await prepare_db()
+    await load_catalog_to_memory(broadcast=False)
 
 
-def cache_delete_product(product_id: int) -> None:
+def cache_adjust_stock(product_id: int, delta: int, broadcast: bool = True) -> bool:
+    """Reserve (delta < 0) or release cached stock; False if there is not enough to reserve."""
+    p = catalog.PRODUCTS_BY_ID.get(product_id)
+    if not p or p["stock"] + delta < 0:
+        return False
+    p["stock"] += delta
+    _touch_stock(p, p["stock"] - delta)
+    if broadcast:
+        _publish("stock", pid=product_id, delta=delta)
+    return True
+
+
+def cache_delete_product(product_id: int, broadcast: bool = True) -> None:
+    if broadcast:
+        _publish("delete", pid=product_id)
     item = catalog.PRODUCTS_BY_ID.pop(product_id, None)
+    pos = catalog.PRODUCT_POS.pop(product_id, None)
     if not item:
         return
+    _search_remove(product_id)
+    _unindex_ids(product_id, item["category"], item["stone"])
+    price_changed(product_id)
+    if _LISTENER is not None:
+        _LISTENER(product_id)
 
-    for key, items in list(catalog.PRODUCTS.items()):
-        catalog.PRODUCTS[key] = [x for x in items if x["id"] != product_id]
-        if not catalog.PRODUCTS[key]:
-            del catalog.PRODUCTS[key]
+    key = (item["category"], item["stone"])
+    items = catalog.PRODUCTS.get(key, [])
+    del items[pos]
+    # the products after it in its group move up: O(group size), not a rebuild of every group
+    for i in range(pos, len(items)):
+        catalog.PRODUCT_POS[items[i]["id"]] = i
+    if not items:
+        del catalog.PRODUCTS[key]
 
 
 def cache_upsert_product(category: str, stone: str, item: dict) -> None:
+    old = catalog.PRODUCTS_BY_ID.get(item["id"])
+    moved = old is not None and (old.get("category"), old.get("stone")) != (category, stone)
+    if moved:
+        cache_delete_product(item["id"], broadcast=False)
+    item["category"], item["stone"] = category, stone
+    if old is None or old["price"] != item["price"]:
+        price_changed(item["id"])
+    if old is not None:
+        item["ver"] = old["ver"]
+    cache_touch(item, content=old is None or _button_changed(old, item))
     catalog.PRODUCTS_BY_ID[item["id"]] = item
+    # a stock-only refresh (every checkout) leaves the search index and its cached queries alone
+    if old is None or moved or _text_changed(old, item):
+        _search_add(item)
     lst = catalog.PRODUCTS.setdefault((category, stone), [])
-    for i, it in enumerate(lst):
-        if it["id"] == item["id"]:
-            lst[i] = item
-            break
+    pos = catalog.PRODUCT_POS.get(item["id"])
+    if pos is not None:
+        lst[pos] = item
     else:
+        catalog.PRODUCT_POS[item["id"]] = len(lst)
         lst.append(item)
+        _index_ids(item["id"], category, stone)
+
+
+def _index_ref(refs: dict, terms: dict, labels: dict, ids: dict, ref_id: int, code: str, name_ru: str | None) -> None:
+    name_ru = name_ru or code
+    old = refs.get(ref_id)
+    if old and old["code"] != code and ids.get(old["code"]) == ref_id:
+        del ids[old["code"]]
+    refs[ref_id] = {"id": ref_id, "code": code, "name_ru": name_ru}
+    labels[code] = name_ru
+    ids[code] = ref_id
+    for term in term_variants(name_ru) + [code]:
+        terms.setdefault(term, ref_id)
+
 
+def cache_upsert_category(category_id: int, code: str, name_ru: str | None) -> None:
+    _index_ref(catalog.CATEGORIES, catalog.CAT_TERMS, catalog.CAT_LABELS, catalog.CAT_IDS, category_id, code, name_ru)
 
-async def cache_refresh_single(session, product_id: int) -> None:
+
+def cache_upsert_stone(stone_id: int, code: str, name_ru: str | None) -> None:
+    _index_ref(catalog.STONES, catalog.STONE_TERMS, catalog.STONE_LABELS, catalog.STONE_IDS, stone_id, code, name_ru)
+
+
+def _find_ref(refs: dict, terms: dict, term: str) -> dict | None:
+    term = term.strip()
+    if not term:
+        return None
+    ref_id = terms.get(normalize_term(term))
+    if ref_id is None:
+        ref_id = terms.get(slugify_ru(term))
+    return refs.get(ref_id)
+
+
+def cache_find_category(term: str) -> dict | None:
+    return _find_ref(catalog.CATEGORIES, catalog.CAT_TERMS, term)
+
+
+def cache_find_stone(term: str) -> dict | None:
+    return _find_ref(catalog.STONES, catalog.STONE_TERMS, term)
+
+
+def _prune_refs(refs: dict, terms: dict, labels: dict, ids: dict, used_codes: set) -> None:
+    for ref_id, ref in list(refs.items()):
+        if ref["code"] not in used_codes:
+            del refs[ref_id]
+            labels.pop(ref["code"], None)
+            ids.pop(ref["code"], None)
+    for term, ref_id in list(terms.items()):
+        if ref_id not in refs:
+            del terms[term]
+
+
+def cache_prune_refs(broadcast: bool = True) -> None:
+    if broadcast:
+        _publish("prune")
+    _prune_refs(catalog.CATEGORIES, catalog.CAT_TERMS, catalog.CAT_LABELS, catalog.CAT_IDS,
+                {c for c, _ in catalog.PRODUCTS})
+    _prune_refs(catalog.STONES, catalog.STONE_TERMS, catalog.STONE_LABELS, catalog.STONE_IDS,
+                {s for _, s in catalog.PRODUCTS})
+
+
+@traced("cache cache_refresh_single")
+async def cache_refresh_single(session, product_id: int, broadcast: bool = True) -> None:
     from sqlalchemy import select
     from app.db.models import Product, Category, Stone
     row = (await session.execute(
-        select(Product, Category.code, Stone.code)
+        select(Product, Category, Stone)
         .join(Category, Category.id == Product.category_id)
         .join(Stone, Stone.id == Product.stone_id)
         .where(Product.id == product_id)
     )).first()
     if not row:
-        cache_delete_product(product_id)
+        cache_delete_product(product_id, broadcast)
         return
-    p, cat_code, st_code = row
+    p, cat, stn = row
+    cache_upsert_category(cat.id, cat.code, cat.name_ru)
+    cache_upsert_stone(stn.id, stn.code, stn.name_ru)
+    cat_code, st_code = cat.code, stn.code
     item = {
         "id": p.id,
         "title": p.title,
@@ -119,9 +438,77 @@ async def cache_refresh_single(session, product_id: int) -> None:
         "description": p.description,
         "photos": p.photos or [],
     }
+    if broadcast:
+        # the row as this session sees it: other workers must not re-read it before the commit
+        _publish("upsert", category=[cat.id, cat.code, cat.name_ru], stone=[stn.id, stn.code, stn.name_ru],
+                 item=dict(item))
+    item["stock"] -= _holds()[p.id]
     cache_upsert_product(cat_code, st_code, item)
 
 
+async def apply_catalog_event(ev: dict) -> None:
+    """Replay a change published by another worker; nothing is published again."""
+    op = ev["op"]
+    if op == "stock":
+        REMOTE_HOLDS[ev["pid"]] -= ev["delta"]
+        if not REMOTE_HOLDS[ev["pid"]]:
+            del REMOTE_HOLDS[ev["pid"]]
+        p = catalog.PRODUCTS_BY_ID.get(ev["pid"])
+        if p:
+            # applied even below zero, so racing reservations on two workers add up the same everywhere
+            p["stock"] += ev["delta"]
+            _touch_stock(p, p["stock"] - ev["delta"])
+    elif op == "upsert":
+        # the item carries DB stock; the holds are subtracted by each worker
+        item = ev["item"]
+        item["stock"] -= _holds()[item["id"]]
+        cache_upsert_category(*ev["category"])
+        cache_upsert_stone(*ev["stone"])
+        cache_upsert_product(ev["category"][1], ev["stone"][1], item)
+    elif op == "delete":
+        cache_delete_product(ev["pid"], broadcast=False)
+    elif op == "prune":
+        cache_prune_refs(broadcast=False)
+    elif op == "reload":
+        await load_catalog_to_memory(broadcast=False)
+
+
+async def reconcile_stock() -> dict[int, tuple[int, int]]:
+    """Set cached stock back to DB stock minus cart holds; returns {pid: (cached, expected)} of what was repaired.
+
+    The holds are counted in one pass over the carts. A product whose revision changes while the
+    DB is read (a cart or admin change in between) is left to the next run.
+    """
+    seen = {pid: p["rev"] for pid, p in catalog.PRODUCTS_BY_ID.items()}
+    async with Session() as session:
+        rows = (await session.execute(select(Product.id, Product.stock))).all()
+    holds = _holds()
+    drift = {}
+    for pid, db_stock in rows:
+        p = catalog.PRODUCTS_BY_ID.get(pid)
+        if p is None or p["rev"] != seen.get(pid):
+            continue
+        expected = db_stock - holds[pid]
+        if p["stock"] != expected:
+            drift[pid] = (p["stock"], expected)
+            p["stock"] = expected
+            _touch_stock(p, drift[pid][0])
+    if drift:
+        STOCK_DRIFT.inc(amount=len(drift))
+        log.warning("stock drift repaired on %d products: %s", len(drift),
+                    ", ".join(f"#{pid} {was}->{now}" for pid, (was, now) in list(drift.items())[:20]))
+    return drift
+
+
+async def stock_reconcile_loop(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile_stock()
+        except Exception:
+            log.exception("stock reconciliation failed")
+
+
 async def cleanup_orphan_refs():
     async with Session() as session:
         await session.execute(
@@ -137,3 +524,5 @@ async def cleanup_orphan_refs():
         )
 
         await session.commit()
+
+    cache_prune_refs()
@@ -1,7 +1,8 @@
 ﻿from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, ForeignKey, Text, JSON, Enum as SAEnum, BigInteger, DateTime
+from sqlalchemy import Integer, String, ForeignKey, Text, JSON, Enum as SAEnum, BigInteger, DateTime, Date, Index
 from sqlalchemy.sql import func
+import datetime as dt
 import enum
 
 json_type = JSON().with_variant(JSONB, "postgresql")
@@ -17,6 +18,10 @@ class Category(Base):
     name_ru: Mapped[str] = mapped_column(String(128), unique=True, index=True)
     products: Mapped[list["Product"]] = relationship(back_populates="category")
 
+    __table_args__ = (
+        Index("ix_categories_name_ru_lower", func.lower(name_ru)),
+    )
+
 
 class Stone(Base):
     __tablename__ = "stones"
@@ -25,6 +30,10 @@ class Stone(Base):
     name_ru: Mapped[str] = mapped_column(String(128), unique=True, index=True)
     products: Mapped[list["Product"]] = relationship(back_populates="stone")
 
+    __table_args__ = (
+        Index("ix_stones_name_ru_lower", func.lower(name_ru)),
+    )
+
 
 class Product(Base):
     __tablename__ = "products"
@@ -40,6 +49,15 @@ class Product(Base):
     category = relationship("Category", back_populates="products")
     stone    = relationship("Stone",    back_populates="products")
 
+    __table_args__ = (
+        # /list filters, newest first; also back the orphan cleanup in bootstrap
+        Index("ix_products_category_pid", category_id, id),
+        Index("ix_products_stone_pid", stone_id, id),
+        Index("ix_products_category_stone_pid", category_id, stone_id, id),
+        # duplicate check in /add
+        Index("ix_products_category_stone_title_lower", category_id, stone_id, func.lower(title)),
+    )
+
 
 class OrderStatus(str, enum.Enum):
     pending = "pending"
@@ -55,14 +73,23 @@ class Order(Base):
     chat_id = mapped_column(BigInteger, nullable=False)
     full_name = mapped_column(String(255), default="")
     username = mapped_column(String(255), default="")
-    currency = mapped_column(String(2), default="RUB")
+    currency = mapped_column(String(3), default="RUB")
     total_amount = mapped_column(Integer, nullable=False)
     payload = mapped_column(String(128), nullable=False)
     status = mapped_column(SAEnum(OrderStatus), default=OrderStatus.pending, nullable=False)
     created_at = mapped_column(DateTime(timezone=True), server_default=func.now())
+    # set when pre-checkout approved the payment; the sweeper leaves such an order to complete
+    approved_at = mapped_column(DateTime(timezone=True), nullable=True)
 
     items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # an invoice's payload finds its order; unique, so a payment can only ever confirm one
+        Index("ux_orders_payload", payload, unique=True),
+        # the sweeper of unpaid invoices
+        Index("ix_orders_status_created", status, created_at),
+    )
+
 
 class OrderItem(Base):
     __tablename__ = "order_items"
@@ -76,3 +103,25 @@ class OrderItem(Base):
     photos = mapped_column(json_type, default=list, nullable=False)
 
     order = relationship("Order", back_populates="items")
+
+
+class SalesDailyProduct(Base):
+    """Rollup of paid order items per day x product, maintained by on_success_payment."""
+    __tablename__ = "sales_daily_product"
+
+    day: Mapped[dt.date] = mapped_column(Date, primary_key=True)
+    product_id: Mapped[int] = mapped_column(Integer, primary_key=True)  # no FK: products sold out get deleted
+    title: Mapped[str] = mapped_column(String(256), default="")
+    units: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    revenue: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)  # kopecks
+
+
+class SalesDailyRef(Base):
+    """Rollup of paid order items per day x category x stone (0 = unknown)."""
+    __tablename__ = "sales_daily_ref"
+
+    day: Mapped[dt.date] = mapped_column(Date, primary_key=True)
+    category_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    stone_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    units: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    revenue: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
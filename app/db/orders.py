@@ -0,0 +1,95 @@
+﻿import asyncio
+import datetime as dt
+import logging
+import secrets
+
+from sqlalchemy import select, update, or_
+from sqlalchemy.orm import selectinload
+
+from app.db.session import Session
+from app.db.models import Order, OrderItem, OrderStatus
+
+log = logging.getLogger(__name__)
+
+
+async def create_pending_order(user_id: int, chat_id: int, full_name: str, username: str, currency: str,
+                               lines: list[dict]) -> str:
+    """Store the order behind an invoice before the invoice is sent; returns its payload.
+
+    `lines` are OrderItem fields (product_id, title, price in kopecks, qty, photos).
+    """
+    payload = f"{user_id}-{secrets.token_hex(8)}"
+    async with Session() as s:
+        s.add(Order(
+            user_id=user_id,
+            chat_id=chat_id,
+            full_name=full_name,
+            username=username,
+            currency=currency,
+            total_amount=sum(ln["price"] * ln["qty"] for ln in lines),
+            payload=payload,
+            status=OrderStatus.pending,
+            items=[OrderItem(**ln) for ln in lines],
+        ))
+        await s.commit()
+    return payload
+
+
+async def order_status(payload: str) -> OrderStatus | None:
+    async with Session() as s:
+        return (await s.execute(select(Order.status).where(Order.payload == payload))).scalar_one_or_none()
+
+
+async def approve_order(payload: str) -> bool:
+    """Pre-checkout: stamp a pending order as approved, so the sweeper lets its payment complete;
+    False if it is not pending any more."""
+    async with Session() as s:
+        order_id = (await s.execute(
+            update(Order)
+            .where(Order.payload == payload, Order.status == OrderStatus.pending)
+            .values(approved_at=dt.datetime.now(dt.timezone.utc))
+            .returning(Order.id)
+        )).scalar_one_or_none()
+        await s.commit()
+    return order_id is not None
+
+
+async def confirm_order(session, payload: str, **fields) -> Order | None:
+    """Mark an order paid in the caller's transaction; None if it is unknown or already paid (an earlier
+    delivery of the same payment). The WHERE makes a replay a no-op. A cancelled order is accepted too:
+    a payment only follows an approved pre-checkout, so the money was captured whatever the sweeper did."""
+    order_id = (await session.execute(
+        update(Order)
+        .where(Order.payload == payload, Order.status.in_((OrderStatus.pending, OrderStatus.cancelled)))
+        .values(status=OrderStatus.paid, **fields)
+        .returning(Order.id)
+    )).scalar_one_or_none()
+    if order_id is None:
+        return None
+    return await session.get(Order, order_id, options=[selectinload(Order.items)])
+
+
+async def expire_pending_orders(max_age_sec: float) -> int:
+    """Cancel invoices left unpaid for longer than `max_age_sec`; returns how many.
+    One approved at pre-checkout has its payment in flight and gets `max_age_sec` from the approval."""
+    cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=max_age_sec)
+    async with Session() as s:
+        res = await s.execute(
+            update(Order)
+            .where(Order.status == OrderStatus.pending, Order.created_at < cutoff,
+                   or_(Order.approved_at.is_(None), Order.approved_at < cutoff))
+            .values(status=OrderStatus.cancelled)
+        )
+        await s.commit()
+    return res.rowcount
+
+
+async def pending_orders_loop(max_age_sec: float, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            n = await expire_pending_orders(max_age_sec)
+            if n:
+                log.info("cancelled %d unpaid orders", n)
+        except Exception:
+            log.exception("pending order sweep failed")
@@ -1,15 +1,168 @@
-﻿from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+﻿import asyncio
+import datetime as dt
+import time
+from collections import deque
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
 from app.config import settings
+from app.tracing import CURRENT_HANDLER
 
 DB_URL = settings.DATABASE_URL or "sqlite+aiosqlite:///./app.db"
 
-engine = create_async_engine(
-    DB_URL,
-    pool_pre_ping=True,
-    future=True,
-    connect_args={}
-)
+
+def sqlite_pragmas() -> list[str]:
+    return [
+        f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}",
+        f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}",
+        f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}",
+        f"PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}",
+    ]
+
+
+def engine_options(url: str, profile: str) -> dict:
+    backend = make_url(url).get_backend_name()
+    if profile == "tuned" and backend == "postgresql":
+        return {
+            "pool_size": settings.PG_POOL_SIZE,
+            "max_overflow": settings.PG_MAX_OVERFLOW,
+            "pool_recycle": settings.PG_POOL_RECYCLE,
+            "pool_pre_ping": settings.PG_POOL_PRE_PING,
+            "connect_args": {"prepared_statement_cache_size": settings.PG_STATEMENT_CACHE_SIZE},
+        }
+    if profile == "tuned" and backend == "sqlite":
+        # local file, connections never go stale
+        return {"pool_pre_ping": False, "connect_args": {}}
+    return {"pool_pre_ping": True, "connect_args": {}}
+
+
+# newest last; entry "plan" is None while EXPLAIN runs and "" when it was skipped
+SLOW_QUERIES: deque[dict] = deque(maxlen=settings.SLOW_QUERY_BUFFER)
+_LAST_EXPLAIN: dict[str, float] = {}
+_PLAN_TASKS: set[asyncio.Task] = set()  # the loop holds tasks only weakly
+
+
+def param_shape(parameters, executemany: bool):
+    """Types of the bound parameters, never their values."""
+    if executemany:
+        rows = list(parameters or [])
+        return {"rows": len(rows), "first": param_shape(rows[0], False) if rows else None}
+    if isinstance(parameters, dict):
+        return {k: type(v).__name__ for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(v).__name__ for v in parameters]
+    return type(parameters).__name__
+
+
+def _caller() -> str:
+    handler = CURRENT_HANDLER.get()
+    if handler:
+        return handler
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return f"task {task.get_name()}" if task else "?"
+
+
+def _explain_sql(eng: AsyncEngine, statement: str) -> str | None:
+    head = statement.lstrip()[:10].upper()
+    if head.startswith(("EXPLAIN", "PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "CREATE", "ALTER")):
+        return None
+    if eng.dialect.name == "sqlite":
+        return "EXPLAIN QUERY PLAN " + statement
+    if eng.dialect.name == "postgresql":
+        analyze = settings.SLOW_QUERY_EXPLAIN_ANALYZE and head.startswith(("SELECT", "WITH"))
+        return ("EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN ") + statement
+    return None
+
+
+async def _capture_plan(eng: AsyncEngine, entry: dict, sql: str, parameters) -> None:
+    try:
+        # own connection and transaction, always rolled back
+        async with eng.connect() as conn:
+            conn = await conn.execution_options(slow_query_log=False)
+            rows = (await conn.exec_driver_sql(sql, parameters)).fetchall()
+            await conn.rollback()
+        entry["plan"] = "\n".join(" | ".join(str(c) for c in r) for r in rows)
+    except Exception as e:
+        entry["plan"] = f"EXPLAIN failed: {type(e).__name__}: {e}"
+
+
+def watch_slow_queries(eng: AsyncEngine) -> None:
+    """Statements slower than SLOW_QUERY_MS go to SLOW_QUERIES; their plan is fetched in a background task."""
+    threshold = settings.SLOW_QUERY_MS / 1000
+    sync_engine = eng.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_t0", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stack = conn.info.get("slow_t0")
+        if not stack:
+            return
+        elapsed = time.perf_counter() - stack.pop()
+        if elapsed < threshold or not conn.get_execution_options().get("slow_query_log", True):
+            return
+        entry = {
+            "at": dt.datetime.now(dt.timezone.utc),
+            "ms": round(elapsed * 1000, 1),
+            "statement": statement[:4000],
+            "params": param_shape(parameters, executemany),
+            "handler": _caller(),
+            "plan": None,
+        }
+        SLOW_QUERIES.append(entry)
+
+        sql = _explain_sql(eng, statement)
+        now = time.monotonic()
+        if sql is None or now - _LAST_EXPLAIN.get(statement, -1e9) < settings.SLOW_QUERY_EXPLAIN_EVERY_SEC:
+            entry["plan"] = ""
+            return
+        if len(_LAST_EXPLAIN) > 1000:
+            _LAST_EXPLAIN.clear()
+        _LAST_EXPLAIN[statement] = now
+        params = parameters[0] if executemany and parameters else parameters
+        try:
+            t = asyncio.get_running_loop().create_task(_capture_plan(eng, entry, sql, params))
+        except RuntimeError:  # no loop: sync use of the engine
+            entry["plan"] = ""
+        else:
+            _PLAN_TASKS.add(t)
+            t.add_done_callback(_PLAN_TASKS.discard)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(ctx):
+        stack = ctx.connection.info.get("slow_t0") if ctx.connection is not None else None
+        if stack:
+            stack.pop()
+
+
+def make_engine(url: str = DB_URL, profile: str | None = None) -> AsyncEngine:
+    profile = profile or settings.DB_ENGINE_PROFILE
+    eng = create_async_engine(url, future=True, **engine_options(url, profile))
+
+    if profile == "tuned" and eng.dialect.name == "sqlite":
+        pragmas = sqlite_pragmas()
+
+        @event.listens_for(eng.sync_engine, "connect")
+        def _apply_pragmas(dbapi_conn, _record):
+            cur = dbapi_conn.cursor()
+            for pragma in pragmas:
+                cur.execute(pragma)
+            cur.close()
+
+    if settings.SLOW_QUERY_MS:
+        watch_slow_queries(eng)
+    return eng
+
+
+engine = make_engine()
 
 Session: async_sessionmaker[AsyncSession] = async_sessionmaker(
     engine, expire_on_commit=False
-)
\ No newline at end of file
+)
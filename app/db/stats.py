@@ -0,0 +1,142 @@
+﻿import datetime as dt
+
+from sqlalchemy import select, func, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.db.session import Session
+from app.db.models import Category, Stone, Product, Order, OrderItem, OrderStatus, SalesDailyProduct, SalesDailyRef
+
+PERIOD_DAYS = {"day": 1, "week": 7, "month": 30}
+TOP_N = 10
+BACKFILL_LOCK_ID = 0x5A1E5  # pg advisory lock key of backfill_sales_rollups
+
+
+def today() -> dt.date:
+    return dt.datetime.now(dt.timezone.utc).date()
+
+
+# rollup days are UTC days of Order.created_at, for both the live path and the backfill
+def utc_day(ts: dt.datetime) -> dt.date:
+    """UTC day of a loaded timestamp; SQLite hands it back naive, already in UTC."""
+    return (ts.astimezone(dt.timezone.utc) if ts.tzinfo else ts).date()
+
+
+def _utc_day_sql(col, dialect: str):
+    if dialect == "postgresql":
+        # date() of a timestamptz would use the session time zone
+        return func.date(func.timezone("UTC", col))
+    # SQLite stores UTC text; date() also folds a "+hh:mm" suffix into UTC
+    return func.date(col)
+
+
+async def _add_to_rollup(session, model, keys: dict, units: int, revenue: int, **latest) -> None:
+    insert_ = pg_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+    stmt = insert_(model).values(**keys, units=units, revenue=revenue, **latest)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={
+            "units": model.units + stmt.excluded.units,
+            "revenue": model.revenue + stmt.excluded.revenue,
+            **{k: stmt.excluded[k] for k in latest},
+        },
+    )
+    await session.execute(stmt)
+
+
+async def record_sale(session, product: Product, qty: int, price_kop: int, day: dt.date | None = None) -> None:
+    """Add one paid order line to the rollups; runs inside the caller's order transaction.
+    Pass the order's `utc_day(created_at)` as `day`, the day the backfill files it under."""
+    if qty <= 0:
+        return
+    day = day or today()
+    revenue = price_kop * qty
+    await _add_to_rollup(session, SalesDailyProduct, {"day": day, "product_id": product.id},
+                         qty, revenue, title=product.title)
+    await _add_to_rollup(session, SalesDailyRef,
+                         {"day": day, "category_id": product.category_id, "stone_id": product.stone_id},
+                         qty, revenue)
+
+
+async def backfill_sales_rollups(force: bool = False) -> bool:
+    """One-off rebuild of the rollups from paid orders; by default only when they are still empty."""
+    async with Session() as s:
+        dialect = s.bind.dialect.name
+        if dialect == "postgresql":
+            # another process backfilling at the same time waits here, then finds the rollups filled
+            await s.execute(select(func.pg_advisory_xact_lock(BACKFILL_LOCK_ID)))
+        if not force and (await s.execute(select(SalesDailyProduct.day).limit(1))).first():
+            return False
+
+        day = _utc_day_sql(Order.created_at, dialect)
+        paid = (
+            select(OrderItem)
+            .join(Order, Order.id == OrderItem.order_id)
+            .outerjoin(Product, Product.id == OrderItem.product_id)
+            .where(Order.status == OrderStatus.paid, OrderItem.qty > 0)
+        )
+        units = func.sum(OrderItem.qty)
+        revenue = func.sum(OrderItem.price * OrderItem.qty)
+
+        await s.execute(SalesDailyProduct.__table__.delete())
+        await s.execute(SalesDailyRef.__table__.delete())
+        await s.execute(insert(SalesDailyProduct).from_select(
+            ["day", "product_id", "title", "units", "revenue"],
+            paid.with_only_columns(day, OrderItem.product_id, func.max(OrderItem.title), units, revenue)
+            .group_by(day, OrderItem.product_id),
+        ))
+        cat_id = func.coalesce(Product.category_id, 0)
+        stone_id = func.coalesce(Product.stone_id, 0)
+        await s.execute(insert(SalesDailyRef).from_select(
+            ["day", "category_id", "stone_id", "units", "revenue"],
+            paid.with_only_columns(day, cat_id, stone_id, units, revenue)
+            .group_by(day, cat_id, stone_id),
+        ))
+        await s.commit()
+    return True
+
+
+async def sales_report(days: int) -> dict:
+    """Totals and top lists for the last `days` days; reads only the rollups."""
+    since = today() - dt.timedelta(days=days - 1)
+    async with Session() as s:
+        units, revenue = (await s.execute(
+            select(func.coalesce(func.sum(SalesDailyRef.units), 0), func.coalesce(func.sum(SalesDailyRef.revenue), 0))
+            .where(SalesDailyRef.day >= since)
+        )).one()
+
+        top_products = (await s.execute(
+            select(SalesDailyProduct.product_id, func.max(SalesDailyProduct.title),
+                   func.sum(SalesDailyProduct.units), func.sum(SalesDailyProduct.revenue).label("rev"))
+            .where(SalesDailyProduct.day >= since)
+            .group_by(SalesDailyProduct.product_id)
+            .order_by(func.sum(SalesDailyProduct.revenue).desc())
+            .limit(TOP_N)
+        )).all()
+
+        top_categories = (await s.execute(
+            select(func.coalesce(Category.name_ru, "—"), func.sum(SalesDailyRef.units), func.sum(SalesDailyRef.revenue))
+            .outerjoin(Category, Category.id == SalesDailyRef.category_id)
+            .where(SalesDailyRef.day >= since)
+            .group_by(SalesDailyRef.category_id, Category.name_ru)
+            .order_by(func.sum(SalesDailyRef.revenue).desc())
+            .limit(TOP_N)
+        )).all()
+
+        top_stones = (await s.execute(
+            select(func.coalesce(Stone.name_ru, "—"), func.sum(SalesDailyRef.units), func.sum(SalesDailyRef.revenue))
+            .outerjoin(Stone, Stone.id == SalesDailyRef.stone_id)
+            .where(SalesDailyRef.day >= since)
+            .group_by(SalesDailyRef.stone_id, Stone.name_ru)
+            .order_by(func.sum(SalesDailyRef.revenue).desc())
+            .limit(TOP_N)
+        )).all()
+
+    return {
+        "since": since,
+        "units": int(units),
+        "revenue": int(revenue),
+        "top_products": [(pid, title, int(u), int(r)) for pid, title, u, r in top_products],
+        "top_categories": [(name, int(u), int(r)) for name, u, r in top_categories],
+        "top_stones": [(name, int(u), int(r)) for name, u, r in top_stones],
+    }
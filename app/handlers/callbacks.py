@@ -1,21 +1,43 @@
 ﻿import re
 import asyncio, shlex
+from bisect import bisect_left, bisect_right
+import html
 import time
 
 from aiogram import F, Router, Bot
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, PreCheckoutQuery, Message, InputMediaPhoto
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent, BufferedInputFile
 from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 
 from app.data import catalog
-from app.data.catalog import PRODUCTS, PRODUCTS_BY_ID, CAT_LABELS, STONE_LABELS
+from app.data.catalog import PRODUCTS, PRODUCTS_BY_ID, PRODUCT_POS, CAT_LABELS, STONE_LABELS
+from app.data.search import SEARCH
+from app.data.cart import Cart
 from aiogram.filters import Command, CommandObject, BaseFilter
-from app.db.bootstrap import cache_delete_product, cache_refresh_single, load_catalog_to_memory, cleanup_orphan_refs
+from app.db.bootstrap import (
+    cache_delete_product, cache_refresh_single, load_catalog_to_memory, cleanup_orphan_refs,
+    cache_find_category, cache_find_stone, cache_adjust_stock, set_stock_holds, set_product_listener, db_stock,
+)
 from decimal import Decimal
-from sqlalchemy import select, func, delete, or_
-from app.db.session import Session
-from app.db.models import Category, Stone, Product, Order, OrderItem, OrderStatus
+from sqlalchemy import select, func, delete
+from app.db.session import Session, SLOW_QUERIES
+from app.db.models import Category, Stone, Product, Order, OrderStatus
+from app.db.stats import record_sale, sales_report, utc_day, PERIOD_DAYS
+from app.db.orders import create_pending_order, approve_order, confirm_order, order_status
+from app.profiling import (
+    profile_cpu, profile_stacks, profiler_busy, PROFILE_MAX_SECONDS,
+    track_memory, memory_report, rss_bytes, tracemalloc_diff, MEM_DIFF_MAX_SECONDS,
+)
 from app.utils.slug import slugify_ru
+from app.utils.bounded import BoundedDict
+from app.warmup import CatalogGate, LOADING_TEXT, wait_catalog
+from app.live import watch, unwatch, product_changed, WATCHING, VIEWERS
+from app.handlers.cbdata import (
+    CallbackTable, Noop, Welcome, Contacts, Catalog1, Catalog2, ProductOpen, ProductNav, ProductAdd, ProductGoto,
+    PhotoNav, CartOpen, CartItem, CartPhoto, CartPhotoNav, Delivery, DeliveryForm, PaymentStart, PaymentMock,
+    AdminListPage,
+)
 from contextlib import suppress
 from typing import Dict, List
 from app.config import settings
@@ -28,12 +50,45 @@ DELETE_PRODUCT_WHEN_STOCK_ZERO = True
 load_dotenv()
 router = Router()
 
-USER_CTX = {}
-CART = {}
+# every callback query goes through one handler and a dict lookup on "namespace|action"
+callbacks = CallbackTable(stale_text="Кнопка устарела. Откройте меню заново.")
+
+
+@router.callback_query()
+async def on_callback(cb: CallbackQuery):
+    # any click but a no-op button leaves the product screen; rendering a product watches it again
+    if cb.data != Noop.__prefix__:
+        unwatch(cb.from_user.id)
+    return await callbacks.dispatch(cb)
+
+
+set_product_listener(product_changed)
+
+# screens that don't read the catalog work while it is still loading at startup
+STATIC_CALLBACKS = {Noop.__prefix__, Welcome.__prefix__, Contacts.__prefix__}
+catalog_gate = CatalogGate(
+    lambda event: isinstance(event, CallbackQuery) and (event.data or "").partition("|")[0] in STATIC_CALLBACKS
+)
+router.callback_query.middleware(catalog_gate)
+router.message.middleware(catalog_gate)
+router.inline_query.middleware(catalog_gate)
+
+USER_CTX = BoundedDict("USER_CTX", settings.USER_STATE_MAX_USERS, settings.USER_STATE_TTL_SEC)
+CART: dict[int, Cart] = {}
 CART_TTL_SEC = 60 * 60 * 12
-CART_META: dict[int, float] = {}
-DELIVERY_CTX = {}
-INPUT_MODE = {}
+
+
+def drop_cart_state(user_id: int, _ts: float) -> None:
+    """CART_META eviction: the cart's units go back on sale and the user's checkout/product context goes too."""
+    clear_cart(user_id, restore_stock=True)
+    DELIVERY_CTX.pop(user_id, None)
+    USER_CTX.pop(user_id, None)
+
+
+# user id -> last cart change; a cart lives as long as its entry here, expiry or eviction drops it via drop_cart_state
+CART_META = BoundedDict("CART_META", settings.USER_STATE_MAX_USERS, CART_TTL_SEC, on_evict=drop_cart_state)
+DELIVERY_CTX = BoundedDict("DELIVERY_CTX", settings.USER_STATE_MAX_USERS, settings.USER_STATE_TTL_SEC)
+INPUT_MODE = BoundedDict("INPUT_MODE", settings.USER_STATE_MAX_USERS, settings.USER_STATE_TTL_SEC)
 
 album_buffers: Dict[str, dict] = {}
 ALBUM_SETTLE_SEC = 0.9
@@ -54,15 +109,19 @@ def is_email(s: str) -> bool:
 
 
 async def safe_edit(message, text, reply_markup=None):
+    """Edit `message`, or send the text anew when it can't be edited; returns the message that shows it."""
     try:
         await message.edit_text(text, reply_markup=reply_markup)
+        return message
     except TelegramBadRequest as e:
         s = str(e)
         if "message is not modified" in s:
-            return
+            return message
+        new = None
         with suppress(Exception):
             new = await message.answer(text, reply_markup=reply_markup)
             await message.delete()
+        return new
 
 
 def uc_first(s: str) -> str:
@@ -74,16 +133,7 @@ def touch_cart(user_id: int) -> None:
 
 
 def purge_expired_carts() -> None:
-    now = time.time()
-    stale = [uid for uid, ts in CART_META.items() if now - ts > CART_TTL_SEC]
-    for uid in stale:
-        for pid, qty in (CART.get(uid, {}) or {}).items():
-            inc_stock(pid, qty)
-
-        CART.pop(uid, None)
-        DELIVERY_CTX.pop(uid, None)
-        USER_CTX.pop(uid, None)
-        CART_META.pop(uid, None)
+    CART_META.expire()
 
 
 class WaitsInput(BaseFilter):
@@ -95,6 +145,16 @@ def ru_labels(category_code: str, stone_code: str) -> tuple[str, str]:
     return uc_first(CAT_LABELS.get(category_code, category_code)), uc_first(STONE_LABELS.get(stone_code, stone_code))
 
 
+def group_ids(category: str, stone: str) -> tuple[int, int]:
+    """Ids of a (category, stone) group for callback data; 0 for a code that is not cached."""
+    return catalog.CAT_IDS.get(category, 0), catalog.STONE_IDS.get(stone, 0)
+
+
+def group_key(cat_id: int, stone_id: int) -> tuple[str, str] | None:
+    cat, st = catalog.CATEGORIES.get(cat_id), catalog.STONES.get(stone_id)
+    return (cat["code"], st["code"]) if cat and st else None
+
+
 async def get_or_create_category(session: Session, name_ru: str) -> Category:
     name_ru = name_ru.strip()
     code = slugify_ru(name_ru)
@@ -123,40 +183,6 @@ async def get_or_create_stone(session: Session, name_ru: str) -> Stone:
     return row
 
 
-async def find_category_by_term(session: Session, term: str) -> Category | None:
-    term = term.strip()
-    if not term:
-        return None
-    code = slugify_ru(term)
-    return (
-        await session.execute(
-            select(Category).where(
-                or_(
-                    func.lower(Category.name_ru) == func.lower(term),
-                    Category.code == code,
-                )
-            )
-        )
-    ).scalar_one_or_none()
-
-
-async def find_stone_by_term(session: Session, term: str) -> Stone | None:
-    term = term.strip()
-    if not term:
-        return None
-    code = slugify_ru(term)
-    return (
-        await session.execute(
-            select(Stone).where(
-                or_(
-                    func.lower(Stone.name_ru) == func.lower(term),
-                    Stone.code == code,
-                )
-            )
-        )
-    ).scalar_one_or_none()
-
-
 async def add_product_from_args(m: Message, args: str, photos: List[str] | None):
     if not is_admin(m.from_user.id):
         return
@@ -217,40 +243,65 @@ async def add_product_from_args(m: Message, args: str, photos: List[str] | None)
 
 def delivery_back_only_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Назад в корзину", callback_data="cart|open|")]
+        [InlineKeyboardButton(text="⬅️ Назад в корзину", callback_data=CartOpen().pack())]
     ])
 
 
 def keyboard_welcome():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Выбор ассортиментов", callback_data="catalog1|open|")],
-        [InlineKeyboardButton(text="Связь с менеджером", callback_data="contacts|open|")]
+        [InlineKeyboardButton(text="Выбор ассортиментов", callback_data=Catalog1().pack())],
+        [InlineKeyboardButton(text="Связь с менеджером", callback_data=Contacts().pack())]
     ])
 
 
+def cart_holds() -> dict[int, int]:
+    """Units held in all carts, by product id."""
+    holds: dict[int, int] = {}
+    for cart in CART.values():
+        for pid, qty in cart.items():
+            holds[pid] = holds.get(pid, 0) + qty
+    return holds
+
+
+set_stock_holds(cart_holds)
+
+
+def user_cart(user_id: int) -> Cart:
+    cart = CART.get(user_id)
+    if cart is None:
+        cart = CART[user_id] = Cart()
+    touch_cart(user_id)
+    return cart
+
+
 def cart_count(user_id: int) -> int:
-    return sum(CART.get(user_id, {}).values())
+    cart = CART.get(user_id)
+    return cart.count if cart else 0
 
 def clear_cart(user_id: int, restore_stock: bool = False):
-    items = CART.get(user_id, {})
+    cart = CART.pop(user_id, None)
+    items = cart.clear() if cart is not None else {}
     if restore_stock:
         for pid, qty, in items.items():
             inc_stock(pid, qty)
-    CART[user_id] = {}
+
+
+STALE_PRODUCT_TEXT = "Цена или наличие товара изменились. Проверьте и нажмите ещё раз."
+PRODUCT_GONE_TEXT = "Этого товара больше нет."
+
+
+def product_gone_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ В каталог", callback_data=Catalog1().pack())]
+    ])
 
 
 def dec_stock(pid: int, n: int = 1) -> bool:
-    p = PRODUCTS_BY_ID.get(pid)
-    if not p or p["stock"] < n:
-        return False
-    p["stock"] -= n
-    return True
+    return cache_adjust_stock(pid, -n)
 
 
 def inc_stock(pid: int, n: int = 1) -> None:
-    p = PRODUCTS_BY_ID.get(pid)
-    if p:
-        p["stock"] += n
+    cache_adjust_stock(pid, n)
 
 
 def render_product_text(p: dict, pos: int, total: int, category: str, stone: str) -> str:
@@ -265,7 +316,7 @@ def render_product_text(p: dict, pos: int, total: int, category: str, stone: str
     if desc:
         lines += ["", "<b>Описание:</b>", desc]
 
-    lines += ["", f"В наличии: {p['stock']} шт", "", f"Товар {pos+1} из {total}"]
+    lines += ["", f"В наличии: {max(0, p['stock'])} шт", "", f"Товар {pos+1} из {total}"]
     return "\n".join(lines)
 
 
@@ -280,82 +331,92 @@ def product_keyboard(
     in_stock = PRODUCTS_BY_ID[product_id]["stock"] > 0
 
     row_nav = [
-        InlineKeyboardButton(text="⬅️", callback_data="product|nav|prev") if not left_disabled
-        else InlineKeyboardButton(text="🚫", callback_data="noop"),
+        InlineKeyboardButton(text="⬅️", callback_data=ProductNav(direction="prev", pid=product_id).pack()) if not left_disabled
+        else InlineKeyboardButton(text="🚫", callback_data=Noop().pack()),
         InlineKeyboardButton(
             text=("Приобрести" if in_stock else "Нет в наличии"),
-            callback_data=(f"product|add|{product_id}" if in_stock else "noop")
+            callback_data=(ProductAdd(pid=product_id, ver=PRODUCTS_BY_ID[product_id]["ver"]).pack()
+                           if in_stock else Noop().pack())
         ),
-        InlineKeyboardButton(text="➡️", callback_data="product|nav|next") if not right_disabled
-        else InlineKeyboardButton(text="🚫", callback_data="noop"),
+        InlineKeyboardButton(text="➡️", callback_data=ProductNav(direction="next", pid=product_id).pack()) if not right_disabled
+        else InlineKeyboardButton(text="🚫", callback_data=Noop().pack()),
     ]
-    row_cart = [InlineKeyboardButton(text=f"🧺 Корзина ({cart_count(user_id)})", callback_data="cart|open|")]
-    row_back = [InlineKeyboardButton(text="⬅️ Назад к камням", callback_data=f"catalog2|open|{category}")]
+    row_cart = [InlineKeyboardButton(text=f"🧺 Корзина ({cart_count(user_id)})", callback_data=CartOpen().pack())]
+    row_back = [InlineKeyboardButton(text="⬅️ Назад к камням",
+                                     callback_data=Catalog2(cat=catalog.CAT_IDS.get(category, 0)).pack())]
 
     rows = []
 
     photos = (PRODUCTS_BY_ID.get(product_id, {}).get("photos") or [])
     if len(photos) > 1:
         rows.append([
-            InlineKeyboardButton(text="◀️", callback_data=f"pimg|prev|{category}:{stone}:{pos}:{img_idx}"),
-            InlineKeyboardButton(text=f"{(img_idx % len(photos)) + 1}/{len(photos)}", callback_data="noop"),
-            InlineKeyboardButton(text="▶️", callback_data=f"pimg|next|{category}:{stone}:{pos}:{img_idx}"),
+            InlineKeyboardButton(text="◀️", callback_data=PhotoNav(action="prev", pid=product_id, img=img_idx).pack()),
+            InlineKeyboardButton(text=f"{(img_idx % len(photos)) + 1}/{len(photos)}", callback_data=Noop().pack()),
+            InlineKeyboardButton(text="▶️", callback_data=PhotoNav(action="next", pid=product_id, img=img_idx).pack()),
         ])
 
     rows += [row_nav, row_cart, row_back]
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-async def render_product_screen(cb: CallbackQuery, category: str, stone: str, idx: int):
-    key = (category, stone)
-    products = PRODUCTS.get(key, [])
-    if not products:
-        await safe_edit(cb.message,
-            "Пока нет товаров для выбранной комбинации",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Назад к камням", callback_data=f"catalog2|open|{category}")]
-            ])
-        )
-        return
+async def render_group_empty(cb: CallbackQuery, category: str):
+    await safe_edit(cb.message,
+        "Пока нет товаров для выбранной комбинации",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Назад к камням", callback_data=Catalog2(cat=catalog.CAT_IDS.get(category, 0)).pack())]
+        ])
+    )
 
-    idx = max(0, min(idx, len(products) - 1))
-    prev = USER_CTX.get(cb.from_user.id) or {}
-    img_idx = prev.get("img_idx", 0) if prev.get("key") == key and prev.get("idx") == idx else 0
 
-    USER_CTX[cb.from_user.id] = {"key": key, "idx": idx, "img_idx": img_idx}
-    p = products[idx]
+async def render_product_screen(cb: CallbackQuery, pid: int, img_idx: int | None = None):
+    """Product card of `pid`; its position and neighbours come from PRODUCT_POS, so this is O(1)."""
+    p = PRODUCTS_BY_ID.get(pid)
+    pos = PRODUCT_POS.get(pid)
+    if p is None or pos is None:
+        # deleted here or by another worker since the button was drawn
+        if cb.message.content_type == "photo":
+            with suppress(TelegramBadRequest):
+                await cb.message.edit_caption(caption=PRODUCT_GONE_TEXT, reply_markup=product_gone_keyboard())
+        else:
+            await safe_edit(cb.message, PRODUCT_GONE_TEXT, product_gone_keyboard())
+        return
+    key = (p["category"], p["stone"])
+    if img_idx is None:
+        prev = USER_CTX.get(cb.from_user.id) or {}
+        img_idx = prev.get("img_idx", 0) if prev.get("pid") == pid else 0
 
-    await show_product(cb, p, idx, len(products), category, stone, img_idx=img_idx)
+    USER_CTX[cb.from_user.id] = {"key": key, "pid": pid, "idx": pos, "img_idx": img_idx}
+    await show_product(cb, p, pos, len(PRODUCTS[key]), *key, img_idx=img_idx)
 
 
-@router.callback_query(F.data == "noop")
-async def cb_noop(cb: CallbackQuery):
+@callbacks.on(Noop)
+async def cb_noop(cb: CallbackQuery, data: Noop):
     return await cb.answer()
 
 
-@router.callback_query(F.data == "welcome|open|")
-async def cb_welcome(cb: CallbackQuery):
+@callbacks.on(Welcome)
+async def cb_welcome(cb: CallbackQuery, data: Welcome):
     await safe_edit(cb.message, "👋 Добро пожаловать! Это черновик приветствия.\n\nВыберите действие ниже.",
                                reply_markup=keyboard_welcome())
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("contacts|"))
-async def cb_contacts(cb: CallbackQuery):
+@callbacks.on(Contacts)
+async def cb_contacts(cb: CallbackQuery, data: Contacts):
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="welcome|open|")]
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=Welcome().pack())]
     ])
     await safe_edit(cb.message, "📲 Связь с менеджером:\nUsername with @\nПричины: обмен, кастом и т.д.",
                                reply_markup=kb)
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("catalog1|"))
-async def cb_catalog1(cb: CallbackQuery):
+@callbacks.on(Catalog1)
+async def cb_catalog1(cb: CallbackQuery, data: Catalog1):
     codes = sorted({cat for (cat, _stone) in PRODUCTS.keys()})
     if not codes:
         kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⬅️ Назад", callback_data="welcome|open|")]
+                    [InlineKeyboardButton(text="⬅️ Назад", callback_data=Welcome().pack())]
                 ])
         await safe_edit(cb.message, "Пока нет категорий.", reply_markup=kb)
         return await cb.answer()
@@ -367,24 +428,27 @@ async def cb_catalog1(cb: CallbackQuery):
 
     labels = {code: name_ru for code, name_ru in rows}
     rows_kb = [[InlineKeyboardButton(text=uc_first(labels.get(code, CAT_LABELS.get(code, code))),
-                                     callback_data=f"catalog2|open|{code}")]
+                                     callback_data=Catalog2(cat=catalog.CAT_IDS.get(code, 0)).pack())]
                for code in codes]
-    rows_kb.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="welcome|open|")])
+    rows_kb.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=Welcome().pack())])
     await safe_edit(cb.message, "Выберите ассортимент:",
                     InlineKeyboardMarkup(inline_keyboard=rows_kb))
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("catalog2|open|"))
-async def cb_catalog2(cb: CallbackQuery):
-    category = cb.data.split("|", 2)[-1]
+@callbacks.on(Catalog2)
+async def cb_catalog2(cb: CallbackQuery, data: Catalog2):
+    ref = catalog.CATEGORIES.get(data.cat)
+    if not ref:
+        return await cb.answer(callbacks.stale_text, show_alert=True)
+    category = ref["code"]
     stones = sorted({stone for (cat, stone) in PRODUCTS.keys() if cat == category})
 
     if not stones:
         await safe_edit(cb.message,
                         f"Для категории «{category}» пока нет камней.",
                         InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text="⬅️ Назад", callback_data="catalog1|open|")]
+                            [InlineKeyboardButton(text="⬅️ Назад", callback_data=Catalog1().pack())]
                         ]))
         return await cb.answer()
 
@@ -395,17 +459,16 @@ async def cb_catalog2(cb: CallbackQuery):
 
     labels = {code: name_ru for code, name_ru in rows}
     rows_kb = [[InlineKeyboardButton(text=uc_first(labels.get(st, STONE_LABELS.get(st, st))),
-                                     callback_data=f"product|open|{category}:{st}")]
+                                     callback_data=ProductOpen(cat=data.cat, stone=catalog.STONE_IDS.get(st, 0)).pack())]
                for st in stones]
-    rows_kb.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="catalog1|open|")])
+    rows_kb.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=Catalog1().pack())])
     await safe_edit(cb.message,"Выберите камень для категории:", InlineKeyboardMarkup(inline_keyboard=rows_kb))
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("product|open|"))
-async def cb_product_open(cb: CallbackQuery):
-    payload = cb.data.split("|", 2)[-1]
-    if ":" not in payload:
+@callbacks.on(ProductOpen)
+async def cb_product_open(cb: CallbackQuery, data: ProductOpen):
+    if not data.cat:
         if PRODUCTS:
             category, stone = next(iter(PRODUCTS.keys()))
         else:
@@ -413,115 +476,163 @@ async def cb_product_open(cb: CallbackQuery):
                 cb.message,
                 "Каталог пуст.",
                 InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⬅️ Назад", callback_data="catalog1|open|")]
+                    [InlineKeyboardButton(text="⬅️ Назад", callback_data=Catalog1().pack())]
                 ])
             )
             return await cb.answer()
     else:
-        category, stone = payload.split(":", 1)
+        key = group_key(data.cat, data.stone)
+        if key is None:
+            return await cb.answer(callbacks.stale_text, show_alert=True)
+        category, stone = key
 
-    await render_product_screen(cb, category, stone, idx=0)
-    return await cb.answer()
-
-@router.callback_query(F.data == "product|nav|next")
-async def cb_product_next(cb: CallbackQuery):
-    ctx = USER_CTX.get(cb.from_user.id)
-    if not ctx:
-        await safe_edit(
-            cb.message,
-            "Выберите ассортимент:",
-            InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Открыть каталог", callback_data="catalog1|open|")]
-            ])
-        )
-        return await cb.answer()
-
-    category, stone = ctx["key"]
-    await render_product_screen(cb, category, stone, ctx.get("idx", 0) + 1)
+    products = PRODUCTS.get((category, stone))
+    if not products:
+        await render_group_empty(cb, category)
+    else:
+        await render_product_screen(cb, products[0]["id"])
     return await cb.answer()
 
 
-@router.callback_query(F.data == "product|nav|prev")
-async def cb_product_prev(cb: CallbackQuery):
-    ctx = USER_CTX.get(cb.from_user.id)
-    if not ctx:
+@callbacks.on(ProductNav)
+async def cb_product_nav(cb: CallbackQuery, data: ProductNav):
+    ctx = USER_CTX.get(cb.from_user.id) or {}
+    pid = data.pid or ctx.get("pid", 0)
+    step = 1 if data.direction == "next" else -1
+    p = PRODUCTS_BY_ID.get(pid)
+    if p:
+        key, pos = (p["category"], p["stone"]), PRODUCT_POS[pid] + step
+    elif ctx.get("pid") == pid and ctx["key"] in PRODUCTS:
+        # deleted since it was shown: the rest of its group moved up by one
+        key, pos = ctx["key"], ctx["idx"] + min(step, 0)
+    else:
         await safe_edit(
             cb.message,
             "Выберите ассортимент:",
             InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Открыть каталог", callback_data="catalog1|open|")]
+                [InlineKeyboardButton(text="Открыть каталог", callback_data=Catalog1().pack())]
             ])
         )
         return await cb.answer()
 
-    category, stone = ctx["key"]
-    await render_product_screen(cb, category, stone, ctx.get("idx", 0) - 1)
+    products = PRODUCTS[key]
+    await render_product_screen(cb, products[max(0, min(pos, len(products) - 1))]["id"])
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("product|add|"))
-async def cb_product_add(cb: CallbackQuery):
+@callbacks.on(ProductAdd)
+async def cb_product_add(cb: CallbackQuery, data: ProductAdd):
     purge_expired_carts()
-    pid = int(cb.data.split("|", 2)[-1])
+    pid = data.pid
+    p = PRODUCTS_BY_ID.get(pid)
+    if p and p["ver"] != data.ver:
+        await render_product_screen(cb, pid)
+        return await cb.answer(STALE_PRODUCT_TEXT, show_alert=True)
     if not dec_stock(pid, 1):
-        ctx = USER_CTX.get(cb.from_user.id)
-        if ctx:
-            category, stone = ctx["key"]
-            await render_product_screen(cb, category, stone, ctx.get("idx", 0))
+        if pid in PRODUCTS_BY_ID:
+            await render_product_screen(cb, pid)
         return await cb.answer("Этого товара больше нет на складе")
 
-    CART.setdefault(cb.from_user.id, {})
-    CART[cb.from_user.id][pid] = CART[cb.from_user.id].get(pid, 0) + 1
-    touch_cart(cb.from_user.id)
+    user_cart(cb.from_user.id).add(pid)
 
-    ctx = USER_CTX.get(cb.from_user.id)
-    if ctx:
-        category, stone = ctx["key"]
-        await render_product_screen(cb, category, stone, ctx.get("idx", 0))
+    if pid in PRODUCTS_BY_ID:
+        await render_product_screen(cb, pid)
     return await cb.answer("Добавлено в корзину")
 
 
-@router.callback_query(F.data.startswith("pimg|"))
-async def cb_photo_nav(cb: CallbackQuery):
-    try:
-        _p, action, payload = cb.data.split("|", 2)
-        category, stone, idx_s, img_idx_s = payload.split(":", 3)
-        idx = int(idx_s); img_idx = int(img_idx_s)
-    except Exception:
-        return await cb.answer("Ошибка параметров.", show_alert=True)
-
-    key = (category, stone)
-    products = PRODUCTS.get(key, [])
-    if not products:
-        return await cb.answer("Нет товаров.", show_alert=True)
-    if not (0 <= idx < len(products)):
+@callbacks.on(PhotoNav)
+async def cb_photo_nav(cb: CallbackQuery, data: PhotoNav):
+    p = PRODUCTS_BY_ID.get(data.pid)
+    if not p:
         return await cb.answer("Нет такого товара.", show_alert=True)
 
-    p = products[idx]
     photos = p.get("photos") or []
     if len(photos) < 2:
         return await cb.answer("Здесь только одно фото.", show_alert=True)
 
-    if action == "prev":
-        img_idx = (img_idx - 1) % len(photos)
-    else:
-        img_idx = (img_idx + 1) % len(photos)
+    step = -1 if data.action == "prev" else 1
+    await render_product_screen(cb, data.pid, img_idx=(data.img + step) % len(photos))
+    return await cb.answer()
+
+
+SEARCH_SHOW = 10
+INLINE_SHOW = 20
+
+
+def search_keyboard(pids: list[int]):
+    rows = [[InlineKeyboardButton(text=f"{short_title(PRODUCTS_BY_ID[pid]['title'], 32)} — {PRODUCTS_BY_ID[pid]['price']} ₽",
+                                  callback_data=ProductGoto(pid=pid).pack())]
+            for pid in pids if pid in PRODUCTS_BY_ID]
+    rows.append([InlineKeyboardButton(text="Выбор ассортиментов", callback_data=Catalog1().pack())])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@router.message(Command("search"))
+async def cmd_search(m: Message, command: CommandObject):
+    query = (command.args or "").strip()
+    if not query:
+        return await m.answer("Что ищем? Пример: <code>/search браслет аметист</code>")
+
+    pids = SEARCH.search(query, limit=SEARCH_SHOW)
+    if not pids:
+        return await m.answer("Ничего не нашлось. Попробуйте другое слово.", reply_markup=keyboard_welcome())
+    await m.answer(f"🔎 Найдено по запросу «{html.escape(query)}»:", reply_markup=search_keyboard(pids))
+
 
-    USER_CTX[cb.from_user.id] = {"key": key, "idx": idx, "img_idx": img_idx}
+@router.inline_query()
+async def inline_search(q: InlineQuery, bot: Bot):
+    pids = SEARCH.search(q.query, limit=INLINE_SHOW)
+    me = await bot.me()
+    results = []
+    for pid in pids:
+        p = PRODUCTS_BY_ID.get(pid)
+        if not p:
+            continue
+        cat_ru, stone_ru = ru_labels(p["category"], p["stone"])
+        results.append(InlineQueryResultArticle(
+            id=str(pid),
+            title=p["title"],
+            description=f"{p['price']} ₽ • {cat_ru} / {stone_ru}",
+            input_message_content=InputTextMessageContent(
+                message_text=f"<b>{html.escape(p['title'])}</b>\n{html.escape(cat_ru)} / {html.escape(stone_ru)}\nЦена: {p['price']} ₽",
+            ),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text="Открыть в магазине", url=f"https://t.me/{me.username}?start=p{pid}")
+            ]]),
+        ))
+    await q.answer(results, cache_time=5, is_personal=False)
+
+
+async def open_product_link(m: Message, pid: int):
+    """/start p<pid> deep link from an inline search result."""
+    if not await wait_catalog(settings.CATALOG_WAIT_TIMEOUT_SEC):
+        return await m.answer(LOADING_TEXT)
+    p = PRODUCTS_BY_ID.get(pid)
+    if not p:
+        return await m.answer("Этого товара больше нет.", reply_markup=keyboard_welcome())
+    await m.answer(f"🔎 {html.escape(p['title'])}", reply_markup=search_keyboard([pid]))
+
+
+@callbacks.on(ProductGoto)
+async def cb_product_goto(cb: CallbackQuery, data: ProductGoto):
+    pid = data.pid
+    p = PRODUCTS_BY_ID.get(pid)
+    if not p:
+        return await cb.answer("Этого товара больше нет.", show_alert=True)
 
-    await show_product(cb, p, idx, len(products), category, stone, img_idx=img_idx)
+    await render_product_screen(cb, pid)
     return await cb.answer()
 
 
 def cart_photo_kb(pid: int, idx: int, total: int):
-    back = InlineKeyboardButton(text="⬅️ Вернуться в корзину", callback_data="cart|open|")
+    back = InlineKeyboardButton(text="⬅️ Вернуться в корзину", callback_data=CartOpen().pack())
 
     if total <= 1:
         return InlineKeyboardMarkup(inline_keyboard=[[back]])
 
-    left  = InlineKeyboardButton(text="◀️", callback_data=f"cartimg|nav|prev|{pid}:{idx}")
-    mid   = InlineKeyboardButton(text=f"{(idx % total)+1}/{total}", callback_data="noop")
-    right = InlineKeyboardButton(text="▶️", callback_data=f"cartimg|nav|next|{pid}:{idx}")
+    left  = InlineKeyboardButton(text="◀️", callback_data=CartPhotoNav(direction="prev", pid=pid, idx=idx).pack())
+    mid   = InlineKeyboardButton(text=f"{(idx % total)+1}/{total}", callback_data=Noop().pack())
+    right = InlineKeyboardButton(text="▶️", callback_data=CartPhotoNav(direction="next", pid=pid, idx=idx).pack())
 
     return InlineKeyboardMarkup(inline_keyboard=[[left, mid, right], [back]])
 
@@ -553,19 +664,15 @@ async def render_cart_photo(cb: CallbackQuery, pid: int, idx: int):
             await cb.message.delete()
 
 
-@router.callback_query(F.data.startswith("cartimg|open|"))
-async def cb_cartimg_open(cb: CallbackQuery):
-    payload = cb.data.split("|", 2)[-1]
-    pid_s, idx_s = payload.split(":")
-    await render_cart_photo(cb, int(pid_s), int(idx_s))
+@callbacks.on(CartPhoto)
+async def cb_cartimg_open(cb: CallbackQuery, data: CartPhoto):
+    await render_cart_photo(cb, data.pid, data.idx)
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("cartimg|nav|"))
-async def cb_cartimg_nav(cb: CallbackQuery):
-    _, _, direction, payload = cb.data.split("|", 3)
-    pid_s, idx_s = payload.split(":")
-    pid, idx = int(pid_s), int(idx_s)
+@callbacks.on(CartPhotoNav)
+async def cb_cartimg_nav(cb: CallbackQuery, data: CartPhotoNav):
+    direction, pid, idx = data.direction, data.pid, data.idx
 
     photos = (PRODUCTS_BY_ID.get(pid, {}) or {}).get("photos") or []
     if len(photos) < 2:
@@ -581,18 +688,16 @@ def money(x: int) -> str:
 
 
 def cart_totals(user_id: int):
-    items = CART.get(user_id, {})
-    total_qty, total_sum = 0, 0
+    """Lines to show and the cart's running totals; the totals are not summed here."""
+    cart = CART.get(user_id)
+    if not cart:
+        return [], 0, 0
     lines = []
-    for pid, qty in items.items():
+    for pid, qty in cart.items():
         p = PRODUCTS_BY_ID.get(pid)
-        if not p:
-            continue
-        line_sum = p["price"] * qty
-        total_qty += qty
-        total_sum += line_sum
-        lines.append((p, qty, line_sum))
-    return lines, total_qty, total_sum
+        if p:
+            lines.append((p, qty, p["price"] * qty))
+    return lines, cart.total_qty, cart.total
 
 
 def short_title(title: str, max_len: int = 20) -> str:
@@ -608,39 +713,38 @@ def cart_keyboard(user_id: int, lines):
     rows = []
     for i, (p, qty, _) in enumerate(lines, start=1):
         if SHOW_LABEL_ROW:
-            rows.append([InlineKeyboardButton(text=f"• {short_title(p['title'])}", callback_data="noop")])
+            rows.append([InlineKeyboardButton(text=f"• {short_title(p['title'])}", callback_data=Noop().pack())])
 
         can_inc = PRODUCTS_BY_ID[p["id"]]["stock"] > 0
         row = [
-            InlineKeyboardButton(text=circ_num(i), callback_data="noop"),
-            InlineKeyboardButton(text="–", callback_data=f"cart|dec|{p['id']}"),
-            InlineKeyboardButton(text=f"x{qty}", callback_data="noop"),
+            InlineKeyboardButton(text=circ_num(i), callback_data=Noop().pack()),
+            InlineKeyboardButton(text="–", callback_data=CartItem(action="dec", pid=p["id"]).pack()),
+            InlineKeyboardButton(text=f"x{qty}", callback_data=Noop().pack()),
             InlineKeyboardButton(
                 text=("+" if can_inc else "🚫"),
-                callback_data=(f"cart|inc|{p['id']}" if can_inc else "noop")
+                callback_data=(CartItem(action="inc", pid=p["id"], ver=p["ver"]).pack() if can_inc else Noop().pack())
             ),
         ]
 
         if SHOW_DELETE_BUTTON:
-            row.append(InlineKeyboardButton(text="Удалить", callback_data=f"cart|del|{p['id']}"))
+            row.append(InlineKeyboardButton(text="Удалить", callback_data=CartItem(action="del", pid=p["id"]).pack()))
         rows.append(row)
 
         if p.get("photos") or []:
             rows.append([
-                InlineKeyboardButton(text="📷 Фото", callback_data=f"cartimg|open|{p['id']}:0"),
+                InlineKeyboardButton(text="📷 Фото", callback_data=CartPhoto(pid=p["id"]).pack()),
             ])
 
-    rows.append([InlineKeyboardButton(text="Очистить", callback_data="cart|clear|")])
-    rows.append([InlineKeyboardButton(text="Перейти к службе доставки", callback_data="delivery|open|")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад к товарам", callback_data="catalog1|open|")])
+    rows.append([InlineKeyboardButton(text="Очистить", callback_data=CartOpen(action="clear").pack())])
+    rows.append([InlineKeyboardButton(text="Перейти к службе доставки", callback_data=Delivery(action="open").pack())])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад к товарам", callback_data=Catalog1().pack())])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
 async def render_cart(cb: CallbackQuery):
-    items = CART.get(cb.from_user.id, {})
-    if not items:
+    if not CART.get(cb.from_user.id):
         kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⬅️ Назад к товарам", callback_data="catalog1|open|")]
+            [InlineKeyboardButton(text="⬅️ Назад к товарам", callback_data=Catalog1().pack())]
         ])
         await safe_edit(cb.message, "Корзина пуста.", reply_markup=kb)
         return
@@ -655,43 +759,45 @@ async def render_cart(cb: CallbackQuery):
     await safe_edit(cb.message, "\n".join(text_lines), cart_keyboard(cb.from_user.id, lines))
 
 
-@router.callback_query(F.data == "cart|open|")
-async def cb_cart_open(cb: CallbackQuery):
+@callbacks.on(CartOpen, "open")
+async def cb_cart_open(cb: CallbackQuery, data: CartOpen):
     purge_expired_carts()
     await render_cart(cb)
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("cart|inc|"))
-async def cb_cart_inc(cb: CallbackQuery):
-    pid = int(cb.data.split("|", 2)[-1])
+@callbacks.on(CartItem, "inc")
+async def cb_cart_inc(cb: CallbackQuery, data: CartItem):
+    pid = data.pid
     p = PRODUCTS_BY_ID.get(pid)
 
-    if not p or p["stock"] <= 0:
+    if p and p["ver"] != data.ver:
+        await render_cart(cb)
+        return await cb.answer(STALE_PRODUCT_TEXT, show_alert=True)
+    if not dec_stock(pid, 1):
         return await cb.answer("Больше нет на складе")
 
-    p["stock"] -= 1
-    CART.setdefault(cb.from_user.id, {})
-    CART[cb.from_user.id][pid] = CART[cb.from_user.id].get(pid, 0) + 1
+    user_cart(cb.from_user.id).add(pid)
 
     await render_cart(cb)
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("cart|dec|"))
-async def cb_cart_dec(cb: CallbackQuery):
-    pid = int(cb.data.split("|", 2)[-1])
+@callbacks.on(CartItem, "dec")
+async def cb_cart_dec(cb: CallbackQuery, data: CartItem):
+    pid = data.pid
 
     changed = False
-    if cb.from_user.id in CART and pid in CART[cb.from_user.id]:
-        cur = CART[cb.from_user.id][pid]
+    cart = CART.get(cb.from_user.id)
+    if cart and pid in cart:
+        cur = cart[pid]
         if cur > 1:
-            CART[cb.from_user.id][pid] = cur - 1
+            cart.remove(pid, 1)
             inc_stock(pid, 1)
             changed = True
         elif cur == 1:
             if REMOVE_ON_ZERO:
-                del CART[cb.from_user.id][pid]
+                cart.remove(pid, 1)
                 inc_stock(pid, 1)
                 changed = True
             else:
@@ -704,37 +810,45 @@ async def cb_cart_dec(cb: CallbackQuery):
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("cart|del|"))
-async def cb_cart_del(cb: CallbackQuery):
-    pid = int(cb.data.split("|", 2)[-1])
-    qty = 0
-    if cb.from_user.id in CART and pid in CART[cb.from_user.id]:
-        qty = CART[cb.from_user.id][pid]
-        del CART[cb.from_user.id][pid]
+@callbacks.on(CartItem, "del")
+async def cb_cart_del(cb: CallbackQuery, data: CartItem):
+    pid = data.pid
+    cart = CART.get(cb.from_user.id)
+    qty = cart.remove(pid) if cart else 0
     if qty:
         inc_stock(pid, qty)
     await render_cart(cb)
     return await cb.answer("Удалено")
 
 
-@router.callback_query(F.data == "cart|clear|")
-async def cb_cart_clear(cb: CallbackQuery):
+@callbacks.on(CartOpen, "clear")
+async def cb_cart_clear(cb: CallbackQuery, data: CartOpen):
     purge_expired_carts()
-    items = CART.get(cb.from_user.id, {})
-    for pid, qty in items.items():
-        inc_stock(pid, qty)
-    CART[cb.from_user.id] = {}
+    clear_cart(cb.from_user.id, restore_stock=True)
     CART_META.pop(cb.from_user.id, None)
     await render_cart(cb)
     return await cb.answer("Очищено")
 
 
-PENDING_ORDERS: dict[str, dict] = {}
+for _name, _obj in {
+    "catalog.PRODUCTS_BY_ID": catalog.PRODUCTS_BY_ID, "catalog.PRODUCTS": catalog.PRODUCTS,
+    "catalog.PRODUCT_POS": catalog.PRODUCT_POS,
+    "catalog.CATEGORIES": catalog.CATEGORIES, "catalog.STONES": catalog.STONES,
+    "catalog.CAT_IDS": catalog.CAT_IDS, "catalog.STONE_IDS": catalog.STONE_IDS,
+    "catalog.CAT_TERMS": catalog.CAT_TERMS, "catalog.STONE_TERMS": catalog.STONE_TERMS,
+    "catalog.CAT_LABELS": catalog.CAT_LABELS, "catalog.STONE_LABELS": catalog.STONE_LABELS,
+    "SEARCH": SEARCH,
+    "CART": CART, "CART_META": CART_META, "USER_CTX": USER_CTX, "DELIVERY_CTX": DELIVERY_CTX,
+    "INPUT_MODE": INPUT_MODE, "album_buffers": album_buffers,
+    "live.WATCHING": WATCHING, "live.VIEWERS": VIEWERS,
+}.items():
+    track_memory(_name, _obj)
 
 
 def build_cart_snapshot(user_id: int) -> dict:
+    cart = CART.get(user_id)
     items = []
-    for pid, qty in CART.get(user_id, {}).items():
+    for pid, qty in (cart or {}).items():
         if qty > 0:
             p = catalog.PRODUCTS_BY_ID.get(pid)
             if p:
@@ -745,8 +859,7 @@ def build_cart_snapshot(user_id: int) -> dict:
                     "qty": qty,
                     "photos": p.get("photos", []),
                 })
-    total_rub = sum(it["price"] * it["qty"] for it in items)
-    return {"items": items, "total_rub": total_rub}
+    return {"items": items, "total_rub": cart.total if cart else 0}
 
 
 def carrier_label(code: str | None) -> str:
@@ -756,10 +869,10 @@ def carrier_label(code: str | None) -> str:
 
 def delivery_choose_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="СДЭК", callback_data="delivery|form|cdek")],
-        [InlineKeyboardButton(text="Яндекс Доставка", callback_data="delivery|form|yandex")],
-        [InlineKeyboardButton(text="Почта России", callback_data="delivery|form|post")],
-        [InlineKeyboardButton(text="⬅️ Назад в корзину", callback_data="cart|open|")],
+        [InlineKeyboardButton(text="СДЭК", callback_data=DeliveryForm(carrier="cdek").pack())],
+        [InlineKeyboardButton(text="Яндекс Доставка", callback_data=DeliveryForm(carrier="yandex").pack())],
+        [InlineKeyboardButton(text="Почта России", callback_data=DeliveryForm(carrier="post").pack())],
+        [InlineKeyboardButton(text="⬅️ Назад в корзину", callback_data=CartOpen().pack())],
     ])
 
 
@@ -782,15 +895,15 @@ def delivery_form_keyboard(user_id: int):
     filled = bool(ctx.get("phone") and ctx.get("email") and ctx.get("address"))
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=("📱 Изменить телефон" if ctx.get("phone") else "📱 Ввести телефон"),
-                              callback_data="delivery|ask_phone|")],
+                              callback_data=Delivery(action="ask_phone").pack())],
         [InlineKeyboardButton(text=("✉️ Изменить e‑mail"  if ctx.get("email") else "✉️ Ввести e‑mail"),
-                              callback_data="delivery|ask_email|")],
+                              callback_data=Delivery(action="ask_email").pack())],
         [InlineKeyboardButton(text=("🏷 Изменить адрес/ПВЗ" if ctx.get("address") else "🏷 Ввести адрес/ПВЗ"),
-                              callback_data="delivery|ask_address|")],
+                              callback_data=Delivery(action="ask_address").pack())],
         [InlineKeyboardButton(text=("Перейти к оплате" if filled else "Перейти к оплате — заполните данные"),
-                              callback_data=("delivery:open" if filled else "noop"))],
-        [InlineKeyboardButton(text="⬅️ Сменить службу", callback_data="delivery|choose|")],
-        [InlineKeyboardButton(text="⬅️ Назад в корзину", callback_data="cart|open|")],
+                              callback_data=(PaymentStart().pack() if filled else Noop().pack()))],
+        [InlineKeyboardButton(text="⬅️ Сменить службу", callback_data=Delivery(action="choose").pack())],
+        [InlineKeyboardButton(text="⬅️ Назад в корзину", callback_data=CartOpen().pack())],
     ])
 
 
@@ -812,9 +925,8 @@ def make_invoice_description(items: list[dict]) -> str:
     return "\n".join(lines) if lines else "Позиции не найдены"
 
 
-@router.callback_query(F.data == "delivery|open|")
-@router.callback_query(F.data == "delivery|choose|")
-async def cb_delivery_choose(cb: CallbackQuery):
+@callbacks.on(Delivery, "open", "choose")
+async def cb_delivery_choose(cb: CallbackQuery, data: Delivery):
     INPUT_MODE[cb.from_user.id] = None
     DELIVERY_CTX.setdefault(cb.from_user.id, {"carrier": None, "phone": None, "email": None, "address": None})
 
@@ -822,9 +934,9 @@ async def cb_delivery_choose(cb: CallbackQuery):
     return await cb.answer()
 
 
-@router.callback_query(F.data.startswith("delivery|form|"))
-async def cb_delivery_form(cb: CallbackQuery):
-    carrier = cb.data.split("|", 2)[-1]
+@callbacks.on(DeliveryForm)
+async def cb_delivery_form(cb: CallbackQuery, data: DeliveryForm):
+    carrier = data.carrier
     INPUT_MODE[cb.from_user.id] = None
     DELIVERY_CTX.setdefault(cb.from_user.id, {"carrier": None, "phone": None, "email": None, "address": None})
     DELIVERY_CTX[cb.from_user.id]["carrier"] = carrier
@@ -833,22 +945,22 @@ async def cb_delivery_form(cb: CallbackQuery):
     return await cb.answer(f"Выбрано: {carrier_label(carrier)}")
 
 
-@router.callback_query(F.data == "delivery|ask_phone|")
-async def cb_delivery_ask_phone(cb: CallbackQuery):
+@callbacks.on(Delivery, "ask_phone")
+async def cb_delivery_ask_phone(cb: CallbackQuery, data: Delivery):
     INPUT_MODE[cb.from_user.id] = "phone"
     await safe_edit(cb.message, "📱 Отправьте телефон одним сообщением:", delivery_back_only_keyboard())
     return await cb.answer()
 
 
-@router.callback_query(F.data == "delivery|ask_email|")
-async def cb_delivery_ask_email(cb: CallbackQuery):
+@callbacks.on(Delivery, "ask_email")
+async def cb_delivery_ask_email(cb: CallbackQuery, data: Delivery):
     INPUT_MODE[cb.from_user.id] = "email"
     await safe_edit(cb.message, "✉️ Отправьте Email одним сообщением:", delivery_back_only_keyboard())
     return await cb.answer()
 
 
-@router.callback_query(F.data == "delivery|ask_address|")
-async def cb_delivery_ask_address(cb: CallbackQuery):
+@callbacks.on(Delivery, "ask_address")
+async def cb_delivery_ask_address(cb: CallbackQuery, data: Delivery):
     INPUT_MODE[cb.from_user.id] = "address"
     await safe_edit(cb.message, "🏷 Отправьте адрес или код ПВЗ (пока текстом).", delivery_back_only_keyboard())
     return await cb.answer()
@@ -883,34 +995,55 @@ async def on_text_input(m: Message):
     await m.answer(delivery_form_text(m.from_user.id), reply_markup=delivery_form_keyboard(m.from_user.id))
 
 
-@router.callback_query(F.data == "delivery|show|")
-async def cb_delivery_show(cb: CallbackQuery):
+@callbacks.on(Delivery, "show")
+async def cb_delivery_show(cb: CallbackQuery, data: Delivery):
     await safe_edit(cb.message, delivery_form_text(cb.from_user.id), delivery_form_keyboard(cb.from_user.id))
     return await cb.answer()
 
 
-@router.callback_query(F.data == "payment|start|current")
-async def cb_payment_start(cb: CallbackQuery):
+@callbacks.on(PaymentStart)
+async def cb_payment_start(cb: CallbackQuery, data: PaymentStart):
     ctx = DELIVERY_CTX.get(cb.from_user.id) or {}
     if not (ctx.get("carrier") and ctx.get("phone") and ctx.get("email") and ctx.get("address")):
         return await cb.answer("Заполните все данные доставки", show_alert=True)
 
+    if settings.PAY_PROVIDER_TOKEN:
+        items = build_cart_snapshot(cb.from_user.id)["items"]
+        if not items:
+            return await cb.answer("Корзина пуста", show_alert=True)
+        # the order is in the DB before the invoice exists, so a restart in between loses nothing
+        payload = await create_pending_order(
+            cb.from_user.id, cb.message.chat.id, cb.from_user.full_name or "", cb.from_user.username or "",
+            settings.PAY_CURRENCY,
+            [{"product_id": it["pid"], "title": it["title"], "price": rub_to_kopecks(it["price"]),
+              "qty": it["qty"], "photos": it["photos"]} for it in items],
+        )
+        await cb.message.answer_invoice(
+            title="Заказ",
+            description=make_invoice_description(items)[:255],
+            payload=payload,
+            provider_token=settings.PAY_PROVIDER_TOKEN,
+            currency=settings.PAY_CURRENCY,
+            prices=cart_to_prices(items),
+        )
+        return await cb.answer()
+
     await safe_edit(cb.message,
                     "💳 (Заглушка) Оплата: здесь будет выставление счёта.",
                     InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="✅ Провести оплату", callback_data="payment|mock_success|")],
-                        [InlineKeyboardButton(text="⬅️ Назад к доставке", callback_data="delivery|show|")],
+                        [InlineKeyboardButton(text="✅ Провести оплату", callback_data=PaymentMock().pack())],
+                        [InlineKeyboardButton(text="⬅️ Назад к доставке", callback_data=Delivery(action="show").pack())],
                     ]))
     return await cb.answer()
 
 
-@router.callback_query(F.data == "payment|mock_success|")
-async def cb_payment_mock_success(cb: CallbackQuery):
+@callbacks.on(PaymentMock)
+async def cb_payment_mock_success(cb: CallbackQuery, data: PaymentMock):
     clear_cart(cb.from_user.id, restore_stock=False)
     await safe_edit(cb.message, "🎉 Спасибо за покупку! Сейчас будет выдан трек.",
                     InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="⬅️ В каталог", callback_data="catalog1|open|")],
-                        [InlineKeyboardButton(text="🧺 Корзина", callback_data="cart|open|")],
+                        [InlineKeyboardButton(text="⬅️ В каталог", callback_data=Catalog1().pack())],
+                        [InlineKeyboardButton(text="🧺 Корзина", callback_data=CartOpen().pack())],
                     ]))
     return await cb.answer()
 
@@ -963,13 +1096,156 @@ async def cmd_admin_help(m: Message):
         "<code>/list</code>\n"
         "<code>/list category браслеты</code>\n"
         "<code>/list stone аметист</code>\n"
-        "<code>/list браслеты аметист</code>\n"
+        "<code>/list браслеты аметист</code>\n\n"
+
+        "<b>/stats</b>\n"
+        "<code>/stats [day|week|month]</code>\n\n"
+
+        "<b>/profile</b>\n"
+        "<code>/profile &lt;секунды&gt; [cpu|flame]</code>\n"
+        "cpu — cProfile (.pstats), flame — сэмплы стеков для flamegraph\n\n"
+
+        "<b>/mem</b>\n"
+        "<code>/mem</code> — размеры структур в памяти\n"
+        "<code>/mem diff &lt;секунды&gt;</code> — рост аллокаций по строкам (tracemalloc)\n\n"
+
+        "<b>/slow</b>\n"
+        "<code>/slow [N]</code> — последние медленные SQL-запросы с планами\n"
+        "<code>/slow clear</code>\n"
     )
 
     await m.answer(txt)
 
 
 
+@router.message(Command("stats"))
+async def admin_stats(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+
+    period = (command.args or "day").strip().lower()
+    if period not in PERIOD_DAYS:
+        return await m.answer("Как пользоваться: /stats [day|week|month]")
+
+    r = await sales_report(PERIOD_DAYS[period])
+    lines = [
+        f"<b>Продажи с {r['since']:%d.%m.%Y}</b>",
+        f"Выручка: {money(r['revenue'] // 100)}",
+        f"Продано: {r['units']} шт.",
+    ]
+    if r["top_products"]:
+        lines += ["", "<b>Топ товаров</b>:"]
+        lines += [f"{i}. #{pid} {title} — {units} шт., {money(rev // 100)}"
+                  for i, (pid, title, units, rev) in enumerate(r["top_products"], start=1)]
+    if r["top_categories"]:
+        lines += ["", "<b>По ассортиментам</b>:"]
+        lines += [f"• {name} — {units} шт., {money(rev // 100)}" for name, units, rev in r["top_categories"]]
+    if r["top_stones"]:
+        lines += ["", "<b>По камням</b>:"]
+        lines += [f"• {name} — {units} шт., {money(rev // 100)}" for name, units, rev in r["top_stones"]]
+    await m.answer("\n".join(lines))
+
+
+@router.message(Command("profile"))
+async def admin_profile(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+
+    parts = (command.args or "").split()
+    mode = parts[1].lower() if len(parts) > 1 else "cpu"
+    if not parts or not parts[0].isdigit() or not (1 <= int(parts[0]) <= PROFILE_MAX_SECONDS) \
+            or mode not in ("cpu", "flame"):
+        return await m.answer(f"Как пользоваться: /profile &lt;1–{PROFILE_MAX_SECONDS}&gt; [cpu|flame]")
+    if profiler_busy():
+        return await m.answer("Профилирование уже идёт, дождитесь результата.")
+
+    seconds = int(parts[0])
+    await m.answer(f"⏱ Профилирую {seconds} с ({mode})…")
+    if mode == "cpu":
+        report, data = await profile_cpu(seconds)
+        filename = f"profile-{int(time.time())}.pstats"
+    else:
+        report, data = await profile_stacks(seconds)
+        filename = f"profile-{int(time.time())}.collapsed.txt"
+
+    text = html.escape(report.strip())
+    if len(text) > TG_TEXT_LIMIT - 20:
+        text = text[:text.rfind("\n", 0, TG_TEXT_LIMIT - 20)] + "\n…"
+    await m.answer(f"<pre>{text}</pre>")
+    await m.answer_document(BufferedInputFile(data, filename=filename))
+
+
+def fmt_bytes(n: int) -> str:
+    for unit in ("Б", "КиБ", "МиБ"):
+        if abs(n) < 1024:
+            return f"{n:.0f} {unit}" if unit == "Б" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} ГиБ"
+
+
+@router.message(Command("mem"))
+async def admin_mem(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+
+    parts = (command.args or "").split()
+    if not parts:
+        rows = await memory_report()
+        rss = rss_bytes()
+        lines = [f"{'структура':24} {'записей':>8} {'≈память':>11}"]
+        lines += [f"{name:24} {n:8} {fmt_bytes(size):>11}" for name, n, size in rows]
+        lines += ["", f"{'итого':24} {'':8} {fmt_bytes(sum(r[2] for r in rows)):>11}"]
+        if rss is not None:
+            lines.append(f"{'RSS процесса':24} {'':8} {fmt_bytes(rss):>11}")
+        return await m.answer(f"<pre>{html.escape(chr(10).join(lines))}</pre>")
+
+    if parts[0] != "diff" or len(parts) != 2 or not parts[1].isdigit() \
+            or not (1 <= int(parts[1]) <= MEM_DIFF_MAX_SECONDS):
+        return await m.answer(f"Как пользоваться: /mem или /mem diff &lt;1–{MEM_DIFF_MAX_SECONDS}&gt;")
+    if profiler_busy():
+        return await m.answer("Профилирование уже идёт, дождитесь результата.")
+
+    seconds = int(parts[1])
+    await m.answer(f"📸 Снимки tracemalloc с интервалом {seconds} с…")
+    lines = await tracemalloc_diff(seconds)
+    if not lines:
+        return await m.answer("Роста аллокаций за это время нет.")
+    await m.answer(f"<pre>{html.escape(chr(10).join(lines))}</pre>")
+
+
+@router.message(Command("slow"))
+async def admin_slow(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+
+    arg = (command.args or "").strip().lower()
+    if arg == "clear":
+        SLOW_QUERIES.clear()
+        return await m.answer("Журнал медленных запросов очищен.")
+    if arg and not arg.isdigit():
+        return await m.answer("Как пользоваться: /slow [N] или /slow clear")
+    if not SLOW_QUERIES:
+        return await m.answer(f"Медленных запросов (≥ {settings.SLOW_QUERY_MS} мс) не было.")
+
+    n = max(1, int(arg or 5))
+    blocks = []
+    for e in list(SLOW_QUERIES)[-n:][::-1]:
+        if e["plan"] is None:
+            plan = "план ещё снимается…"
+        elif not e["plan"]:
+            plan = "план не снимался: этот запрос уже разбирали недавно"
+        else:
+            plan = e["plan"]
+        blocks.append(
+            f"<b>{e['ms']} мс</b> · {e['at']:%d.%m %H:%M:%S} UTC · {html.escape(e['handler'], quote=False)}\n"
+            f"<pre>{html.escape(e['statement'][:1500], quote=False)}</pre>\n"
+            f"параметры: <code>{html.escape(str(e['params'])[:300], quote=False)}</code>\n"
+            f"<pre>{html.escape(plan[:1500], quote=False)}</pre>"
+        )
+    for chunk in split_message(blocks):
+        await m.answer(chunk)
+
+
 @router.message(Command("add"), ~F.photo, ~F.media_group_id)
 async def admin_add_text(m: Message, command: CommandObject):
     if not is_admin(m.from_user.id):
@@ -1075,12 +1351,12 @@ async def admin_set(message: Message, command: CommandObject):
                 p.description = value
 
         elif field in ("category", "категория", "type", "тип"):
-            cat = await get_or_create_category(s, value)
-            p.category_id = cat.id
+            ref = cache_find_category(value)
+            p.category_id = ref["id"] if ref else (await get_or_create_category(s, value)).id
 
         elif field in ("stone", "камень"):
-            st = await get_or_create_stone(s, value)
-            p.stone_id = st.id
+            ref = cache_find_stone(value)
+            p.stone_id = ref["id"] if ref else (await get_or_create_stone(s, value)).id
 
         else:
             return await message.answer(
@@ -1148,61 +1424,161 @@ async def admin_list(m: Message, command: CommandObject):
             return await m.answer("<b>По камням</b>:\n" + text)
 
     terms = shlex.split(args) if args else []
-    async with Session() as s:
-        cat = stn = None
-
-        if len(terms) == 1:
-            t = terms[0]
-            c = await find_category_by_term(s, t)
-            s_ = await find_stone_by_term(s, t)
-            if c and not s_:
-                cat = c
-            elif s_ and not c:
-                stn = s_
-            elif c and s_:
-                return await m.answer(
-                    "Уточни, это категория или камень?\n"
-                    "Можно явно указать два слова: <code>/list &lt;категория&gt; &lt;камень&gt;</code>\n"
-                    "Либо посмотреть агрегаты: <code>/list types</code> или <code>/list stones</code>"
-                )
-            else:
-                return await m.answer("Ничего не найдено по этому слову.")
-        elif len(terms) >= 2:
-            cat = await find_category_by_term(s, terms[0])
-            stn = await find_stone_by_term(s, " ".join(terms[1:])) if len(terms) > 2 else await find_stone_by_term(s, terms[1])
-            if not cat and not stn:
-                return await m.answer("Не удалось распознать ни категорию, ни камень.")
-        q = (
-            select(Product, Category.name_ru, Stone.name_ru)
-            .join(Category, Product.category_id == Category.id)
-            .join(Stone, Product.stone_id == Stone.id)
-            .order_by(Product.id.desc())
-            .limit(30)
-        )
+    cat = stn = None
+
+    if len(terms) == 1:
+        t = terms[0]
+        c = cache_find_category(t)
+        s_ = cache_find_stone(t)
+        if c and not s_:
+            cat = c
+        elif s_ and not c:
+            stn = s_
+        elif c and s_:
+            return await m.answer(
+                "Уточни, это категория или камень?\n"
+                "Можно явно указать два слова: <code>/list &lt;категория&gt; &lt;камень&gt;</code>\n"
+                "Либо посмотреть агрегаты: <code>/list types</code> или <code>/list stones</code>"
+            )
+        else:
+            return await m.answer("Ничего не найдено по этому слову.")
+    elif len(terms) >= 2:
+        cat = cache_find_category(terms[0])
+        stn = cache_find_stone(" ".join(terms[1:])) if len(terms) > 2 else cache_find_stone(terms[1])
+        if not cat and not stn:
+            return await m.answer("Не удалось распознать ни категорию, ни камень.")
+
+    await send_list_page(
+        m,
+        cat["id"] if cat else 0,
+        stn["id"] if stn else 0,
+        direction="next",
+        cursor=None,
+    )
+
+
+LIST_PAGE_SIZE = 30
+TG_TEXT_LIMIT = 4096
+
+
+def list_row_text(pid: int, cat_ru: str, stone_ru: str, title: str, price: int, stock: int,
+                  nphotos: int, has_desc: bool) -> str:
+    return (
+        f"#{pid} • {cat_ru} / {stone_ru}\n"
+        f"{title} — {price} ₽, {stock} шт. (фото: {nphotos}{' + описание' if has_desc else ''})"
+    )
+
+
+def split_message(blocks: list[str], sep: str = "\n\n", limit: int = TG_TEXT_LIMIT) -> list[str]:
+    chunks, cur = [], ""
+    for b in blocks:
+        b = b[:limit]
+        if cur and len(cur) + len(sep) + len(b) > limit:
+            chunks.append(cur)
+            cur = b
+        else:
+            cur = cur + sep + b if cur else b
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+
+def list_page_from_memory(cat_id: int, stone_id: int, direction: str, cursor: int | None):
+    """None if the filter is not in the in-memory catalog and the DB has to answer."""
+    cat_code = catalog.CATEGORIES.get(cat_id, {}).get("code") if cat_id else None
+    st_code = catalog.STONES.get(stone_id, {}).get("code") if stone_id else None
+    if (cat_id and not cat_code) or (stone_id and not st_code) or not PRODUCTS_BY_ID:
+        return None
 
-        if cat:
-            q = q.where(Product.category_id == cat.id)
-        if stn:
-            q = q.where(Product.stone_id == stn.id)
+    ids = catalog.IDS_BY_FILTER.get((cat_code, st_code), [])
+    if direction == "prev":
+        i = 0 if cursor is None else bisect_right(ids, cursor)
+        page = ids[i:i + LIST_PAGE_SIZE + 1]
+    else:
+        i = len(ids) if cursor is None else bisect_left(ids, cursor)
+        page = ids[max(0, i - LIST_PAGE_SIZE - 1):i][::-1]
+
+    # DB stock, as the DB path shows it; the cache holds it net of cart holds
+    return [
+        (it["id"], CAT_LABELS.get(it["category"], it["category"]), STONE_LABELS.get(it["stone"], it["stone"]),
+         it["title"], it["price"], db_stock(it), len(it.get("photos") or []), bool(it.get("description")))
+        for it in map(PRODUCTS_BY_ID.__getitem__, page)
+    ]
+
+
+async def list_page_from_db(cat_id: int, stone_id: int, direction: str, cursor: int | None):
+    q = (
+        select(Product, Category.name_ru, Stone.name_ru)
+        .join(Category, Product.category_id == Category.id)
+        .join(Stone, Product.stone_id == Stone.id)
+        .limit(LIST_PAGE_SIZE + 1)
+    )
+    if direction == "prev":
+        q = q.order_by(Product.id.asc())
+        if cursor is not None:
+            q = q.where(Product.id > cursor)
+    else:
+        q = q.order_by(Product.id.desc())
+        if cursor is not None:
+            q = q.where(Product.id < cursor)
+    if cat_id:
+        q = q.where(Product.category_id == cat_id)
+    if stone_id:
+        q = q.where(Product.stone_id == stone_id)
+
+    async with Session() as s:
         rows = (await s.execute(q)).all()
+    return [
+        (p.id, cat_ru, stone_ru, p.title, p.price, p.stock, len(p.photos or []), bool(p.description))
+        for p, cat_ru, stone_ru in rows
+    ]
+
+
+def list_nav_keyboard(cat_id: int, stone_id: int, first_id: int, last_id: int,
+                      has_newer: bool, has_older: bool):
+    row = []
+    if has_newer:
+        row.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=AdminListPage(action="prev", cat_id=cat_id, stone_id=stone_id, cursor=first_id).pack()))
+    if has_older:
+        row.append(InlineKeyboardButton(text="Старее ➡️", callback_data=AdminListPage(action="next", cat_id=cat_id, stone_id=stone_id, cursor=last_id).pack()))
+    return InlineKeyboardMarkup(inline_keyboard=[row]) if row else None
+
+
+async def send_list_page(m: Message, cat_id: int, stone_id: int, direction: str, cursor: int | None):
+    rows = list_page_from_memory(cat_id, stone_id, direction, cursor)
+    if rows is None:
+        rows = await list_page_from_db(cat_id, stone_id, direction, cursor)
+
+    more = len(rows) > LIST_PAGE_SIZE
+    rows = rows[:LIST_PAGE_SIZE]
+    if direction == "prev":
+        rows.reverse()
+        has_newer, has_older = more, True
+    else:
+        has_newer, has_older = cursor is not None, more
 
     if not rows:
         label = []
-        if cat: label.append(cat.name_ru)
-        if stn: label.append(stn.name_ru)
+        if cat_id: label.append(catalog.CATEGORIES.get(cat_id, {}).get("name_ru", "?"))
+        if stone_id: label.append(catalog.STONES.get(stone_id, {}).get("name_ru", "?"))
         hint = f" по фильтру: {' / '.join(label)}" if label else ""
         return await m.answer(f"Список пуст{hint}.")
 
-    lines = []
-    for p, cat_ru, stone_ru in rows:
-        nphotos = len(p.photos or [])
-        has_desc = " + описание" if p.description else ""
-        lines.append(
-            f"#{p.id} • {cat_ru} / {stone_ru}\n"
-            f"{p.title} — {p.price} ₽, {p.stock} шт. (фото: {nphotos}{has_desc})"
-        )
+    chunks = split_message([list_row_text(*r) for r in rows])
+    kb = list_nav_keyboard(cat_id, stone_id, rows[0][0], rows[-1][0], has_newer, has_older)
+    for i, chunk in enumerate(chunks):
+        await m.answer(chunk, reply_markup=kb if i == len(chunks) - 1 else None)
+
 
-    await m.answer("\n\n".join(lines))
+@callbacks.on(AdminListPage)
+async def cb_admin_list_page(cb: CallbackQuery, data: AdminListPage):
+    if not is_admin(cb.from_user.id):
+        return await cb.answer()
+
+    with suppress(Exception):
+        await cb.message.edit_reply_markup(reply_markup=None)
+    await send_list_page(cb.message, data.cat_id, data.stone_id, data.action, data.cursor)
+    return await cb.answer()
 
 
 async def show_product(
@@ -1214,37 +1590,69 @@ async def show_product(
         stone: str,
         img_idx: int = 0,
 ) -> None:
-    cat_ru, stone_ru = ru_labels(category, stone)
-    caption = render_product_text(p, idx, total, cat_ru, stone_ru)
-    kb = product_keyboard(category, stone, p["id"], cb.from_user.id, idx, total, img_idx=img_idx)
+    caption, kb, fid = product_card(p, idx, total, category, stone, cb.from_user.id, img_idx)
 
-    photos = p.get("photos") or []
-    if photos:
-        img_idx = img_idx % len(photos)
-        fid = photos[img_idx]
+    shown = cb.message
+    if fid:
         media = InputMediaPhoto(media=fid, caption=caption)
 
         if cb.message.content_type == "photo":
             try:
                 await cb.message.edit_media(media=media, reply_markup=kb)
             except TelegramBadRequest:
-                new = await cb.message.answer_photo(fid, caption=caption, reply_markup=kb)
+                shown = await cb.message.answer_photo(fid, caption=caption, reply_markup=kb)
                 with suppress(Exception):
                     await cb.message.delete()
 
         else:
-            new = await cb.message.answer_photo(fid, caption=caption, reply_markup=kb)
+            shown = await cb.message.answer_photo(fid, caption=caption, reply_markup=kb)
             with suppress(Exception):
                 await cb.message.delete()
 
     else:
         if cb.message.content_type == "photo":
-            new = await cb.message.answer(caption, reply_markup=kb)
+            shown = await cb.message.answer(caption, reply_markup=kb)
             with suppress(Exception):
                 await cb.message.delete()
 
         else:
-            await safe_edit(cb.message, caption, kb)
+            shown = await safe_edit(cb.message, caption, kb)
+
+    if shown is not None:
+        watch(cb.from_user.id, p["id"], shown.chat.id, shown.message_id, img_idx, bool(fid), p["rev"])
+
+
+def product_card(p: dict, idx: int, total: int, category: str, stone: str, user_id: int, img_idx: int = 0):
+    """Caption, keyboard and photo (None for a product without photos) of a product screen."""
+    cat_ru, stone_ru = ru_labels(category, stone)
+    caption = render_product_text(p, idx, total, cat_ru, stone_ru)
+    kb = product_keyboard(category, stone, p["id"], user_id, idx, total, img_idx=img_idx)
+    photos = p.get("photos") or []
+    return caption, kb, (photos[img_idx % len(photos)] if photos else None)
+
+
+async def refresh_product_view(bot: Bot, user_id: int, view: dict, p: dict | None) -> bool:
+    """Re-render a watched product screen in place (see app.live); False when the message is gone."""
+    chat_id, message_id = view["chat_id"], view["message_id"]
+    if p is None:
+        text, kb = PRODUCT_GONE_TEXT, product_gone_keyboard()
+    else:
+        key = (p["category"], p["stone"])
+        text, kb, fid = product_card(p, PRODUCT_POS[p["id"]], len(PRODUCTS[key]), *key, user_id, view["img_idx"])
+        if bool(fid) != view["photo"]:
+            # a photo was added or removed: a text message can't become a photo, the next click re-renders
+            return True
+    try:
+        if view["photo"] and p is not None:
+            await bot.edit_message_media(media=InputMediaPhoto(media=fid, caption=text), chat_id=chat_id,
+                                         message_id=message_id, reply_markup=kb)
+        elif view["photo"]:
+            await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=text, reply_markup=kb)
+        else:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=kb)
+    except TelegramBadRequest as e:
+        return "message is not modified" in str(e)
+    return True
 
 @router.message(Command("add"), F.photo, ~F.media_group_id)
 async def admin_add_single_photo(m: Message, command: CommandObject):
@@ -1300,6 +1708,8 @@ async def finalize_album_after_pause(mgid: str):
 
 @router.pre_checkout_query()
 async def pre_checkout(pre: PreCheckoutQuery, bot: Bot):
+    if not await approve_order(pre.invoice_payload):
+        return await pre.answer(ok=False, error_message="Счёт устарел. Оформите заказ заново.")
     await pre.answer(ok=True)
 
 
@@ -1307,44 +1717,36 @@ async def pre_checkout(pre: PreCheckoutQuery, bot: Bot):
 async def on_success_payment(m: Message, bot: Bot):
     sp = m.successful_payment
     payload = sp.invoice_payload
-    snap = PENDING_ORDERS.pop(payload, None)
-    if not snap:
-        await m.answer("Не удалось найти заказ по платежу.")
-        return
 
     async with Session() as s:
-        order = Order(
-            user_id=snap["user_id"],
-            chat_id=snap["chat_id"],
-            full_name=m.from_user.full_name or "",
-            username=m.from_user.username or "",
-            currency=snap["currency"],
-            total_amount=snap["total_kop"],
-            payload=payload,
-            status=OrderStatus.paid,
-        )
-        s.add(order)
-        await s.flush()
+        order = await confirm_order(s, payload, full_name=m.from_user.full_name or "",
+                                    username=m.from_user.username or "")
+        if order is None:
+            if await order_status(payload) is OrderStatus.paid:
+                # the same payment delivered again (an update replay): it has been handled already
+                return
+            await m.answer("Не удалось найти заказ по платежу.")
+            return
 
-        for it in snap["items"]:
-            pid = it["pid"]
-            qty = it["qty"]
+        for it in order.items:
+            pid = it.product_id
 
             p: Product | None = await s.get(Product, pid)
             if not p:
+                it.qty = 0
                 continue
 
-            real_qty = min(qty, max(0, p.stock))
-            s.add(OrderItem(
-                order_id=order.id,
-                product_id=pid,
-                title=p.title,
-                price=rub_to_kopecks(it["price"]),
-                qty=real_qty,
-                photos=it.get("photos", []),
-            ))
+            real_qty = min(it.qty, max(0, p.stock))
+            it.title = p.title
+            it.qty = real_qty
+            await record_sale(s, p, real_qty, it.price, day=utc_day(order.created_at))
 
             p.stock = max(0, p.stock - real_qty)
+            # the units are sold now, the cart no longer holds them
+            cart = CART.get(m.from_user.id)
+            held = cart.remove(pid) if cart else 0
+            if held:
+                inc_stock(pid, held)
             if DELETE_PRODUCT_WHEN_STOCK_ZERO and p.stock == 0:
                 await s.delete(p)
                 cache_delete_product(pid)
@@ -1354,10 +1756,12 @@ async def on_success_payment(m: Message, bot: Bot):
         await s.commit()
         await cleanup_orphan_refs()
 
-    CART[m.from_user.id] = {}
+    clear_cart(m.from_user.id, restore_stock=True)
     CART_META.pop(m.from_user.id, None)
 
     await m.answer("Спасибо за покупку! ✨")
+    snap = {"items": [{"title": it.title, "price": it.price // 100, "qty": it.qty, "photos": it.photos}
+                      for it in order.items]}
     await notify_managers_about_order(bot, m, order, snap)
 
 
@@ -0,0 +1,219 @@
+import re
+import typing
+from typing import Annotated, Literal
+
+from aiogram.filters.callback_data import CallbackData, MAX_CALLBACK_LENGTH
+from aiogram.types import CallbackQuery
+from pydantic import BeforeValidator, PlainSerializer
+
+_PAYLOAD_SEP = re.compile(r"[|:]")
+_B36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def to_b36(n: int) -> str:
+    if n < 0:
+        raise ValueError(f"negative id {n}")
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36_DIGITS[r] + out
+        if not n:
+            return out
+
+
+def _from_b36(v):
+    return int(v, 36) if isinstance(v, str) else v
+
+
+# catalog id (category, stone) or version written in base 36: a few bytes whatever the name is
+B36 = Annotated[int, BeforeValidator(_from_b36), PlainSerializer(to_b36, return_type=str)]
+
+
+class Action(CallbackData, prefix="_"):
+    """Callback data in the bot's `namespace|action|a:b:c` format.
+
+    The prefix is the namespace, an `action` field (a Literal) is the second
+    segment, every other field goes into the payload joined with ":".
+    `|` is accepted between payload fields too, for buttons sent by older versions.
+    A class without an `action` field packs to the bare prefix ("noop").
+    """
+
+    def pack(self) -> str:
+        values = self.model_dump(mode="json")
+        action = values.pop("action", None)
+        parts = []
+        for key, value in values.items():
+            encoded = self._encode_value(key, value)
+            if _PAYLOAD_SEP.search(encoded):
+                raise ValueError(f"{key}={encoded!r} contains a separator")
+            parts.append(encoded)
+        data = self.__prefix__ if action is None else f"{self.__prefix__}|{action}|{':'.join(parts)}"
+        if len(data.encode()) > MAX_CALLBACK_LENGTH:
+            raise ValueError(f"callback data too long: {data!r}")
+        return data
+
+    @classmethod
+    def unpack(cls, value: str):
+        ns, _, rest = value.partition("|")
+        if ns != cls.__prefix__:
+            raise ValueError(f"bad prefix {ns!r} for {cls.__name__}")
+        payload = {}
+        names = [n for n in cls.model_fields if n != "action"]
+        if "action" in cls.model_fields:
+            action, _, tail = rest.partition("|")
+            payload["action"] = action
+            parts = _PAYLOAD_SEP.split(tail) if tail else []
+        else:
+            parts = [rest] if rest else []
+        if len(parts) > len(names):
+            raise ValueError(f"{cls.__name__} takes {len(names)} values, got {len(parts)}")
+        payload.update(zip(names, parts))
+        return cls(**payload)
+
+    @classmethod
+    def actions(cls) -> tuple[str, ...]:
+        field = cls.model_fields.get("action")
+        return typing.get_args(field.annotation) if field else ()
+
+
+class Noop(Action, prefix="noop"):
+    pass
+
+
+class Welcome(Action, prefix="welcome"):
+    action: Literal["open"] = "open"
+
+
+class Contacts(Action, prefix="contacts"):
+    action: Literal["open"] = "open"
+
+
+class Catalog1(Action, prefix="catalog1"):
+    action: Literal["open"] = "open"
+
+
+class Catalog2(Action, prefix="catalog2"):
+    action: Literal["open"] = "open"
+    cat: B36
+
+
+class ProductOpen(Action, prefix="product"):
+    """cat=0 opens the first group (ids start at 1)."""
+    action: Literal["open"] = "open"
+    cat: B36 = 0
+    stone: B36 = 0
+
+
+class ProductNav(Action, prefix="product"):
+    """Step from product `pid` (the one on screen) to its neighbour; pid=0 means the user's last shown product."""
+    action: Literal["nav"] = "nav"
+    direction: Literal["prev", "next"]
+    pid: int = 0
+
+
+class ProductAdd(Action, prefix="product"):
+    """ver: the product's cache version when the button was drawn; 0 for buttons sent before versions."""
+    action: Literal["add"] = "add"
+    pid: int
+    ver: B36 = 0
+
+
+class ProductGoto(Action, prefix="product"):
+    action: Literal["id"] = "id"
+    pid: int
+
+
+class PhotoNav(Action, prefix="pimg"):
+    action: Literal["prev", "next"]
+    pid: int
+    img: int
+
+
+class CartOpen(Action, prefix="cart"):
+    action: Literal["open", "clear"] = "open"
+
+
+class CartItem(Action, prefix="cart"):
+    action: Literal["inc", "dec", "del"]
+    pid: int
+    ver: B36 = 0
+
+
+class CartPhoto(Action, prefix="cartimg"):
+    action: Literal["open"] = "open"
+    pid: int
+    idx: int = 0
+
+
+class CartPhotoNav(Action, prefix="cartimg"):
+    action: Literal["nav"] = "nav"
+    direction: Literal["prev", "next"]
+    pid: int
+    idx: int
+
+
+class Delivery(Action, prefix="delivery"):
+    action: Literal["open", "choose", "show", "ask_phone", "ask_email", "ask_address"]
+
+
+class DeliveryForm(Action, prefix="delivery"):
+    action: Literal["form"] = "form"
+    carrier: Literal["cdek", "yandex", "post"]
+
+
+class PaymentStart(Action, prefix="payment"):
+    action: Literal["start"] = "start"
+    order: Literal["current"] = "current"
+
+
+class PaymentMock(Action, prefix="payment"):
+    action: Literal["mock_success"] = "mock_success"
+
+
+class AdminListPage(Action, prefix="alist"):
+    action: Literal["prev", "next"]
+    cat_id: int
+    stone_id: int
+    cursor: int
+
+
+def callback_key(data: str) -> str:
+    """`ns|action` of raw callback data, or the bare data when it has no action ("noop")."""
+    ns, sep, rest = data.partition("|")
+    return f"{ns}|{rest.partition('|')[0]}" if sep else ns
+
+
+class CallbackTable:
+    """Dispatch of callback queries by `ns|action` in one dict lookup.
+
+    Register handlers with `@table.on(DataClass)` (all actions of the class) or
+    `@table.on(DataClass, "inc")`; a handler gets `(cb, data)` with `data` already
+    parsed and validated. Register `table.dispatch` as the router's only callback handler.
+    """
+
+    def __init__(self, stale_text: str = ""):
+        self.handlers: dict[str, tuple[type[Action], typing.Callable]] = {}
+        self.stale_text = stale_text
+
+    def on(self, cls: type[Action], *actions: str):
+        keys = [f"{cls.__prefix__}|{a}" for a in (actions or cls.actions())] or [cls.__prefix__]
+
+        def register(fn):
+            for key in keys:
+                if key in self.handlers:
+                    raise ValueError(f"callback {key!r} is already handled by {self.handlers[key][1].__name__}")
+                self.handlers[key] = (cls, fn)
+            return fn
+        return register
+
+    async def dispatch(self, cb: CallbackQuery):
+        entry = self.handlers.get(callback_key(cb.data or ""))
+        if entry is None:
+            return await cb.answer()
+        cls, handler = entry
+        try:
+            data = cls.unpack(cb.data)
+        except (ValueError, TypeError):
+            # malformed or from an old keyboard; pydantic's ValidationError is a ValueError
+            return await cb.answer(self.stale_text, show_alert=bool(self.stale_text))
+        return await handler(cb, data)
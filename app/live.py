@@ -0,0 +1,99 @@
+﻿import asyncio
+import logging
+import time
+
+from app.config import settings
+from app.metrics import Counter
+from app.utils.bounded import BoundedDict
+
+log = logging.getLogger(__name__)
+
+LIVE_EDITS = Counter("bot_live_view_edits_total",
+                     "Product screens re-rendered because the product changed, by outcome.", ("outcome",))
+
+# product id -> ids of the users in WATCHING that show it
+VIEWERS: dict[int, set[int]] = {}
+
+
+def _drop_viewer(user_id: int, view: dict) -> None:
+    users = VIEWERS.get(view["pid"])
+    if users is not None:
+        users.discard(user_id)
+        if not users:
+            del VIEWERS[view["pid"]]
+
+
+# user id -> the product screen they have open: {"pid", "chat_id", "message_id", "img_idx", "photo", "rev", "at"}
+WATCHING = BoundedDict("live.WATCHING", settings.USER_STATE_MAX_USERS, settings.LIVE_VIEW_TTL_SEC,
+                       on_evict=_drop_viewer)
+# products changed since the last batch
+_DIRTY: set[int] = set()
+_WAKE = asyncio.Event()
+_TASK: asyncio.Task | None = None
+
+
+def watch(user_id: int, pid: int, chat_id: int, message_id: int, img_idx: int, photo: bool, rev: int) -> None:
+    """`user_id` now looks at product `pid` in that message; replaces whatever they watched before."""
+    unwatch(user_id)
+    WATCHING[user_id] = {"pid": pid, "chat_id": chat_id, "message_id": message_id, "img_idx": img_idx,
+                         "photo": photo, "rev": rev, "at": time.monotonic()}
+    VIEWERS.setdefault(pid, set()).add(user_id)
+
+
+def unwatch(user_id: int) -> None:
+    view = WATCHING.pop(user_id, None)
+    if view is not None:
+        _drop_viewer(user_id, view)
+
+
+def product_changed(pid: int) -> None:
+    """Catalog hook: the cached product changed or was removed."""
+    if pid in VIEWERS:
+        _DIRTY.add(pid)
+        _WAKE.set()
+
+
+async def _run(bot, render, rate: float) -> None:
+    """One batch per wake-up: waits LIVE_VIEW_COALESCE_MS so a burst of changes to one product becomes one
+    edit per viewer, then edits at most `rate` messages a second. `render(bot, user_id, view, product)`
+    returns False when the message can't be edited any more."""
+    from app.data.catalog import PRODUCTS_BY_ID
+
+    while True:
+        await _WAKE.wait()
+        await asyncio.sleep(settings.LIVE_VIEW_COALESCE_MS / 1000)
+        _WAKE.clear()
+        pids = list(_DIRTY)
+        _DIRTY.clear()
+        for pid in pids:
+            for user_id in list(VIEWERS.get(pid, ())):
+                view = WATCHING.get(user_id)
+                if view is None or view["pid"] != pid:
+                    continue
+                if time.monotonic() - view["at"] > settings.LIVE_VIEW_TTL_SEC:
+                    unwatch(user_id)
+                    LIVE_EDITS.inc("expired")
+                    continue
+                p = PRODUCTS_BY_ID.get(pid)
+                if p is not None and p["rev"] == view["rev"]:
+                    # already up to date, e.g. the user's own click re-rendered it
+                    continue
+                try:
+                    ok = await render(bot, user_id, view, p)
+                except Exception:
+                    log.exception("live re-render of product %s for user %s failed", pid, user_id)
+                    ok = False
+                LIVE_EDITS.inc("ok" if ok else "failed")
+                if not ok or p is None:
+                    unwatch(user_id)
+                else:
+                    view["rev"] = p["rev"]
+                await asyncio.sleep(1 / rate)
+
+
+def start_live_views(bot, render) -> None:
+    global _TASK
+    if settings.LIVE_VIEW_EDITS_PER_SEC > 0 and _TASK is None:
+        # the rate is for the whole bot: each shard worker runs its own editor with an equal share
+        rate = settings.LIVE_VIEW_EDITS_PER_SEC / (1 if settings.SHARD_INDEX is None else settings.WORKERS)
+        _TASK = asyncio.get_running_loop().create_task(_run(bot, render, rate), name="live-views")
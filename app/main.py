@@ -4,38 +4,124 @@ if sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 import asyncio
+import logging
 from aiogram import Bot, Dispatcher
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandStart, CommandObject
 from aiogram.types import Message
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 from app.config import settings
-from app.db.bootstrap import init_db_and_load_cache
-from app.handlers.callbacks import router as cb_router
+from app.db.bootstrap import init_db_and_load_cache, load_catalog_to_memory, stock_reconcile_loop
+from app.db.orders import pending_orders_loop
+from app.db.session import engine
+from app.handlers.callbacks import router as cb_router, open_product_link, refresh_product_view
+from app.handlers.cbdata import Catalog1, Contacts
+from app.metrics import MetricsMiddleware, MetricsSession, instrument_engine, start_metrics_server, mark_startup
+from app.warmup import catalog_loaded
+from app.live import start_live_views
+from app.shard import Supervisor, run_worker, stop_worker
+from app.tracing import setup_tracing, shutdown_tracing
+from app.profiling import track_memory
+from app.watchdog import start_loop_watchdog, stop_loop_watchdog
+from app.utils.bounded import BoundedDict
 
-bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+api = TelegramAPIServer.from_base(settings.BOT_API_URL) if settings.BOT_API_URL else PRODUCTION
+bot = Bot(token=settings.BOT_TOKEN, session=MetricsSession(api=api), default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
+dp.update.outer_middleware(MetricsMiddleware())
 dp.include_router(cb_router)
+instrument_engine(engine)
 
-USER_UI_MESSAGE = {}
+USER_UI_MESSAGE = BoundedDict("USER_UI_MESSAGE", settings.USER_STATE_MAX_USERS, settings.USER_STATE_TTL_SEC)
+track_memory("USER_UI_MESSAGE", USER_UI_MESSAGE)
 
 @dp.message(CommandStart())
-async def start(message: Message):
+async def start(message: Message, command: CommandObject):
+    args = command.args or ""
+    if args.startswith("p") and args[1:].isdigit():
+        return await open_product_link(message, int(args[1:]))
+
     text = "👋 Добро пожаловать! Это черновик приветствия.\n\nВыберите действие ниже."
     kb = {
         "inline_keyboard": [[
-            {"text": "Выбор ассортиментов", "callback_data": "catalog1|open|"},
+            {"text": "Выбор ассортиментов", "callback_data": Catalog1().pack()},
         ], [
-            {"text": "Связь с менеджером", "callback_data": "contacts|open|"}
+            {"text": "Связь с менеджером", "callback_data": Contacts().pack()}
         ]]
     }
     msg = await message.answer(text, reply_markup=kb)
     USER_UI_MESSAGE[message.from_user.id] = msg.message_id
 
 
+log = logging.getLogger(__name__)
+
+# set when the startup catalog load failed; main() then exits non-zero so a process manager restarts the bot
+_startup_failed = False
+
+
+async def warm_start():
+    """Loads the catalog while polling already runs; /start and other static screens answer meanwhile.
+    Then stays on as the periodic stock reconciliation."""
+    global _startup_failed
+    try:
+        if settings.SHARD_INDEX is None:
+            await init_db_and_load_cache()
+        else:
+            # the supervisor prepared the DB; every worker loads its own cache
+            await load_catalog_to_memory(broadcast=False)
+    except Exception:
+        log.exception("startup: catalog load failed, stopping")
+        _startup_failed = True
+        if settings.SHARD_INDEX is not None:
+            stop_worker(failed=True)
+        else:
+            await dp.stop_polling()
+        return
+    catalog_loaded()
+    if settings.STOCK_RECONCILE_INTERVAL_SEC:
+        await stock_reconcile_loop(settings.STOCK_RECONCILE_INTERVAL_SEC)
+
+
+_warm_start_task = None
+_order_sweep_task = None
+
+
+@dp.startup()
+async def on_startup():
+    global _warm_start_task, _order_sweep_task
+    mark_startup("polling")
+    # keep a reference: the loop holds tasks only weakly
+    _warm_start_task = asyncio.create_task(warm_start(), name="catalog-warm-start")
+    start_live_views(bot, refresh_product_view)
+    # one sweeper is enough when sharded
+    if settings.SHARD_INDEX in (None, 0):
+        _order_sweep_task = asyncio.create_task(
+            pending_orders_loop(settings.PENDING_ORDER_TTL_SEC, settings.PENDING_ORDER_SWEEP_SEC),
+            name="pending-order-sweep")
+
+
 async def main():
-    await init_db_and_load_cache()
-    await bot.delete_webhook(drop_pending_updates=False)
-    await dp.start_polling(bot)
+    setup_tracing()
+    start_loop_watchdog()
+    shard = settings.SHARD_INDEX
+    if settings.METRICS_PORT:
+        # in sharded mode the supervisor takes METRICS_PORT and worker i the port i + 1 above it
+        await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT + (0 if shard is None else shard + 1))
+    try:
+        if shard is not None:
+            if not await run_worker(bot, dp, shard, settings.SHARD_SUPERVISOR):
+                raise SystemExit(1)
+        elif settings.WORKERS > 1:
+            if not await Supervisor(bot, dp, settings.WORKERS).run():
+                raise SystemExit(1)
+        else:
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
+            if _startup_failed:
+                raise SystemExit(1)
+    finally:
+        await stop_loop_watchdog()
+        await shutdown_tracing()
 
 
 if __name__ == '__main__':
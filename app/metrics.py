@@ -0,0 +1,288 @@
+﻿import logging
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.types import Update
+from sqlalchemy import event
+
+from app.tracing import span, start_span, end_span, CURRENT_HANDLER
+
+log = logging.getLogger(__name__)
+
+# label sets per metric; anything beyond is folded into "other" so user input can't blow up the series count
+MAX_SERIES = 500
+
+HANDLER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+API_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.series: dict[tuple, object] = {}
+        REGISTRY.append(self)
+
+    def _key(self, values: tuple) -> tuple:
+        if values in self.series or len(self.series) < MAX_SERIES:
+            return values
+        return ("other",) * len(self.labels)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *values, amount: float = 1) -> None:
+        key = self._key(values)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        return self.header() + [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_num(v)}"
+                                for k, v in self.series.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *values) -> None:
+        self.series[self._key(values)] = value
+
+    def render(self) -> list[str]:
+        return self.header() + [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_num(v)}"
+                                for k, v in self.series.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = HANDLER_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *values) -> None:
+        key = self._key(values)
+        s = self.series.get(key)
+        if s is None:
+            # per-bucket (non-cumulative) counts, then sum and count
+            s = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            s[0][i] += 1
+        s[1] += value
+        s[2] += 1
+
+    def render(self) -> list[str]:
+        out = self.header()
+        for k, (counts, total, n) in self.series.items():
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                le_label = 'le="%s"' % _fmt_num(le)
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le_label)} {acc}")
+            inf_label = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, inf_label)} {n}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {_fmt_num(total)}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {n}")
+        return out
+
+
+REGISTRY: list[_Metric] = []
+
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Time to process one update, by handler label.", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Updates whose processing raised, by handler label.", ("handler",))
+UPDATE_API_CALLS = Histogram("bot_update_api_calls", "Bot API calls made while processing one update.",
+                             ("handler",), COUNT_BUCKETS)
+UPDATE_DB_QUERIES = Histogram("bot_update_db_queries", "SQL statements executed while processing one update.",
+                              ("handler",), COUNT_BUCKETS)
+DB_LATENCY = Histogram("db_statement_seconds", "SQL statement execution time, by statement kind.",
+                       ("operation",), DB_BUCKETS)
+DB_ERRORS = Counter("db_statement_errors_total", "SQL statements that raised, by statement kind.", ("operation",))
+API_LATENCY = Histogram("telegram_api_seconds", "Bot API request time, by method.", ("method",), API_BUCKETS)
+API_CALLS = Counter("telegram_api_calls_total", "Bot API requests, by method and outcome.", ("method", "outcome"))
+STARTUP = Gauge("bot_startup_seconds", "Seconds from process start to a startup stage "
+                "(polling, catalog_ready, first_response).", ("stage",))
+
+# [api calls, db queries] of the update being processed in this task
+_UPDATE_COST: ContextVar[list | None] = ContextVar("update_cost", default=None)
+
+
+def _process_age() -> float | None:
+    """Seconds since the process was started, from /proc; None elsewhere."""
+    try:
+        with open("/proc/self/stat", encoding="ascii") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", encoding="ascii") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+# fallback origin where /proc is not available: import of this module, early in startup
+_IMPORTED_AT = time.monotonic()
+
+
+def mark_startup(stage: str) -> None:
+    """Record the first time `stage` is reached; later calls are no-ops."""
+    if (stage,) in STARTUP.series:
+        return
+    age = _process_age()
+    if age is None:
+        age = time.monotonic() - _IMPORTED_AT
+    STARTUP.set(round(age, 3), stage)
+    log.info("startup: %s after %.2f s", stage, age)
+
+
+def render() -> str:
+    lines = []
+    for m in REGISTRY:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+
+def handler_label(update: Update) -> str:
+    """Low-cardinality name of what an update asks for: `product|add`, `/start`, `text`, ..."""
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        return "|".join(data.split("|", 2)[:2]) or "empty"
+    m = update.message
+    if m:
+        if m.successful_payment:
+            return "successful_payment"
+        text = m.text or ""
+        if text.startswith("/"):
+            return text.split(maxsplit=1)[0].split("@", 1)[0][:32]
+        return "text" if text else "other_message"
+    if update.inline_query:
+        return "inline_query"
+    if update.pre_checkout_query:
+        return "pre_checkout_query"
+    return update.event_type
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Outer middleware on `dp.update`: latency, errors and per-update API/DB cost by handler label.
+
+    Also opens the root tracing span of the update.
+    """
+
+    async def __call__(self, handler, event: Update, data: dict):
+        label = handler_label(event)
+        cost = [0, 0]
+        token = _UPDATE_COST.set(cost)
+        label_token = CURRENT_HANDLER.set(label)
+        t0 = time.perf_counter()
+        user = getattr(event.event, "from_user", None)
+        try:
+            with span(f"update {label}", handler=label, update_id=event.update_id,
+                      user_id=user.id if user else 0):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            mark_startup("first_response")
+            HANDLER_LATENCY.observe(time.perf_counter() - t0, label)
+            UPDATE_API_CALLS.observe(cost[0], label)
+            UPDATE_DB_QUERIES.observe(cost[1], label)
+            _UPDATE_COST.reset(token)
+            CURRENT_HANDLER.reset(label_token)
+
+
+class MetricsSession(AiohttpSession):
+    """AiohttpSession that counts and times every Bot API method, with a tracing span per call."""
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        if name == "getUpdates":  # long polling: neither a latency sample nor a trace
+            API_CALLS.inc(name, "ok")
+            return await super().make_request(bot, method, timeout)
+        cost = _UPDATE_COST.get()
+        if cost is not None:
+            cost[0] += 1
+        t0 = time.perf_counter()
+        outcome = "ok"
+        try:
+            with span(f"telegram {name}", method=name):
+                return await super().make_request(bot, method, timeout)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - t0, name)
+            API_CALLS.inc(name, outcome)
+
+
+def _operation(statement: str) -> str:
+    word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return word if word in {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "PRAGMA", "CREATE", "BEGIN",
+                            "COMMIT", "ROLLBACK", "EXPLAIN"} else "OTHER"
+
+
+def instrument_engine(engine) -> None:
+    """Time every statement on an (async) engine through cursor execute events, with a span each."""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        op = _operation(statement)
+        s = start_span(f"db {op}", {"db.statement": statement[:1000], "db.executemany": executemany})
+        conn.info.setdefault("metrics_t0", []).append((time.perf_counter(), s))
+        cost = _UPDATE_COST.get()
+        if cost is not None:
+            cost[1] += 1
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stack = conn.info.get("metrics_t0")
+        if stack:
+            t0, s = stack.pop()
+            DB_LATENCY.observe(time.perf_counter() - t0, _operation(statement))
+            end_span(s)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(ctx):
+        stack = ctx.connection.info.get("metrics_t0") if ctx.connection is not None else None
+        if stack:
+            end_span(stack.pop()[1], ctx.original_exception)
+        DB_ERRORS.inc(_operation(ctx.statement or ""))
+
+
+async def _metrics_view(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
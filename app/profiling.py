@@ -0,0 +1,204 @@
+﻿import asyncio
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_MAX_SECONDS = 120
+SAMPLE_INTERVAL_SEC = 0.005
+TOP_FUNCTIONS = 25
+
+# one profile at a time: cProfile and the sampler both watch the whole loop thread
+_BUSY = asyncio.Lock()
+
+
+def profiler_busy() -> bool:
+    return _BUSY.locked()
+
+
+async def profile_cpu(seconds: float) -> tuple[str, bytes]:
+    """cProfile the event loop thread for `seconds`; returns the top functions by cumulative time and the .pstats dump."""
+    async with _BUSY:
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            prof.disable()
+
+    out = io.StringIO()
+    st = pstats.Stats(prof, stream=out)
+    st.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+    # same bytes as Stats.dump_stats, without a temp file
+    return out.getvalue(), marshal.dumps(pstats.Stats(prof).stats)
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _sample_loop(thread_id: int, stop: threading.Event, stacks: Counter, interval: float) -> None:
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[_collapse(frame)] += 1
+
+
+async def profile_stacks(seconds: float, interval: float = SAMPLE_INTERVAL_SEC) -> tuple[str, bytes]:
+    """Sample the loop's stack; returns a summary and flamegraph-collapsed stacks.
+
+    In the main thread on Unix this uses SIGPROF, so only CPU time is sampled and
+    short bursts are not hidden behind the GIL. Elsewhere a helper thread samples
+    wall time, idle time in the selector included.
+    """
+    async with _BUSY:
+        stacks: Counter[str] = Counter()
+        use_signal = hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+        started = time.perf_counter()
+        if use_signal:
+            def on_sigprof(_signum, frame):
+                stacks[_collapse(frame)] += 1
+
+            prev = signal.signal(signal.SIGPROF, on_sigprof)
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                signal.setitimer(signal.ITIMER_PROF, 0)
+                signal.signal(signal.SIGPROF, prev)
+        else:
+            stop = threading.Event()
+            t = threading.Thread(target=_sample_loop, args=(threading.get_ident(), stop, stacks, interval),
+                                 name="profile-sampler", daemon=True)
+            t.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop.set()
+                await asyncio.to_thread(t.join)
+        elapsed = time.perf_counter() - started
+
+    total = sum(stacks.values())
+    inclusive: Counter[str] = Counter()
+    leaf: Counter[str] = Counter()
+    for stack, n in stacks.items():
+        frames = stack.split(";")
+        leaf[frames[-1]] += n
+        for name in set(frames):
+            inclusive[name] += n
+    kind = "CPU" if use_signal else "wall"
+    lines = [f"{total} {kind} samples in {elapsed:.1f} s, every {interval * 1000:.0f} ms", "", "inclusive:"]
+    lines += [f"{n / total:6.1%}  {name}" for name, n in inclusive.most_common(TOP_FUNCTIONS)] if total else []
+    lines += ["", "self:"]
+    lines += [f"{n / total:6.1%}  {name}" for name, n in leaf.most_common(TOP_FUNCTIONS)] if total else []
+    collapsed = "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+    return "\n".join(lines), collapsed.encode("utf-8")
+
+
+# ---- memory -----------------------------------------------------------------
+
+MEM_DIFF_MAX_SECONDS = 300
+MEM_TOP_LINES = 15
+# yield to the loop this often while walking big structures
+_WALK_CHUNK = 20_000
+
+# name -> object reported by /mem; modules register their long-lived state with track_memory
+MEM_TRACKED: dict[str, object] = {}
+
+
+def track_memory(name: str, obj: object) -> None:
+    MEM_TRACKED[name] = obj
+
+
+async def deep_size(obj: object, seen: set | None = None) -> int:
+    """Approximate deep size: builtin containers are followed, other objects count their own size
+    (plus their __dict__ for the root, so an index object is measured through its fields).
+    Objects already in `seen` are not counted again."""
+    seen = set() if seen is None else seen
+    stack = [obj]
+    if not isinstance(obj, (dict, list, tuple, set, frozenset)) and hasattr(obj, "__dict__"):
+        stack.append(vars(obj))
+    total = 0
+    walked = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(list(o.keys()))
+            stack.extend(list(o.values()))
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(list(o))
+        walked += 1
+        if walked % _WALK_CHUNK == 0:
+            await asyncio.sleep(0)
+    return total
+
+
+def rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, KiB on Linux
+    except (ImportError, AttributeError):
+        return None
+
+
+async def memory_report() -> list[tuple[str, int, int]]:
+    """(name, len, approx deep bytes) for every tracked structure, in registration order.
+    An object reachable from several structures is counted under the first one only, so the rows add up."""
+    rows = []
+    seen: set[int] = set()
+    for name, obj in list(MEM_TRACKED.items()):
+        n = len(obj) if hasattr(obj, "__len__") else 0
+        rows.append((name, n, await deep_size(obj, seen)))
+    return rows
+
+
+async def tracemalloc_diff(seconds: float) -> list[str]:
+    """Two snapshots `seconds` apart; top allocation growth by line. Tracing runs only for the window
+    unless it was already on."""
+    import tracemalloc
+    async with _BUSY:
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(1)
+        try:
+            first = tracemalloc.take_snapshot()
+            await asyncio.sleep(seconds)
+            second = tracemalloc.take_snapshot()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    stats = second.filter_traces(filters).compare_to(first.filter_traces(filters), "lineno")
+    grown = [s for s in stats if s.size_diff > 0][:MEM_TOP_LINES]
+    lines = []
+    for s in grown:
+        frame = s.traceback[0]
+        lines.append(f"{s.size_diff / 1024:+10.1f} KiB {s.count_diff:+7d} blk  "
+                     f"{'/'.join(frame.filename.split(os.sep)[-2:])}:{frame.lineno}")
+    return lines
@@ -0,0 +1,257 @@
+﻿import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from contextlib import suppress
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp import web
+
+from app.config import settings
+from app.db.bootstrap import apply_catalog_event, prepare_db, set_catalog_publisher
+from app.db.session import engine
+from app.metrics import Counter
+
+log = logging.getLogger(__name__)
+
+# one update or catalog event per line; a long product description can exceed asyncio's 64 KiB default
+LINE_LIMIT = 16 * 1024 * 1024
+POLL_TIMEOUT_SEC = 30
+
+ROUTED = Counter("shard_updates_total", "Updates the supervisor routed to each worker.", ("worker",))
+RELAYED = Counter("shard_catalog_events_total", "Catalog changes relayed between workers, by operation.", ("op",))
+
+
+def _line(obj: dict) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def shard_of(update: dict, workers: int) -> int:
+    """Worker of a raw update: the sender's id modulo the worker count; updates without a sender go to 0."""
+    for event in update.values():
+        if isinstance(event, dict):
+            user = event.get("from")
+            if user:
+                return user["id"] % workers
+    return 0
+
+
+class Supervisor:
+    """Receives updates (long polling or webhook) and hands each to the worker that owns its user.
+
+    Workers connect back over a localhost TCP socket and exchange JSON lines: `{"update": ...}`
+    goes to a worker, `{"catalog": ...}` comes from one and is relayed to all the others. Any
+    worker exiting stops the whole group, so an outer process manager restarts it consistently.
+    """
+
+    def __init__(self, bot, dp, workers: int):
+        self.bot = bot
+        self.dp = dp
+        self.n = workers
+        self.writers: dict[int, asyncio.StreamWriter] = {}
+        self.all_connected = asyncio.Event()
+        self.stopped = asyncio.Event()
+        self.failed = False  # stopped by a worker rather than by a signal
+        self.procs: list[asyncio.subprocess.Process] = []
+
+    async def _on_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        index = json.loads(await reader.readline())["worker"]
+        self.writers[index] = writer
+        if len(self.writers) == self.n:
+            self.all_connected.set()
+        try:
+            while line := await reader.readline():
+                ev = json.loads(line)["catalog"]
+                RELAYED.inc(ev["op"])
+                for i, w in self.writers.items():
+                    if i != index:
+                        w.write(line)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        if not self.stopped.is_set():
+            log.error("worker %d disconnected", index)
+            self.failed = True
+        self.stopped.set()
+
+    async def _watch(self, index: int, proc: asyncio.subprocess.Process) -> None:
+        code = await proc.wait()
+        if not self.stopped.is_set():
+            log.error("worker %d exited with code %s", index, code)
+            self.failed = True
+        self.stopped.set()
+
+    def route(self, updates: list[dict]) -> None:
+        for u in updates:
+            i = shard_of(u, self.n)
+            ROUTED.inc(str(i))
+            self.writers[i].write(_line({"update": u}))
+
+    async def drain(self) -> None:
+        await asyncio.gather(*(w.drain() for w in self.writers.values()))
+
+    async def _poll(self) -> None:
+        url = self.bot.session.api.api_url(token=self.bot.token, method="getUpdates")
+        allowed = json.dumps(self.dp.resolve_used_update_types())
+        offset = 0
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=POLL_TIMEOUT_SEC + 10)) as http:
+            while not self.stopped.is_set():
+                form = {"offset": str(offset), "timeout": str(POLL_TIMEOUT_SEC), "allowed_updates": allowed}
+                try:
+                    async with http.post(url, data=form) as resp:
+                        body = await resp.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    log.warning("getUpdates failed: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+                if not body.get("ok"):
+                    log.warning("getUpdates: %s", body.get("description"))
+                    await asyncio.sleep((body.get("parameters") or {}).get("retry_after", 1))
+                    continue
+                updates = body["result"]
+                if updates:
+                    self.route(updates)
+                    offset = updates[-1]["update_id"] + 1
+                    await self.drain()
+
+    async def _webhook_view(self, request: web.Request) -> web.Response:
+        if settings.WEBHOOK_SECRET and \
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token") != settings.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        self.route([await request.json()])
+        await self.drain()
+        return web.Response()
+
+    async def _serve_webhook(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post(urlparse(settings.WEBHOOK_URL).path or "/", self._webhook_view)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, settings.WEBHOOK_HOST, settings.WEBHOOK_PORT).start()
+        await self.bot.set_webhook(settings.WEBHOOK_URL, secret_token=settings.WEBHOOK_SECRET or None,
+                                   allowed_updates=self.dp.resolve_used_update_types())
+        return runner
+
+    async def run(self) -> bool:
+        """Runs until a signal or a worker stops the group; False when it was a worker."""
+        await prepare_db()
+        await engine.dispose()  # the supervisor itself does not use the DB
+        server = await asyncio.start_server(self._on_worker, "127.0.0.1", 0, limit=LINE_LIMIT)
+        host, port = server.sockets[0].getsockname()[:2]
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            with suppress(NotImplementedError):
+                loop.add_signal_handler(sig, self.stopped.set)
+
+        watchers = []
+        for i in range(self.n):
+            env = {**os.environ, "SHARD_INDEX": str(i), "SHARD_SUPERVISOR": f"{host}:{port}"}
+            proc = await asyncio.create_subprocess_exec(sys.executable, "-m", "app.main", env=env)
+            self.procs.append(proc)
+            watchers.append(asyncio.create_task(self._watch(i, proc)))
+
+        runner = None
+        receiver = None
+        try:
+            waiters = [asyncio.create_task(self.all_connected.wait()), asyncio.create_task(self.stopped.wait())]
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for t in waiters:
+                t.cancel()
+            if not self.stopped.is_set():
+                log.info("%d workers connected, receiving updates", self.n)
+                if settings.WEBHOOK_URL:
+                    runner = await self._serve_webhook()
+                else:
+                    await self.bot.delete_webhook(drop_pending_updates=False)
+                    receiver = asyncio.create_task(self._poll())
+                await self.stopped.wait()
+        finally:
+            if receiver:
+                receiver.cancel()
+            if runner:
+                await runner.cleanup()
+            for proc in self.procs:
+                if proc.returncode is None:
+                    proc.terminate()
+            for proc in self.procs:
+                with suppress(Exception):
+                    await asyncio.wait_for(proc.wait(), 10)
+                if proc.returncode is None:
+                    proc.kill()
+            for w in watchers:
+                w.cancel()
+            server.close()
+            await self.bot.session.close()
+        return not self.failed
+
+
+_WORKER_CONN: asyncio.StreamWriter | None = None
+_WORKER_STOP: bool | None = None  # None while running, then whether the stop was a failure
+
+
+def stop_worker(failed: bool = False) -> None:
+    """Ends run_worker: closing the connection ends its read loop."""
+    global _WORKER_STOP
+    _WORKER_STOP = failed or bool(_WORKER_STOP)
+    if _WORKER_CONN is not None:
+        _WORKER_CONN.close()
+
+
+async def run_worker(bot, dp, index: int, address: str) -> bool:
+    """Worker side: feeds the updates the supervisor routes here into `dp` and publishes catalog changes.
+
+    Returns False when it stopped on a failure (see stop_worker) or lost the supervisor unasked."""
+    global _WORKER_CONN
+    host, port = address.rsplit(":", 1)
+    reader, writer = await asyncio.open_connection(host, int(port), limit=LINE_LIMIT)
+    _WORKER_CONN = writer
+    writer.write(_line({"worker": index}))
+    set_catalog_publisher(lambda ev: writer.write(_line({"catalog": ev})))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_worker)
+
+    tasks: set[asyncio.Task] = set()
+    # catalog events are applied in order by one consumer, so a "reload" does not hold up the updates
+    events: asyncio.Queue[dict] = asyncio.Queue()
+
+    async def process(update: dict) -> None:
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception:
+            log.exception("update %s failed", update.get("update_id"))
+
+    async def apply_events() -> None:
+        while True:
+            ev = await events.get()
+            try:
+                await apply_catalog_event(ev)
+            except Exception:
+                log.exception("catalog event %s failed", ev.get("op"))
+
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+    applier = asyncio.create_task(apply_events(), name="catalog-events")
+    try:
+        while line := await reader.readline():
+            msg = json.loads(line)
+            if "update" in msg:
+                t = asyncio.create_task(process(msg["update"]))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+            else:
+                events.put_nowait(msg["catalog"])
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        applier.cancel()
+        set_catalog_publisher(None)
+        if tasks:
+            await asyncio.wait(tasks, timeout=10)
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+        await bot.session.close()
+    if _WORKER_STOP is None:
+        log.error("worker %d: supervisor connection lost", index)
+    return _WORKER_STOP is False
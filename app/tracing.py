@@ -0,0 +1,243 @@
+﻿import asyncio
+import functools
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attrs", "start_ns", "t0", "duration_ns", "error")
+
+    def __init__(self, trace: "_Trace", parent_id: str | None, name: str, attrs: dict):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.start_ns = time.time_ns()
+        self.t0 = time.perf_counter_ns()
+        self.duration_ns = 0
+        self.error: str | None = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def as_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": round(self.duration_ns / 1e6, 3),
+            "attrs": self.attrs,
+            "error": self.error,
+        }
+
+
+class _Trace:
+    __slots__ = ("trace_id", "spans", "sampled", "done", "kept")
+
+    def __init__(self, sampled: bool):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.spans: list[Span] = []
+        self.sampled = sampled
+        self.done = False
+        self.kept = False
+
+
+# marks an update that was not sampled, so its statements and API calls don't start traces of their own
+_DROPPED = object()
+_CURRENT: ContextVar = ContextVar("trace_span", default=None)
+# handler label of the update being processed (set by the update middleware), for logs and slow-query records
+CURRENT_HANDLER: ContextVar[str | None] = ContextVar("current_handler", default=None)
+_EXPORTER = None
+
+
+def current_span() -> Span | None:
+    s = _CURRENT.get()
+    return s if isinstance(s, Span) else None
+
+
+def start_span(name: str, attrs: dict | None = None) -> Span | None:
+    """Child of the current span, or the root of a new trace. Does not make itself current."""
+    if _EXPORTER is None:
+        return None
+    parent = _CURRENT.get()
+    if parent is _DROPPED:
+        return None
+    if parent is None:
+        sampled = random.random() < settings.TRACE_SAMPLE_RATE
+        if not sampled and not settings.TRACE_SLOW_MS:
+            return None
+        # unsampled traces are still collected so a slow one can be kept when it ends
+        return Span(_Trace(sampled), None, name, attrs or {})
+    return Span(parent.trace, parent.span_id, name, attrs or {})
+
+
+def end_span(s: Span | None, error: BaseException | None = None) -> None:
+    if s is None:
+        return
+    s.duration_ns = time.perf_counter_ns() - s.t0
+    if error is not None:
+        s.error = f"{type(error).__name__}: {error}"
+    trace = s.trace
+    if trace.done:
+        # finished after its root, e.g. in a task spawned by the handler
+        if trace.kept:
+            _export([s])
+        return
+    trace.spans.append(s)
+    if s.parent_id is None:
+        trace.done = True
+        trace.kept = trace.sampled or s.duration_ns >= settings.TRACE_SLOW_MS * 1_000_000
+        if trace.kept:
+            _export(trace.spans)
+        trace.spans = []
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Span around a block; it is current inside, so nested spans, awaits and create_task see it."""
+    if _EXPORTER is None or _CURRENT.get() is _DROPPED:
+        yield None
+        return
+    s = start_span(name, attrs)
+    token = _CURRENT.set(s if s is not None else _DROPPED)
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _CURRENT.reset(token)
+        end_span(s, error)
+
+
+def traced(name: str):
+    """Decorator for coroutine functions: runs each call inside `span(name)`."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def inner(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def _export(spans: list[Span]) -> None:
+    try:
+        _EXPORTER.export(spans)
+    except Exception:
+        log.exception("trace export failed")
+
+
+class JsonlExporter:
+    """One JSON object per span, appended to a local file."""
+
+    def __init__(self, path: str):
+        self.f = open(path, "a", encoding="utf-8")
+
+    def export(self, spans: list[Span]) -> None:
+        self.f.write("".join(json.dumps(s.as_dict(), ensure_ascii=False, default=str) + "\n" for s in spans))
+        self.f.flush()
+
+    async def close(self) -> None:
+        self.f.close()
+
+
+def _otlp_value(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+class OtlpExporter:
+    """Batches spans and POSTs them as OTLP/HTTP JSON to `<endpoint>/v1/traces`."""
+
+    def __init__(self, endpoint: str, service: str, interval: float = 2.0, max_batch: int = 512):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service = service
+        self.interval = interval
+        self.max_batch = max_batch
+        self.pending: list[Span] = []
+        self.task: asyncio.Task | None = None
+        self.http = None
+
+    def export(self, spans: list[Span]) -> None:
+        self.pending.extend(spans)
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def _payload(self, spans: list[Span]) -> dict:
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service}}]},
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": [{
+                "traceId": s.trace.trace_id,
+                "spanId": s.span_id,
+                **({"parentSpanId": s.parent_id} if s.parent_id else {}),
+                "name": s.name,
+                "kind": 2 if s.parent_id is None else 3,  # SERVER for updates, CLIENT for DB/API calls
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.start_ns + s.duration_ns),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attrs.items()],
+                "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+            } for s in spans]}],
+        }]}
+
+    async def flush(self) -> None:
+        import aiohttp
+        if self.http is None:
+            self.http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            try:
+                async with self.http.post(self.url, json=self._payload(batch)) as resp:
+                    if resp.status >= 300:
+                        log.warning("OTLP export: HTTP %s, %d spans dropped", resp.status, len(batch))
+            except Exception as e:
+                log.warning("OTLP export failed, %d spans dropped: %s", len(batch), e)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+        if self.http:
+            await self.http.close()
+
+
+def setup_tracing():
+    """Install the exporter chosen by TRACE_EXPORTER ("jsonl", "otlp" or empty to disable)."""
+    global _EXPORTER
+    kind = (settings.TRACE_EXPORTER or "").lower()
+    if kind == "jsonl":
+        _EXPORTER = JsonlExporter(settings.TRACE_FILE)
+    elif kind == "otlp":
+        _EXPORTER = OtlpExporter(settings.TRACE_OTLP_ENDPOINT, settings.TRACE_SERVICE_NAME)
+    else:
+        _EXPORTER = None
+    return _EXPORTER
+
+
+async def shutdown_tracing() -> None:
+    global _EXPORTER
+    if _EXPORTER is not None:
+        exporter, _EXPORTER = _EXPORTER, None
+        await exporter.close()
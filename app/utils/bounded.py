@@ -0,0 +1,125 @@
+﻿import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from app.metrics import Counter, Gauge
+
+STATE_ENTRIES = Gauge("bot_state_entries", "Entries in a bounded per-user map.", ("name",))
+STATE_EVICTIONS = Counter("bot_state_evictions_total", "Entries dropped from a bounded map, by reason.",
+                          ("name", "reason"))
+
+_MISSING = object()
+
+
+class BoundedDict(MutableMapping):
+    """Dict with a capacity (least recently used entries go first) and a TTL since last use.
+
+    Reading or writing a key counts as use; `in`, iteration and items() don't. Expired entries are
+    dropped lazily (on access and on every insert, oldest first, so the cost is the number dropped)
+    or by expire(). `on_evict(key, value)` is called for entries dropped by capacity or TTL, not
+    for del/pop. Sizes and evictions are exported as bot_state_entries / bot_state_evictions_total.
+    """
+
+    def __init__(self, name: str, maxlen: int, ttl: float | None = None, on_evict=None):
+        self.name = name
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: OrderedDict = OrderedDict()
+        # key -> time of last use; same order as _data
+        self._used: dict = {}
+
+    def _expired(self, key, now: float) -> bool:
+        return self.ttl is not None and now - self._used[key] > self.ttl
+
+    def _evict(self, key, reason: str) -> None:
+        value = self._data.pop(key)
+        del self._used[key]
+        STATE_EVICTIONS.inc(self.name, reason)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def _sized(self) -> None:
+        STATE_ENTRIES.set(len(self._data), self.name)
+
+    def expire(self) -> int:
+        """Drop every expired entry; returns how many."""
+        n = 0
+        if self.ttl is not None:
+            now = time.monotonic()
+            while self._data:
+                key = next(iter(self._data))
+                if not self._expired(key, now):
+                    break
+                self._evict(key, "ttl")
+                n += 1
+            if n:
+                self._sized()
+        return n
+
+    def __getitem__(self, key):
+        value = self._data.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        now = time.monotonic()
+        if self._expired(key, now):
+            self._evict(key, "ttl")
+            self._sized()
+            raise KeyError(key)
+        self._data.move_to_end(key)
+        del self._used[key]
+        self._used[key] = now
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        new = key not in self._data
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self._used.pop(key, None)
+        self._used[key] = time.monotonic()
+        if new:
+            self.expire()
+            while len(self._data) > self.maxlen:
+                self._evict(next(iter(self._data)), "capacity")
+            self._sized()
+
+    def __delitem__(self, key) -> None:
+        del self._data[key]
+        del self._used[key]
+        self._sized()
+
+    def __contains__(self, key) -> bool:
+        return key in self._data and not self._expired(key, time.monotonic())
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=_MISSING):
+        if key in self._data:
+            del self._used[key]
+            value = self._data.pop(key)
+            self._sized()
+            return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def items(self):
+        return self._data.items()
+
+    def values(self):
+        return self._data.values()
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._used.clear()
+        self._sized()
@@ -1,5 +1,6 @@
 ﻿import re
 import unicodedata
+from functools import lru_cache
 
 TR = {
     "а":"a","б":"b","в":"v","г":"g","д":"d","е":"e","ё":"e","ж":"zh","з":"z","и":"i","й":"i",
@@ -7,10 +8,31 @@ TR = {
     "х":"h","ц":"c","ч":"ch","ш":"sh","щ":"sch","ъ":"","ы":"y","ь":"","э":"e","ю":"yu","я":"ya"
 }
 
-def slugify_ru(text: str) -> str:
-    t = text.strip().lower()
-    t = "".join(TR.get(ch, ch) for ch in t)
+# other spellings people type in latin: "kholodny", "tsitrin", "yashma", ...
+TR_ALT = {**TR, "ё":"yo","й":"y","х":"kh","ц":"ts","щ":"shch","ю":"iu","я":"ia"}
+
+_TR_TABLE = str.maketrans(TR)
+_TR_ALT_TABLE = str.maketrans(TR_ALT)
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def _slug(text: str, table: dict) -> str:
+    t = text.strip().lower().translate(table)
     t = unicodedata.normalize("NFKD", t)
-    t = re.sub(r"[^a-z0-9]+", "-", t)
-    t = re.sub(r"-{2,}", "-", t).strip("-")
+    t = _NON_ALNUM.sub("-", t).strip("-")
     return t or "x"
+
+
+@lru_cache(maxsize=4096)
+def slugify_ru(text: str) -> str:
+    return _slug(text, _TR_TABLE)
+
+
+def normalize_term(text: str) -> str:
+    return " ".join(text.lower().replace("ё", "е").split())
+
+
+def term_variants(text: str) -> list[str]:
+    """Every spelling of a category/stone name that should resolve to it."""
+    variants = [normalize_term(text), slugify_ru(text), _slug(text, _TR_ALT_TABLE)]
+    return list(dict.fromkeys(v for v in variants if v and v != "x"))
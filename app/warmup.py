@@ -0,0 +1,63 @@
+﻿import asyncio
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, InlineQuery, Message
+
+from app.config import settings
+from app.metrics import Counter, Histogram, mark_startup
+
+LOADING_TEXT = "Каталог обновляется, попробуйте через минуту."
+
+# set once the first catalog load has finished; polling starts before that
+CATALOG_READY = asyncio.Event()
+
+CATALOG_WAIT = Histogram("bot_catalog_wait_seconds", "Time an update waited for the startup catalog load.")
+CATALOG_NOT_READY = Counter("bot_catalog_not_ready_total",
+                            "Updates answered with 'catalog is loading' because the startup load took too long.")
+
+
+def catalog_loaded() -> None:
+    CATALOG_READY.set()
+    mark_startup("catalog_ready")
+
+
+async def wait_catalog(timeout: float | None) -> bool:
+    """True once the catalog is loaded, False if it still isn't after `timeout` seconds (None waits for ever)."""
+    if CATALOG_READY.is_set():
+        return True
+    t0 = time.perf_counter()
+    try:
+        await asyncio.wait_for(CATALOG_READY.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        CATALOG_WAIT.observe(time.perf_counter() - t0)
+
+
+class CatalogGate(BaseMiddleware):
+    """Inner middleware for handlers that read the in-memory catalog.
+
+    Until the startup load finishes, matched updates wait up to CATALOG_WAIT_TIMEOUT_SEC and then
+    get LOADING_TEXT. Events for which `is_static(event)` is true run at once; a successful
+    payment waits for as long as it takes, it must not be dropped.
+    """
+
+    def __init__(self, is_static=None):
+        self.is_static = is_static
+
+    async def __call__(self, handler, event, data: dict):
+        if CATALOG_READY.is_set() or (self.is_static is not None and self.is_static(event)):
+            return await handler(event, data)
+        payment = isinstance(event, Message) and event.successful_payment is not None
+        if await wait_catalog(None if payment else settings.CATALOG_WAIT_TIMEOUT_SEC):
+            return await handler(event, data)
+
+        CATALOG_NOT_READY.inc()
+        if isinstance(event, CallbackQuery):
+            return await event.answer(LOADING_TEXT)
+        if isinstance(event, InlineQuery):
+            return await event.answer([], cache_time=1, is_personal=True)
+        if isinstance(event, Message):
+            return await event.answer(LOADING_TEXT)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from app.config import settings
+from app.metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+STACK_LIMIT = 30
+
+LOOP_LAG = Histogram("event_loop_lag_seconds", "Delay between when the watchdog tick was due and when it ran.",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+LOOP_STALLS = Counter("event_loop_stalls_total", "Times the loop was blocked longer than LOOP_LAG_THRESHOLD_MS.")
+
+
+class LoopWatchdog:
+    """A loop task ticks every `interval` and records how late each tick ran. A helper thread watches
+    the last tick; once the loop has been silent longer than `threshold` it logs the loop thread's stack,
+    i.e. the code that is blocking right now, not the code that runs after the stall."""
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_tick = time.monotonic()
+        self.loop_thread_id = threading.get_ident()
+        self.stop_event = threading.Event()
+        self.task: asyncio.Task | None = None
+        self.thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self._tick(), name="loop-watchdog")
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    async def stop(self) -> None:
+        self.stop_event.set()
+        if self.task:
+            self.task.cancel()
+        if self.thread:
+            await asyncio.to_thread(self.thread.join)
+
+    async def _tick(self) -> None:
+        while True:
+            due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_tick = now
+            lag = max(0.0, now - due)
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                LOOP_STALLS.inc()
+                log.warning("event loop was blocked for %.0f ms", lag * 1000)
+
+    def _watch(self) -> None:
+        reported_tick = None
+        while not self.stop_event.wait(self.interval):
+            tick = self.last_tick
+            silent = time.monotonic() - tick
+            if silent < self.interval + self.threshold or tick == reported_tick:
+                continue
+            reported_tick = tick  # one stack per stall
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT))
+            log.warning("event loop blocked for %.0f ms so far, loop thread stack:\n%s", silent * 1000, stack)
+
+
+_WATCHDOG: LoopWatchdog | None = None
+
+
+def start_loop_watchdog() -> LoopWatchdog | None:
+    """Starts the watchdog unless LOOP_LAG_THRESHOLD_MS is 0; call from inside the running loop."""
+    global _WATCHDOG
+    if not settings.LOOP_LAG_THRESHOLD_MS:
+        return None
+    _WATCHDOG = LoopWatchdog(settings.LOOP_WATCHDOG_INTERVAL_MS / 1000, settings.LOOP_LAG_THRESHOLD_MS / 1000)
+    _WATCHDOG.start()
+    return _WATCHDOG
+
+
+async def stop_loop_watchdog() -> None:
+    global _WATCHDOG
+    if _WATCHDOG is not None:
+        wd, _WATCHDOG = _WATCHDOG, None
+        await wd.stop()
@@ -0,0 +1,96 @@
+"""
+Cart aggregates: walking the lines on every read vs. the running totals of `app.data.cart.Cart`.
+
+    python -m bench.cart --lines 1 10 100 1000 --iterations 20000
+
+For every cart size N a cart with N distinct products is built both as a plain
+{pid: qty} dict and as a `Cart`. Reported is µs per call of what the handlers
+do: the badge count on every product card, the totals of the cart screen and
+checkout, an add + remove pair, and the first totals read after a price change
+of one product in the cart (the only read that walks the lines).
+"""
+import argparse
+import time
+
+from app.data.catalog import PRODUCTS_BY_ID
+
+
+def seed(n: int) -> list[int]:
+    PRODUCTS_BY_ID.clear()
+    for pid in range(1, n + 2):
+        PRODUCTS_BY_ID[pid] = {"id": pid, "title": f"Изделие {pid}", "price": 500 + pid, "stock": 10}
+    return list(range(1, n + 1))
+
+
+def walk_count(lines: dict) -> int:
+    return sum(lines.values())
+
+
+def walk_totals(lines: dict) -> tuple[int, int]:
+    qty = total = 0
+    for pid, n in lines.items():
+        p = PRODUCTS_BY_ID.get(pid)
+        if p:
+            qty += n
+            total += p["price"] * n
+    return qty, total
+
+
+def per_call(fn, iterations: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - t0) / iterations * 1e6
+
+
+def measure(n: int, iterations: int) -> dict:
+    from app.data.cart import Cart, price_changed
+
+    pids = seed(n)
+    extra = n + 1
+    lines = {pid: 2 for pid in pids}
+    cart = Cart()
+    for pid in pids:
+        cart.add(pid, 2)
+    assert (cart.count, cart.total_qty, cart.total) == (walk_count(lines), *walk_totals(lines))
+
+    def dict_add_remove():
+        lines[extra] = lines.get(extra, 0) + 1
+        del lines[extra]
+
+    def cart_add_remove():
+        cart.add(extra)
+        cart.remove(extra)
+
+    item = PRODUCTS_BY_ID[pids[0]]
+
+    def reprice():
+        item["price"] += 1
+        price_changed(item["id"])
+        return cart.total
+
+    out = {
+        "badge": (per_call(lambda: walk_count(lines), iterations), per_call(lambda: cart.count, iterations)),
+        "totals": (per_call(lambda: walk_totals(lines), iterations), per_call(lambda: cart.total, iterations)),
+        "add+remove": (per_call(dict_add_remove, iterations), per_call(cart_add_remove, iterations)),
+        "reprice+totals": (per_call(lambda: (walk_totals(lines), item.update(price=item["price"] + 1)), iterations),
+                           per_call(reprice, iterations)),
+    }
+    assert cart.total == walk_totals(lines)[1]
+    cart.clear()
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--lines", type=int, nargs="+", default=[1, 10, 100, 1000])
+    ap.add_argument("--iterations", type=int, default=20000)
+    args = ap.parse_args()
+    print(f"{'lines':>6}  {'operation':<15} {'walk':>9} {'Cart':>9}  (µs/call)")
+    for n in args.lines:
+        for op, (walk, agg) in measure(n, args.iterations).items():
+            print(f"{n:>6}  {op:<15} {walk:>9.3f} {agg:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
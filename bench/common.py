@@ -0,0 +1,60 @@
+import os
+import random
+import tempfile
+from pathlib import Path
+
+
+def setup_env(db_url: str | None = None) -> str:
+    """Must run before anything from `app` is imported: settings are read at import time."""
+    if not db_url:
+        db_url = f"sqlite+aiosqlite:///{Path(tempfile.mkdtemp()) / 'bench.db'}"
+    os.environ.setdefault("BOT_TOKEN", "000:BENCH")
+    os.environ["DATABASE_URL"] = db_url
+    os.environ.setdefault("ADMIN_IDS", "1")
+    return db_url
+
+
+CAT_WORDS = ["браслеты", "колье", "серьги", "кольца", "подвески", "чокеры", "броши", "анклеты"]
+STONE_WORDS = ["аметист", "цитрин", "агат", "кварц", "яшма", "оникс", "гранат", "лазурит", "малахит", "турмалин"]
+
+
+def category_names(n: int) -> list[str]:
+    return [CAT_WORDS[i % len(CAT_WORDS)] + ("" if i < len(CAT_WORDS) else f" {i}") for i in range(n)]
+
+
+def stone_names(n: int) -> list[str]:
+    return [STONE_WORDS[i % len(STONE_WORDS)] + ("" if i < len(STONE_WORDS) else f" {i}") for i in range(n)]
+
+
+async def seed_catalog(engine, n_products: int, n_categories: int = 20, n_stones: int = 40,
+                       seed: int = 0, batch: int = 10_000) -> None:
+    """Bulk-insert a synthetic catalog straight through Core, bypassing the handlers."""
+    from sqlalchemy import insert
+    from app.db.models import Category, Stone, Product
+    from app.utils.slug import slugify_ru
+
+    rnd = random.Random(seed)
+    cats = category_names(n_categories)
+    stns = stone_names(n_stones)
+
+    async with engine.begin() as conn:
+        await conn.execute(insert(Category), [
+            {"id": i + 1, "code": slugify_ru(name), "name_ru": name} for i, name in enumerate(cats)
+        ])
+        await conn.execute(insert(Stone), [
+            {"id": i + 1, "code": slugify_ru(name), "name_ru": name} for i, name in enumerate(stns)
+        ])
+        for start in range(0, n_products, batch):
+            rows = []
+            for pid in range(start + 1, min(start + batch, n_products) + 1):
+                rows.append({
+                    "id": pid,
+                    "title": f"Изделие {pid}",
+                    "price": rnd.randrange(500, 20_000, 10),
+                    "stock": rnd.randrange(0, 10),
+                    "description": f"Описание изделия {pid}",
+                    "photos": [f"photo-{pid}-{k}" for k in range(rnd.randrange(0, 4))],
+                    "category_id": rnd.randrange(n_categories) + 1,
+                    "stone_id": rnd.randrange(n_stones) + 1,
+                })
+            await conn.execute(insert(Product), rows)
@@ -0,0 +1,139 @@
+"""
+Compare DB_ENGINE_PROFILE=default against DB_ENGINE_PROFILE=tuned on the catalog
+and checkout paths.
+
+    python -m bench.engine_profiles                   # fresh SQLite file per profile
+    python -m bench.engine_profiles --url postgresql+asyncpg://user:pw@host/empty_db
+
+catalog  - the reads of load_catalog_to_memory() plus the cb_catalog1/cb_catalog2 label lookups
+checkout - the on_success_payment() transaction (order + items + stock update), run concurrently
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from bench.common import setup_env, seed_catalog
+
+
+def percentile(xs: list[float], q: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else 0.0
+
+
+def summary(samples: list[float], wall: float) -> dict:
+    return {
+        "ops": len(samples),
+        "ops_per_sec": round(len(samples) / wall, 1) if wall else 0.0,
+        "p50_ms": round(statistics.median(samples) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+    }
+
+
+async def catalog_path(Session, rounds: int) -> dict:
+    from sqlalchemy import select
+    from app.db.models import Category, Stone, Product
+
+    samples = []
+    t_all = time.perf_counter()
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        async with Session() as s:
+            cats = (await s.execute(select(Category))).scalars().all()
+            stns = (await s.execute(select(Stone))).scalars().all()
+            (await s.execute(select(Product))).scalars().all()
+            await s.execute(select(Category.code, Category.name_ru).where(Category.code.in_([c.code for c in cats])))
+            await s.execute(select(Stone.code, Stone.name_ru).where(Stone.code.in_([x.code for x in stns])))
+        samples.append(time.perf_counter() - t0)
+    return summary(samples, time.perf_counter() - t_all)
+
+
+async def checkout_path(Session, n_orders: int, concurrency: int, n_products: int) -> dict:
+    from app.db.models import Product, Order, OrderItem, OrderStatus
+
+    rnd = random.Random(1)
+    samples, errors = [], {}
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                async with Session() as s:
+                    order = Order(user_id=i, chat_id=i, currency="RUB", total_amount=0,
+                                  payload=f"bench-{i}", status=OrderStatus.paid)
+                    s.add(order)
+                    await s.flush()
+                    for pid in rnd.sample(range(1, n_products + 1), 3):
+                        p = await s.get(Product, pid)
+                        s.add(OrderItem(order_id=order.id, product_id=pid, title=p.title,
+                                        price=p.price * 100, qty=1, photos=[]))
+                        p.stock = max(0, p.stock - 1)
+                    await s.commit()
+            except Exception as e:
+                key = type(getattr(e, "orig", None) or e).__name__
+                errors[key] = errors.get(key, 0) + 1
+                return
+            samples.append(time.perf_counter() - t0)
+
+    t_all = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n_orders)))
+    res = summary(samples, time.perf_counter() - t_all)
+    res["errors"] = errors
+    return res
+
+
+async def bench_profile(url: str | None, profile: str, a) -> dict:
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    from app.db.models import Base
+    from app.db.session import make_engine
+
+    if url is None:
+        url = setup_env(None)
+    engine = make_engine(url, profile)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    await seed_catalog(engine, a.products)
+
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+    try:
+        return {
+            "catalog": await catalog_path(Session, a.catalog_rounds),
+            "checkout": await checkout_path(Session, a.orders, a.concurrency, a.products),
+        }
+    finally:
+        await engine.dispose()
+
+
+async def run(a) -> dict:
+    setup_env(a.url)
+    results = {}
+    for profile in ("default", "tuned"):
+        results[profile] = await bench_profile(a.url, profile, a)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", help="empty database, dropped and re-seeded per profile (default: temporary SQLite)")
+    ap.add_argument("--products", type=int, default=20_000)
+    ap.add_argument("--catalog-rounds", type=int, default=20)
+    ap.add_argument("--orders", type=int, default=2_000)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--out", help="write results as JSON")
+    a = ap.parse_args()
+
+    results = asyncio.run(run(a))
+    for profile, res in results.items():
+        for path, r in res.items():
+            print(f"{profile:8} {path:9} " + "  ".join(f"{k}={v}" for k, v in r.items()))
+    if a.out:
+        with open(a.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
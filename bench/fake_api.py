@@ -0,0 +1,200 @@
+"""
+Local aiohttp stand-in for the Telegram Bot API, used by bench.loadtest.
+
+Implements getUpdates (long polling over an in-memory queue), sendMessage,
+sendPhoto, editMessageText, editMessageMedia, editMessageReplyMarkup,
+answerCallbackQuery, deleteMessage, getMe and deleteWebhook. Every other
+method answers `true`. Latency and 429 responses are injected per call.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+BOT_ID = 42
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "editMessageText", "editMessageMedia",
+                   "editMessageReplyMarkup", "editMessageCaption"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, rate_429: float = 0.0,
+                 retry_after: int = 1, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rnd = random.Random(seed)
+
+        self.updates: list[dict] = []
+        self.new_update = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+
+        self.calls: Counter[str] = Counter()
+        self.throttled: Counter[str] = Counter()
+        self.calls_by_chat: Counter[int] = Counter()
+        # chat_id -> latest bot message: {"message_id", "photo", "reply_markup"}
+        self.screens: dict[int, dict] = {}
+        # chat_id -> [(kind, future)]: "message" resolves on the next send*, "callback" on answerCallbackQuery
+        self.waiters: dict[int, list[tuple[str, asyncio.Future]]] = defaultdict(list)
+        self.callback_chat: dict[str, int] = {}
+
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner: web.AppRunner | None = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+
+    # ---- simulated users --------------------------------------------------------
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def _push(self, update: dict) -> None:
+        update["update_id"] = next(self.update_ids)
+        self.updates.append(update)
+        self.new_update.set()
+
+    def _wait_reply(self, chat_id: int, kind: str) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id].append((kind, fut))
+        return fut
+
+    def send_text(self, uid: int, text: str) -> asyncio.Future:
+        fut = self._wait_reply(uid, "message")
+        self._push({"message": {
+            "message_id": next(self.message_ids), "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"}, "from": self._user(uid), "text": text,
+        }})
+        return fut
+
+    def press(self, uid: int, data: str) -> asyncio.Future:
+        screen = self.screens.get(uid, {})
+        message = {
+            "message_id": screen.get("message_id") or next(self.message_ids), "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"}, "from": {"id": BOT_ID, "is_bot": True, "first_name": "Shop"},
+        }
+        if screen.get("photo"):
+            message["photo"] = [{"file_id": "ph", "file_unique_id": "ph", "width": 1, "height": 1}]
+        else:
+            message["text"] = "…"
+        cq_id = f"cq{next(self.callback_ids)}"
+        self.callback_chat[cq_id] = uid
+        fut = self._wait_reply(uid, "callback")
+        self._push({"callback_query": {
+            "id": cq_id, "from": self._user(uid), "chat_instance": "load", "data": data, "message": message,
+        }})
+        return fut
+
+    def buttons(self, uid: int) -> list[str]:
+        markup = self.screens.get(uid, {}).get("reply_markup") or {}
+        return [b.get("callback_data") for row in markup.get("inline_keyboard", []) for b in row
+                if b.get("callback_data")]
+
+    # ---- Bot API ----------------------------------------------------------------
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            return await self._get_updates(params)
+
+        if self.latency_ms or self.jitter_ms:
+            await asyncio.sleep((self.latency_ms + self.rnd.uniform(0, self.jitter_ms)) / 1000)
+        if self.rate_429 and self.rnd.random() < self.rate_429:
+            self.throttled[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        if method == "getMe":
+            return self._ok({"id": BOT_ID, "is_bot": True, "first_name": "Shop", "username": "shop_load_bot"})
+
+        if method == "answerCallbackQuery":
+            chat_id = self.callback_chat.pop(params.get("callback_query_id", ""), None)
+            if chat_id is not None:
+                self.calls_by_chat[chat_id] += 1
+                self._resolve(chat_id, "callback")
+            return self._ok(True)
+
+        chat_id = int(params["chat_id"]) if params.get("chat_id", "").lstrip("-").isdigit() else None
+        if chat_id is not None:
+            self.calls_by_chat[chat_id] += 1
+
+        if method in MESSAGE_METHODS and chat_id is not None:
+            return self._ok(self._message_result(method, chat_id, params))
+        return self._ok(True)
+
+    def _message_result(self, method: str, chat_id: int, params: dict) -> dict:
+        screen = self.screens.setdefault(chat_id, {})
+        if method.startswith("send"):
+            screen["message_id"] = next(self.message_ids)
+            screen["photo"] = method == "sendPhoto"
+        elif method == "editMessageMedia":
+            screen["photo"] = True
+        if "reply_markup" in params:
+            screen["reply_markup"] = json.loads(params["reply_markup"])
+        elif method != "editMessageReplyMarkup":
+            screen["reply_markup"] = None
+
+        if method.startswith("send"):
+            # commands and text input are answered with a new message
+            self._resolve(chat_id, "message")
+
+        result = {"message_id": screen["message_id"], "date": int(time.time()),
+                  "chat": {"id": chat_id, "type": "private"}}
+        if screen.get("photo"):
+            result["photo"] = [{"file_id": "ph", "file_unique_id": "ph", "width": 1, "height": 1}]
+        else:
+            result["text"] = params.get("text", "")
+        return result
+
+    def _resolve(self, chat_id: int, kind: str) -> None:
+        waiters = self.waiters.get(chat_id) or []
+        for i, (k, fut) in enumerate(waiters):
+            if k == kind:
+                del waiters[i]
+                if not fut.done():
+                    fut.set_result(time.perf_counter())
+                return
+
+    async def _get_updates(self, params: dict) -> web.Response:
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        if offset:
+            # everything below offset is confirmed by the bot
+            drop = 0
+            while drop < len(self.updates) and self.updates[drop]["update_id"] < offset:
+                drop += 1
+            del self.updates[:drop]
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self._ok(self.updates[:limit])
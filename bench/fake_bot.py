@@ -0,0 +1,90 @@
+"""In-process stand-in for the Bot API: no network, answers every method with a plausible result."""
+import datetime as dt
+import itertools
+from collections import Counter
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.types import (
+    CallbackQuery, Chat, Message, PhotoSize, Update, User,
+)
+
+BOT_USER = User(id=42, is_bot=True, first_name="Shop", username="shop_bench_bot")
+_MESSAGE_RESULTS = {
+    "SendMessage", "SendPhoto", "EditMessageText", "EditMessageMedia",
+    "EditMessageReplyMarkup", "EditMessageCaption",
+}
+
+
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.calls: Counter[str] = Counter()
+        self._ids = itertools.count(1_000_000)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        if name == "GetMe":
+            return BOT_USER
+        if name in _MESSAGE_RESULTS:
+            chat_id = getattr(method, "chat_id", None) or 1
+            return Message(
+                message_id=next(self._ids),
+                date=dt.datetime.now(dt.timezone.utc),
+                chat=Chat(id=int(chat_id), type="private"),
+                text=getattr(method, "text", None) or "",
+            )
+        if name == "SendMediaGroup":
+            return []
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+
+def make_bot() -> tuple[Bot, FakeSession]:
+    session = FakeSession()
+    bot = Bot(token="42:BENCH", session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    return bot, session
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def user(uid: int) -> User:
+    return User(id=uid, is_bot=False, first_name=f"User{uid}", username=f"user{uid}")
+
+
+def _message(uid: int, text: str | None = None, photo: bool = False) -> Message:
+    return Message(
+        message_id=next(_message_ids),
+        date=dt.datetime.now(dt.timezone.utc),
+        chat=Chat(id=uid, type="private"),
+        from_user=user(uid),
+        text=None if photo else (text if text is not None else "…"),
+        photo=[PhotoSize(file_id="ph", file_unique_id="ph", width=1, height=1)] if photo else None,
+        caption=text if photo else None,
+    )
+
+
+def callback_update(uid: int, data: str, photo: bool = False) -> Update:
+    return Update(
+        update_id=next(_update_ids),
+        callback_query=CallbackQuery(
+            id=str(next(_update_ids)),
+            from_user=user(uid),
+            chat_instance="bench",
+            message=_message(uid, photo=photo),
+            data=data,
+        ),
+    )
+
+
+def message_update(uid: int, text: str) -> Update:
+    return Update(update_id=next(_update_ids), message=_message(uid, text))
@@ -0,0 +1,186 @@
+"""
+Per-handler microbenchmarks through the real Dispatcher/router with a fake Bot session.
+
+    python -m bench.handlers --sizes 1000 10000 100000 --out bench_handlers.json
+    python -m bench.handlers --sizes 1000 --compare bench_handlers.json
+
+For every catalog size a synthetic catalog is seeded into a temporary SQLite
+database and loaded into memory, then fake updates are fed through
+`dp.feed_update`. Reports p50/p99 latency per handler and, from a separate
+tracemalloc pass, the peak and retained allocations per update.
+"""
+import argparse
+import asyncio
+import datetime as dt
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from bench.common import setup_env, seed_catalog
+
+ADMIN_ID = 1
+
+
+def percentile(xs: list[float], q: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else 0.0
+
+
+def scenarios(rnd: random.Random, iterations: int):
+    """handler name -> (number of updates, factory(i) -> Update)."""
+    from bench.fake_bot import callback_update, message_update
+    from app.data.catalog import PRODUCTS, PRODUCTS_BY_ID
+    from app.handlers.callbacks import group_ids
+    from app.handlers.cbdata import Catalog2, ProductAdd, ProductOpen
+
+    keys = [group_ids(c, s) for c, s in sorted(PRODUCTS)]
+    cats = sorted({c for c, _ in keys})
+    pids = list(PRODUCTS_BY_ID)
+    shoppers = list(range(1000, 1000 + max(10, iterations // 10)))
+
+    def add(uid, pid):
+        # with the product's current version, or the handler only re-renders the card as stale
+        return callback_update(uid, ProductAdd(pid=pid, ver=PRODUCTS_BY_ID[pid]["ver"]).pack())
+
+    def group(i):
+        cat, stone = keys[rnd.randrange(len(keys))]
+        return ProductOpen(cat=cat, stone=stone).pack()
+
+    return {
+        "cb_catalog1": (iterations, lambda i: callback_update(rnd.choice(shoppers), "catalog1|open|")),
+        "cb_catalog2": (iterations, lambda i: callback_update(rnd.choice(shoppers), Catalog2(cat=rnd.choice(cats)).pack())),
+        "render_product_screen": (iterations, lambda i: callback_update(
+            shoppers[i % len(shoppers)], group(i), photo=bool(i % 2))),
+        "cb_product_add": (iterations, lambda i: add(shoppers[i % len(shoppers)], rnd.choice(pids))),
+        "render_cart": (iterations, lambda i: callback_update(shoppers[i % len(shoppers)], "cart|open|")),
+        "admin_set": (max(3, iterations // 20), lambda i: message_update(
+            ADMIN_ID, f"/set {rnd.choice(pids)} price {rnd.randrange(500, 9000)}")),
+    }
+
+
+async def run_size(dp, bot, n_products: int, iterations: int, seed: int) -> dict:
+    from app.db.session import engine
+    from app.db.models import Base
+    from app.db.bootstrap import init_db, load_catalog_to_memory
+    from app.handlers import callbacks
+    from app.warmup import catalog_loaded
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await init_db()
+    await seed_catalog(engine, n_products, n_categories=max(5, n_products // 2000),
+                       n_stones=max(10, n_products // 1000), seed=seed)
+    t0 = time.perf_counter()
+    await load_catalog_to_memory()
+    load_s = time.perf_counter() - t0
+    catalog_loaded()
+    for uid in list(callbacks.CART):
+        callbacks.clear_cart(uid)
+    for state in (callbacks.CART_META, callbacks.USER_CTX):
+        state.clear()
+
+    results = {"load_catalog_s": round(load_s, 3)}
+    for name, (n, make) in scenarios(random.Random(seed), iterations).items():
+        updates = [make(i) for i in range(n)]
+        alloc_updates = [make(i) for i in range(max(3, n // 5))]
+
+        latencies, errors = [], 0
+        for upd in updates:
+            t0 = time.perf_counter()
+            try:
+                await dp.feed_update(bot, upd)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - t0)
+
+        peaks, retained = [], []
+        tracemalloc.start()
+        for upd in alloc_updates:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            try:
+                await dp.feed_update(bot, upd)
+            except Exception:
+                errors += 1
+            cur, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(cur - before)
+        tracemalloc.stop()
+
+        results[name] = {
+            "n": len(latencies),
+            "p50_ms": round(statistics.median(latencies) * 1e3, 4),
+            "p99_ms": round(percentile(latencies, 0.99) * 1e3, 4),
+            "alloc_peak_kb": round(statistics.mean(peaks) / 1024, 2),
+            "alloc_retained_kb": round(statistics.mean(retained) / 1024, 2),
+            "errors": errors,
+        }
+    return results
+
+
+async def run(sizes: list[int], iterations: int, seed: int) -> dict:
+    setup_env(None)
+    import aiogram
+    from bench.fake_bot import make_bot
+    from app.main import dp
+
+    bot, session = make_bot()
+    out = {
+        "meta": {
+            "date": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "aiogram": aiogram.__version__,
+            "iterations": iterations,
+            "seed": seed,
+        },
+        "results": {},
+    }
+    for n in sizes:
+        out["results"][str(n)] = await run_size(dp, bot, n, iterations, seed)
+    out["meta"]["api_calls"] = dict(session.calls)
+    return out
+
+
+def print_report(data: dict, baseline: dict | None = None) -> None:
+    for size, res in data["results"].items():
+        print(f"\n== {size} products (catalog load {res['load_catalog_s']} s)")
+        base = ((baseline or {}).get("results") or {}).get(size, {})
+        for name, r in res.items():
+            if not isinstance(r, dict):
+                continue
+            line = (f"{name:24} p50={r['p50_ms']:9.3f} ms  p99={r['p99_ms']:9.3f} ms  "
+                    f"peak={r['alloc_peak_kb']:9.1f} KiB  kept={r['alloc_retained_kb']:7.1f} KiB")
+            if r["errors"]:
+                line += f"  errors={r['errors']}"
+            if name in base and base[name]["p50_ms"]:
+                line += f"  p50 x{r['p50_ms'] / base[name]['p50_ms']:.2f} vs baseline"
+            print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    ap.add_argument("--iterations", type=int, default=300)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="write results as JSON")
+    ap.add_argument("--compare", help="earlier JSON results to compare p50 against")
+    a = ap.parse_args()
+
+    data = asyncio.run(run(a.sizes, a.iterations, a.seed))
+    baseline = None
+    if a.compare:
+        with open(a.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(data, baseline)
+    if a.out:
+        with open(a.out, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
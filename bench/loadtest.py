@@ -0,0 +1,243 @@
+"""
+End-to-end load test: the real bot process polls a local fake Bot API.
+
+    python -m bench.loadtest --users 2000 --products 20000
+    python -m bench.loadtest --users 500 --latency-ms 30 --jitter-ms 20 --rate-429 0.01 --out load.json
+    python -m bench.loadtest --users 2000 --workers 4     # sharded: compare actions/s with --workers 1
+
+A synthetic catalog is seeded into a temporary SQLite database, then
+`python -m app.main` is started with BOT_API_URL pointing at bench.fake_api.
+Every simulated shopper sends /start, browses categories and products, adds
+items to the cart, fills in delivery and pays with the mock payment, waiting
+for the bot's reply (the answerCallbackQuery, or the new message for text
+input) before the next action. Reports throughput, latency per action and the
+number of Bot API calls each action cost.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+
+from bench.common import setup_env, seed_catalog
+from bench.fake_api import FakeBotAPI
+
+TOKEN = "42:LOADTEST"
+
+
+def percentile(xs: list[float], q: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else 0.0
+
+
+def action_name(data: str) -> str:
+    """`product|open|3:7` -> `product|open`; commands and text input are passed already named."""
+    return "|".join(data.split("|")[:2])
+
+
+class Shopper:
+    def __init__(self, api: FakeBotAPI, uid: int, rnd: random.Random, stats: "Stats",
+                 think_ms: float, timeout: float):
+        self.api, self.uid, self.rnd, self.stats = api, uid, rnd, stats
+        self.think_ms, self.timeout = think_ms, timeout
+
+    async def _do(self, name: str, fut: asyncio.Future) -> bool:
+        t0 = time.perf_counter()
+        calls_before = self.api.calls_by_chat[self.uid]
+        try:
+            done = await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts[name] += 1
+            return False
+        # let the handler finish the rest of its calls before counting them
+        await asyncio.sleep(0)
+        self.stats.latency[name].append(done - t0)
+        self.stats.api_calls[name].append(self.api.calls_by_chat[self.uid] - calls_before)
+        if self.think_ms:
+            await asyncio.sleep(self.rnd.expovariate(1000 / self.think_ms))
+        return True
+
+    def _pick(self, prefix: str) -> str | None:
+        options = [d for d in self.api.buttons(self.uid) if d.startswith(prefix)]
+        return self.rnd.choice(options) if options else None
+
+    async def text(self, name: str, text: str) -> bool:
+        return await self._do(name, self.api.send_text(self.uid, text))
+
+    async def press(self, data: str) -> bool:
+        return await self._do(action_name(data), self.api.press(self.uid, data))
+
+    async def press_any(self, prefix: str) -> bool:
+        data = self._pick(prefix)
+        return bool(data) and await self.press(data)
+
+    async def run(self, pay: bool) -> None:
+        if not await self.text("/start", "/start"):
+            return
+        added = 0
+        for _ in range(self.rnd.randint(1, 3)):
+            if not (await self.press("catalog1|open|") and await self.press_any("catalog2|open|")
+                    and await self.press_any("product|open|")):
+                return
+            for _ in range(self.rnd.randint(0, 4)):
+                if not await self.press_any("product|nav|"):
+                    break
+            if self.rnd.random() < 0.7 and await self.press_any("product|add|"):
+                added += 1
+        if not (await self.press("cart|open|") and added and pay):
+            return
+
+        steps = [
+            ("delivery|open|", None),
+            (f"delivery|form|{self.rnd.choice(['cdek', 'yandex', 'post'])}", None),
+            ("delivery|ask_phone|", f"+7 900 {self.uid % 10_000_000:07d}"),
+            ("delivery|ask_email|", f"user{self.uid}@example.com"),
+            ("delivery|ask_address|", "Москва, ПВЗ 123"),
+        ]
+        for data, reply in steps:
+            if not await self.press(data):
+                return
+            if reply and not await self.text("text input", reply):
+                return
+        if await self.press("payment|start|current") and await self.press("payment|mock_success|"):
+            self.stats.paid += 1
+
+
+class Stats:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.api_calls: dict[str, list[int]] = defaultdict(list)
+        self.timeouts: Counter[str] = Counter()
+        self.paid = 0
+
+    def report(self, elapsed: float, api: FakeBotAPI) -> dict:
+        actions = sum(len(v) for v in self.latency.values())
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "actions": actions,
+            "actions_per_s": round(actions / elapsed, 1) if elapsed else 0.0,
+            "paid_orders": self.paid,
+            "timeouts": dict(self.timeouts),
+            "per_action": {
+                name: {
+                    "n": len(xs),
+                    "p50_ms": round(statistics.median(xs) * 1e3, 2),
+                    "p90_ms": round(percentile(xs, 0.90) * 1e3, 2),
+                    "p99_ms": round(percentile(xs, 0.99) * 1e3, 2),
+                    "max_ms": round(max(xs) * 1e3, 2),
+                    "api_calls_mean": round(statistics.mean(self.api_calls[name]), 2),
+                }
+                for name, xs in sorted(self.latency.items())
+            },
+            "api_calls": dict(api.calls.most_common()),
+            "api_429": dict(api.throttled),
+        }
+
+
+async def wait_until_polling(api: FakeBotAPI, proc: asyncio.subprocess.Process, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while not api.calls["getUpdates"]:
+        if proc.returncode is not None:
+            raise SystemExit(f"bot exited with code {proc.returncode}")
+        if time.monotonic() > deadline:
+            raise SystemExit("bot did not start polling in time")
+        await asyncio.sleep(0.05)
+
+
+async def run(a) -> dict:
+    db_url = setup_env(a.database_url)
+    from app.db.session import engine
+    from app.db.bootstrap import init_db
+
+    await init_db()
+    await seed_catalog(engine, a.products, n_categories=max(5, a.products // 2000),
+                       n_stones=max(10, a.products // 1000), seed=a.seed)
+    await engine.dispose()
+
+    api = FakeBotAPI(latency_ms=a.latency_ms, jitter_ms=a.jitter_ms, rate_429=a.rate_429, seed=a.seed)
+    base = await api.start()
+    env = {**os.environ, "BOT_TOKEN": TOKEN, "DATABASE_URL": db_url, "BOT_API_URL": base, "WORKERS": str(a.workers)}
+    proc = await asyncio.create_subprocess_exec(sys.executable, "-m", "app.main", env=env,
+                                                stdout=None if a.verbose else asyncio.subprocess.DEVNULL,
+                                                stderr=None if a.verbose else asyncio.subprocess.DEVNULL)
+    try:
+        t0 = time.perf_counter()
+        await wait_until_polling(api, proc, a.startup_timeout)
+        startup_s = time.perf_counter() - t0
+
+        rnd = random.Random(a.seed)
+        stats = Stats()
+
+        async def shopper(i: int):
+            await asyncio.sleep(rnd.uniform(0, a.ramp))
+            uid = 10_000 + i
+            await Shopper(api, uid, random.Random(rnd.random()), stats, a.think_ms, a.timeout).run(
+                pay=rnd.random() < a.pay_share)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(shopper(i) for i in range(a.users)))
+        out = stats.report(time.perf_counter() - t0, api)
+        out["meta"] = {
+            "users": a.users, "products": a.products, "latency_ms": a.latency_ms, "jitter_ms": a.jitter_ms,
+            "rate_429": a.rate_429, "think_ms": a.think_ms, "ramp_s": a.ramp, "startup_s": round(startup_s, 2),
+            "workers": a.workers,
+        }
+        return out
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+            try:
+                await asyncio.wait_for(proc.wait(), 10)
+            except asyncio.TimeoutError:
+                proc.kill()
+        await api.stop()
+
+
+def print_report(out: dict) -> None:
+    m = out["meta"]
+    print(f"{m['users']} shoppers, {m['products']} products, API latency {m['latency_ms']}+{m['jitter_ms']} ms, "
+          f"429 rate {m['rate_429']}, bot startup {m['startup_s']} s")
+    print(f"{out['actions']} actions in {out['elapsed_s']} s -> {out['actions_per_s']} actions/s, "
+          f"{out['paid_orders']} paid orders")
+    for name, r in out["per_action"].items():
+        print(f"  {name:26} n={r['n']:6}  p50={r['p50_ms']:8.2f}  p90={r['p90_ms']:8.2f}  "
+              f"p99={r['p99_ms']:8.2f}  max={r['max_ms']:8.2f} ms  api calls={r['api_calls_mean']:.2f}")
+    if out["timeouts"]:
+        print("  timeouts:", out["timeouts"])
+    print("  Bot API calls:", out["api_calls"])
+    if out["api_429"]:
+        print("  429 responses:", out["api_429"])
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--products", type=int, default=10_000)
+    ap.add_argument("--pay-share", type=float, default=0.5, help="share of shoppers that go through checkout")
+    ap.add_argument("--ramp", type=float, default=10.0, help="seconds over which shoppers arrive")
+    ap.add_argument("--think-ms", type=float, default=300.0, help="mean pause between a shopper's actions")
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--rate-429", type=float, default=0.0, help="probability of a 429 answer per API call")
+    ap.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for the reply to one action")
+    ap.add_argument("--startup-timeout", type=float, default=120.0)
+    ap.add_argument("--workers", type=int, default=1, help="bot worker processes (sharded mode when > 1)")
+    ap.add_argument("--database-url", help="defaults to a temporary SQLite file")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--verbose", action="store_true", help="show the bot's output")
+    ap.add_argument("--out", help="write results as JSON")
+    a = ap.parse_args()
+
+    out = asyncio.run(run(a))
+    print_report(out)
+    if a.out:
+        with open(a.out, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Query-plan regression check for the hot queries of app/handlers/callbacks.py.
+
+Seeds a large catalog into an empty database and asserts via EXPLAIN that every
+hot query reaches `products`/`categories`/`stones` through an index.
+
+    python -m bench.query_plans                       # temporary SQLite file
+    python -m bench.query_plans --url postgresql+asyncpg://user:pw@host/empty_db
+
+Exits with status 1 when a plan regresses to a table scan or an extra sort.
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from bench.common import setup_env, seed_catalog
+
+
+def hot_queries():
+    from sqlalchemy import select, func, or_, exists, delete
+    from app.db.models import Category, Stone, Product
+
+    def listing(**where):
+        q = (
+            select(Product, Category.name_ru, Stone.name_ru)
+            .join(Category, Product.category_id == Category.id)
+            .join(Stone, Product.stone_id == Stone.id)
+            .order_by(Product.id.desc())
+            .limit(30)
+        )
+        if "category_id" in where:
+            q = q.where(Product.category_id == where["category_id"])
+        if "stone_id" in where:
+            q = q.where(Product.stone_id == where["stone_id"])
+        return q
+
+    # name -> (statement, tables that must not be scanned, ORDER BY must come from an index)
+    return {
+        "add_duplicate_check": (
+            select(Product.id)
+            .where(Product.category_id == 3)
+            .where(Product.stone_id == 5)
+            .where(func.lower(Product.title) == func.lower("Изделие 42")),
+            {"products"}, False,
+        ),
+        "list_by_category": (listing(category_id=3), {"products", "categories", "stones"}, True),
+        "list_by_stone": (listing(stone_id=5), {"products", "categories", "stones"}, True),
+        "list_by_category_stone": (listing(category_id=3, stone_id=5), {"products", "categories", "stones"}, True),
+        "catalog1_codes": (
+            select(Category.code, Category.name_ru).where(Category.code.in_(["braslety", "kole", "sergi"])),
+            {"categories"}, False,
+        ),
+        "catalog2_codes": (
+            select(Stone.code, Stone.name_ru).where(Stone.code.in_(["ametist", "citrin", "agat"])),
+            {"stones"}, False,
+        ),
+        "category_by_term": (
+            select(Category).where(or_(func.lower(Category.name_ru) == func.lower("Браслеты"),
+                                       Category.code == "braslety")),
+            {"categories"}, False,
+        ),
+        "stone_by_term": (
+            select(Stone).where(or_(func.lower(Stone.name_ru) == func.lower("Аметист"),
+                                    Stone.code == "ametist")),
+            {"stones"}, False,
+        ),
+        "del_by_ids": (select(Product.id).where(Product.id.in_([7, 12, 15])), {"products"}, False),
+        "orphan_categories": (
+            delete(Category).where(~exists(select(Product.id).where(Product.category_id == Category.id))),
+            {"products"}, False,
+        ),
+        "orphan_stones": (
+            delete(Stone).where(~exists(select(Product.id).where(Product.stone_id == Stone.id))),
+            {"products"}, False,
+        ),
+    }
+
+
+def sqlite_problems(plan_rows, no_scan: set[str], ordered: bool) -> list[str]:
+    problems = []
+    for row in plan_rows:
+        detail = row[-1]
+        words = detail.split()
+        if words[:1] == ["SCAN"] and len(words) > 1 and words[1] in no_scan and "INDEX" not in words:
+            problems.append(detail)
+        if ordered and "TEMP B-TREE FOR ORDER BY" in detail:
+            problems.append(detail)
+    return problems
+
+
+def pg_problems(plan: dict, no_scan: set[str], ordered: bool) -> list[str]:
+    problems = []
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        kind = node.get("Node Type")
+        if kind == "Seq Scan" and node.get("Relation Name") in no_scan:
+            problems.append(f"Seq Scan on {node['Relation Name']}")
+        if ordered and kind in ("Sort", "Incremental Sort"):
+            problems.append(f"{kind} on {node.get('Sort Key')}")
+        stack.extend(node.get("Plans", []))
+    return problems
+
+
+async def check(engine) -> int:
+    failed = 0
+    dialect = engine.dialect.name
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("ANALYZE")
+        if dialect == "postgresql":
+            # catalog reference tables are tiny, force the planner to show whether an index is usable at all
+            await conn.exec_driver_sql("SET enable_seqscan = off")
+
+        for name, (stmt, no_scan, ordered) in hot_queries().items():
+            sql = str(stmt.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+            if dialect == "postgresql":
+                raw = (await conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql)).scalar_one()
+                plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+                problems = pg_problems(plan, no_scan, ordered)
+            else:
+                rows = (await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)).all()
+                problems = sqlite_problems(rows, no_scan, ordered)
+
+            if problems:
+                failed += 1
+                print(f"FAIL {name}: " + "; ".join(problems))
+            else:
+                print(f"ok   {name}")
+        await conn.rollback()
+    return failed
+
+
+async def run(url: str | None, n_products: int) -> int:
+    setup_env(url)
+    from app.db.session import engine
+    from app.db.bootstrap import init_db
+
+    await init_db()
+    await seed_catalog(engine, n_products)
+    try:
+        return await check(engine)
+    finally:
+        await engine.dispose()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", help="empty database to seed (default: temporary SQLite file)")
+    ap.add_argument("--products", type=int, default=100_000)
+    a = ap.parse_args()
+    failed = asyncio.run(run(a.url, a.products))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Routing cost of callback queries: aiogram's filter chain vs. the `ns|action` dispatch table.
+
+    python -m bench.routing --handlers 10 30 100 300 1000 --iterations 1000
+
+For every size N two routers with N callback handlers are built. The first is the
+classic chain of `F.data.startswith("nsI|go|")` filters, where a handler parses its
+own payload; the second is one `CallbackTable.dispatch` handler with N typed `Action`
+classes. Updates that hit the first, middle and last registered handler are fed
+through `Dispatcher.feed_update` with a fake Bot session; reported is µs per update.
+"""
+import argparse
+import asyncio
+import time
+import types
+from typing import Literal
+
+from bench.common import setup_env
+
+
+def percentile(xs: list[float], q: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else 0.0
+
+
+def filter_chain_router(n: int):
+    from aiogram import F, Router
+    from aiogram.types import CallbackQuery
+
+    router = Router(name=f"chain{n}")
+
+    def make(i):
+        async def handler(cb: CallbackQuery):
+            _ns, _action, payload = cb.data.split("|", 2)
+            pid_s, page_s = payload.split(":")
+            int(pid_s), int(page_s)
+            await cb.answer()
+        return handler
+
+    for i in range(n):
+        router.callback_query.register(make(i), F.data.startswith(f"ns{i}|go|"))
+    return router
+
+
+def table_router(n: int):
+    from aiogram import Router
+    from aiogram.types import CallbackQuery
+    from app.handlers.cbdata import Action, CallbackTable
+
+    router = Router(name=f"table{n}")
+    table = CallbackTable(stale_text="stale")
+    router.callback_query.register(table.dispatch)
+
+    async def handler(cb: CallbackQuery, data):
+        await cb.answer()
+
+    for i in range(n):
+        def body(ns):
+            ns["__annotations__"] = {"action": Literal["go"], "pid": int, "page": int}
+            ns["action"] = "go"
+        cls = types.new_class(f"Ns{i}", (Action,), {"prefix": f"ns{i}"}, body)
+        table.on(cls)(handler)
+    return router
+
+
+async def measure(router, bot, n: int, iterations: int) -> dict:
+    from aiogram import Dispatcher
+    from bench.fake_bot import callback_update
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    out = {}
+    for where, i in (("first", 0), ("middle", n // 2), ("last", n - 1)):
+        updates = [callback_update(1000 + k % 50, f"ns{i}|go|{k}:{k % 7}") for k in range(iterations)]
+        for u in updates[:50]:
+            await dp.feed_update(bot, u)
+        samples = []
+        for u in updates:
+            t0 = time.perf_counter()
+            await dp.feed_update(bot, u)
+            samples.append(time.perf_counter() - t0)
+        out[where] = (percentile(samples, 0.5) * 1e6, percentile(samples, 0.99) * 1e6)
+    return out
+
+
+async def main_async(args) -> None:
+    from bench.fake_bot import make_bot
+
+    bot, session = make_bot()
+    print(f"{'N':>6}  {'router':<12} {'first p50':>10} {'middle p50':>11} {'last p50':>9} {'last p99':>9}  (µs/update)")
+    for n in args.handlers:
+        for name, build in (("filter chain", filter_chain_router), ("table", table_router)):
+            r = await measure(build(n), bot, n, args.iterations)
+            print(f"{n:>6}  {name:<12} {r['first'][0]:>10.1f} {r['middle'][0]:>11.1f} "
+                  f"{r['last'][0]:>9.1f} {r['last'][1]:>9.1f}")
+    await bot.session.close()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--handlers", type=int, nargs="+", default=[10, 30, 100, 300, 1000])
+    ap.add_argument("--iterations", type=int, default=1000)
+    args = ap.parse_args()
+    setup_env(None)
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
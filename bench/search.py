@@ -0,0 +1,67 @@
+"""
+Build the product search index over a synthetic catalog and time lookups.
+
+    python -m bench.search --products 100000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from bench.common import setup_env, CAT_WORDS, STONE_WORDS
+
+ADJ = ["морозный", "солнечный", "лунный", "небесный", "тихий", "яркий", "нежный", "звёздный", "лесной", "речной"]
+QUERIES = ["браслет", "аметист", "морозный цитрин", "ametist", "kolie", "лун", "небесн аг", "цитирн", "zvezdnyi", "нет такого"]
+
+
+def build_items(n: int, seed: int = 0) -> list[dict]:
+    rnd = random.Random(seed)
+    items = []
+    for pid in range(1, n + 1):
+        cat, stone, adj = rnd.choice(CAT_WORDS), rnd.choice(STONE_WORDS), rnd.choice(ADJ)
+        items.append({
+            "id": pid,
+            "title": f"{cat.capitalize()} «{adj.capitalize()} {stone}» {pid}",
+            "description": f"{adj} {stone}, длина {rnd.randrange(14, 60)} см",
+            "price": rnd.randrange(500, 20_000, 10),
+        })
+    return items
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--products", type=int, default=100_000)
+    ap.add_argument("--repeat", type=int, default=50)
+    a = ap.parse_args()
+
+    setup_env(None)
+    from app.data.search import SearchIndex
+
+    items = build_items(a.products)
+    idx = SearchIndex()
+    t0 = time.perf_counter()
+    idx.rebuild(items)
+    print(f"build: {a.products} products, {len(idx.vocab)} tokens in {time.perf_counter() - t0:.2f}s")
+
+    for q in QUERIES:
+        cold, warm = [], []
+        for _ in range(a.repeat):
+            idx.clear_cache()
+            t0 = time.perf_counter()
+            hits = idx.search(q)
+            cold.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            idx.search(q)
+            warm.append(time.perf_counter() - t0)
+        print(f"{q!r:22} hits={len(hits):2}  cold p50={statistics.median(cold) * 1e3:8.3f} ms"
+              f"  cached p50={statistics.median(warm) * 1e6:6.1f} us")
+
+    t0 = time.perf_counter()
+    for it in items[:1000]:
+        idx.remove(it["id"])
+        idx.add(it)
+    print(f"incremental upsert: {(time.perf_counter() - t0) / 1000 * 1e6:.1f} us/product")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Memory of per-user state under a stream of distinct users.
+
+    python -m bench.user_state --users 1000000 --max-users 100000 --every 100000
+
+Every simulated user does what a shopper's clicks leave behind: a product screen
+(USER_CTX and the live-view index), a delivery form and input mode, a cart with
+one reserved unit. The maps are the handlers' own, so capacity eviction runs
+the real callbacks (a cart's unit goes back on sale). Printed per checkpoint:
+RSS, the size of each map and whether cached stock + units in carts still add
+up to the seeded stock. With --max-users above --users nothing is evicted,
+which shows the unbounded growth.
+"""
+import argparse
+import os
+import time
+
+from bench.common import setup_env
+
+STOCK = 10 ** 9
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=1_000_000)
+    ap.add_argument("--max-users", type=int, default=100_000)
+    ap.add_argument("--every", type=int, default=100_000)
+    args = ap.parse_args()
+    setup_env(None)
+    os.environ["USER_STATE_MAX_USERS"] = str(args.max_users)
+
+    from app.data import catalog
+    from app.handlers import callbacks
+    from app.live import WATCHING, VIEWERS, watch
+    from app.profiling import rss_bytes
+
+    pid = 1
+    catalog.PRODUCTS_BY_ID[pid] = {"id": pid, "title": "Изделие", "price": 1000, "stock": STOCK, "ver": 1, "rev": 1,
+                                   "category": "c", "stone": "s", "photos": []}
+    maps = {"USER_CTX": callbacks.USER_CTX, "DELIVERY_CTX": callbacks.DELIVERY_CTX,
+            "INPUT_MODE": callbacks.INPUT_MODE, "CART_META": callbacks.CART_META, "CART": callbacks.CART,
+            "WATCHING": WATCHING}
+
+    print(f"{'users':>9} {'rss MiB':>8} {'s':>6}  " + " ".join(f"{k:>12}" for k in maps) + "  stock ok")
+    t0 = time.perf_counter()
+    for uid in range(1, args.users + 1):
+        callbacks.USER_CTX[uid] = {"key": ("c", "s"), "pid": pid, "idx": 0, "img_idx": 0}
+        watch(uid, pid, uid, uid, 0, False, 1)
+        callbacks.DELIVERY_CTX.setdefault(uid, {"carrier": "cdek", "phone": None, "email": None, "address": None})
+        callbacks.INPUT_MODE[uid] = "phone"
+        if callbacks.dec_stock(pid, 1):
+            callbacks.user_cart(uid).add(pid)
+        if uid % args.every == 0:
+            held = sum(c.count for c in callbacks.CART.values())
+            ok = catalog.PRODUCTS_BY_ID[pid]["stock"] + held == STOCK
+            print(f"{uid:>9} {(rss_bytes() or 0) / 2**20:>8.1f} {time.perf_counter() - t0:>6.1f}  "
+                  + " ".join(f"{len(m):>12}" for m in maps.values()) + f"  {ok}")
+    assert len(VIEWERS.get(pid, ())) == len(WATCHING)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+﻿import pytest
+
+from app.utils import bounded
+from app.utils.bounded import BoundedDict
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bounded.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_capacity_evicts_least_recently_used(clock):
+    evicted = []
+    d = BoundedDict("test_lru", 2, on_evict=lambda k, v: evicted.append((k, v)))
+    d["a"] = 1
+    d["b"] = 2
+    assert d["a"] == 1  # "b" is now the least recently used
+    d["c"] = 3
+    assert evicted == [("b", 2)]
+    assert list(d) == ["a", "c"]
+
+
+def test_ttl_counts_from_last_use(clock):
+    evicted = []
+    d = BoundedDict("test_ttl", 10, ttl=60, on_evict=lambda k, v: evicted.append(k))
+    d["a"] = 1
+    d["b"] = 2
+    clock[0] += 50
+    assert d.get("a") == 1
+    clock[0] += 20
+    assert "b" not in d
+    assert d.get("a") == 1
+    assert d.expire() == 1
+    assert evicted == ["b"] and list(d) == ["a"]
+
+    clock[0] += 61
+    assert d.get("a") is None
+    assert evicted == ["b", "a"] and len(d) == 0
+
+
+def test_insert_drops_expired_entries(clock):
+    evicted = []
+    d = BoundedDict("test_insert", 10, ttl=60, on_evict=lambda k, v: evicted.append(k))
+    d["a"] = 1
+    clock[0] += 61
+    d["b"] = 2
+    assert evicted == ["a"] and list(d) == ["b"]
+
+
+def test_pop_and_del_do_not_call_on_evict(clock):
+    evicted = []
+    d = BoundedDict("test_pop", 10, ttl=60, on_evict=lambda k, v: evicted.append(k))
+    d["a"] = 1
+    d["b"] = 2
+    assert d.pop("a") == 1
+    del d["b"]
+    assert d.pop("c", None) is None
+    assert evicted == [] and len(d) == 0
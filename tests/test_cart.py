@@ -0,0 +1,58 @@
+﻿import pytest
+
+from app.data import catalog
+from app.data.cart import _HOLDERS, Cart, held, price_changed
+
+
+@pytest.fixture
+def products(monkeypatch):
+    monkeypatch.setattr(catalog, "PRODUCTS_BY_ID", {1: {"id": 1, "price": 100}, 2: {"id": 2, "price": 250}})
+    yield catalog.PRODUCTS_BY_ID
+    _HOLDERS.clear()
+
+
+def test_running_totals(products):
+    cart = Cart()
+    cart.add(1, 2)
+    cart.add(2)
+    cart.add(99)  # not in the catalog: counted in the badge only
+    assert (cart.count, cart.total_qty, cart.total) == (4, 3, 450)
+
+    assert cart.remove(1) == 2
+    assert cart.remove(2, 5) == 1
+    assert cart.remove(2) == 0
+    assert (cart.count, cart.total_qty, cart.total) == (1, 0, 0)
+    assert dict(cart) == {99: 1}
+
+
+def test_price_change_marks_only_holders_dirty(products):
+    a, b = Cart(), Cart()
+    a.add(1, 3)
+    b.add(2)
+    products[1]["price"] = 120
+    price_changed(1)
+    assert a.dirty and not b.dirty
+    assert a.total == 360 and not a.dirty
+    assert b.total == 250
+
+    del products[2]
+    price_changed(2)
+    assert (b.count, b.total_qty, b.total) == (1, 0, 0)
+
+
+def test_holders_follow_lines(products):
+    a, b = Cart(), Cart()
+    a.add(1, 2)
+    b.add(1)
+    b.add(2)
+    assert set(_HOLDERS[1]) == {id(a), id(b)}
+    assert held(1) == 3 and held(2) == 1
+
+    a.remove(1, 1)
+    assert held(1) == 2
+    a.remove(1)
+    assert set(_HOLDERS[1]) == {id(b)}
+
+    assert b.clear() == {1: 1, 2: 1}
+    assert _HOLDERS == {} and held(1) == 0
+    assert (b.count, b.total_qty, b.total, b.dirty) == (0, 0, 0, False)
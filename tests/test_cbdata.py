@@ -0,0 +1,61 @@
+﻿import pytest
+
+from app.handlers.cbdata import (
+    Action, CartItem, CartOpen, CartPhotoNav, Catalog2, Noop, PhotoNav, ProductAdd, ProductNav, callback_key,
+)
+
+
+@pytest.mark.parametrize("data", [
+    Noop(),
+    CartOpen(),
+    CartOpen(action="clear"),
+    Catalog2(cat=35),
+    ProductAdd(pid=1234, ver=36 ** 3),
+    ProductNav(direction="prev", pid=7),
+    PhotoNav(action="next", pid=12, img=3),
+    CartItem(action="dec", pid=5, ver=1),
+])
+def test_pack_unpack_round_trip(data):
+    packed = data.pack()
+    assert type(data).unpack(packed) == data
+    assert callback_key(packed) == (data.__prefix__ if "action" not in data.model_fields
+                                    else f"{data.__prefix__}|{data.action}")
+
+
+def test_ids_pack_in_base36():
+    assert Catalog2(cat=35).pack() == "catalog2|open|z"
+    assert ProductAdd(pid=1234, ver=36).pack() == "product|add|1234:10"
+    assert Noop().pack() == "noop"
+
+
+@pytest.mark.parametrize("cls, raw, expected", [
+    # payload fields joined by "|" and an empty payload, as older keyboards sent them
+    (CartPhotoNav, "cartimg|nav|prev|5:2", CartPhotoNav(direction="prev", pid=5, idx=2)),
+    (CartPhotoNav, "cartimg|nav|next|5|2", CartPhotoNav(direction="next", pid=5, idx=2)),
+    (CartOpen, "cart|open|", CartOpen()),
+    # buttons drawn before versions carry no `ver`
+    (ProductAdd, "product|add|12", ProductAdd(pid=12, ver=0)),
+    (CartItem, "cart|inc|12", CartItem(action="inc", pid=12, ver=0)),
+])
+def test_unpack_legacy(cls, raw, expected):
+    assert cls.unpack(raw) == expected
+
+
+@pytest.mark.parametrize("cls, raw", [
+    (ProductAdd, "cart|add|12"),
+    (ProductAdd, "product|add|12:1:2"),
+    (ProductAdd, "product|add|x"),
+    (CartItem, "cart|buy|12"),
+])
+def test_unpack_rejects_malformed(cls, raw):
+    with pytest.raises(ValueError):
+        cls.unpack(raw)
+
+
+def test_pack_rejects_separator_in_value():
+    class Tagged(Action, prefix="tag"):
+        action: str = "set"
+        name: str
+
+    with pytest.raises(ValueError):
+        Tagged(name="a:b").pack()
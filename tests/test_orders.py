@@ -0,0 +1,48 @@
+﻿from sqlalchemy import update
+
+from app.db.models import Order, OrderStatus
+from app.db.orders import confirm_order, create_pending_order, order_status
+from app.db.session import Session
+
+LINES = [{"product_id": 1, "title": "Браслет", "price": 300000, "qty": 2, "photos": []}]
+
+
+def new_order(run):
+    return run(create_pending_order(1, 1, "Test User", "test", "RUB", LINES))
+
+
+def confirm(run, payload, **fields):
+    async def go():
+        async with Session() as s:
+            order = await confirm_order(s, payload, **fields)
+            await s.commit()
+            return order
+    return run(go())
+
+
+def test_confirm_order_is_idempotent(run, schema):
+    payload = new_order(run)
+    order = confirm(run, payload, full_name="Paid User")
+    assert order is not None and order.status == OrderStatus.paid
+    assert order.full_name == "Paid User" and order.total_amount == 600000 and [it.qty for it in order.items] == [2]
+
+    # a second delivery of the same successful_payment
+    assert confirm(run, payload, full_name="Paid User") is None
+    assert run(order_status(payload)) == OrderStatus.paid
+
+
+def test_confirm_order_accepts_swept_order(run, schema):
+    payload = new_order(run)
+
+    async def sweep():
+        async with Session() as s:
+            await s.execute(update(Order).where(Order.payload == payload).values(status=OrderStatus.cancelled))
+            await s.commit()
+    run(sweep())
+
+    assert confirm(run, payload) is not None
+    assert confirm(run, payload) is None
+
+
+def test_confirm_order_unknown_payload(run, schema):
+    assert confirm(run, "no-such-payload") is None
@@ -0,0 +1,29 @@
+﻿import asyncio
+
+from bench.common import seed_catalog
+from bench.query_plans import hot_queries, sqlite_problems
+
+
+def test_hot_queries_use_indexes_on_sqlite(tmp_path):
+    from app.db.models import Base
+    from app.db.session import make_engine
+
+    async def plans():
+        eng = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'plans.db'}")
+        try:
+            async with eng.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            await seed_catalog(eng, 2_000)
+            async with eng.connect() as conn:
+                await conn.exec_driver_sql("ANALYZE")
+                found = {}
+                for name, (stmt, no_scan, ordered) in hot_queries().items():
+                    sql = str(stmt.compile(dialect=eng.dialect, compile_kwargs={"literal_binds": True}))
+                    rows = (await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)).all()
+                    found[name] = sqlite_problems(rows, no_scan, ordered)
+            return found
+        finally:
+            await eng.dispose()
+
+    problems = asyncio.run(plans())
+    assert problems and not any(problems.values()), problems